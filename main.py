@@ -1,26 +1,40 @@
 from copy import Error
 import os
+import sys
+import json
 import click
 from termcolor import colored
 import pprint
-import webbrowser
 
 from src.config import Config
 from src.youtube import YouTubeAccount
-from src.mturk import MTurkAccount
-from src.survey import HTMLSurvey
+from src.mturk import MTurkAccount, HITJournal
+from src.survey import HTMLSurvey, question_name
+from src.qualification import grade_qualifications
+from src.design import design_size, estimate_cost
+from src.status import StatusCache
+from src.metrics import ApiMetrics
+from src.store import ResponseStore
+from src.payments import PaymentLedger, PaymentRules, plan_payments, send_payments, review_assignments
+from src.pipeline import Pipeline, STAGES
 import src.utils as utils
 
+# Modules that import slow libraries (numpy, asyncio, webbrowser) are imported in the
+# methods that use them, so the menu shows up quickly (see src.startup)
+
 # TODOS:
 # - Clean up the process_data.py  file (put it into mturk.py ) and get it to work with mturk instead of qualtrics
-# - Figure out how to make the HIT only allow workers who have passed qualification
 
 class CLI:
     def __init__(self):
         self.config = Config()
-        self.youtube_account = YouTubeAccount(self.config["YOUTUBE"]["OAUTH_CLIENT_SECRETS_FILE"])
+        self.api_metrics = ApiMetrics(profile_commands=self.config["METRICS"]["PROFILE_COMMANDS"])
+        self.youtube_account = YouTubeAccount(self.config["YOUTUBE"]["OAUTH_CLIENT_SECRETS_FILE"],
+                                              self.config["YOUTUBE"]["TOKEN_CACHE"],
+                                              metrics=self.api_metrics)
         self.mturk_account = MTurkAccount(self.config["AWS"]["ACCESS_KEY_ID"],
-                                          self.config["AWS"]["SECRET_ACCESS_KEY"])
+                                          self.config["AWS"]["SECRET_ACCESS_KEY"],
+                                          metrics=self.api_metrics)
         self.qual_survey_files = [
             os.path.join(os.getcwd(), "surveys/qualification_survey.html"),
             os.path.join(os.getcwd(), "surveys/qualification_sample_survey_do_not_upload.html"),
@@ -31,10 +45,18 @@ class CLI:
             os.path.join(os.getcwd(), "surveys/sample_survey_do_not_upload.html"),
             os.path.join(os.getcwd(), "surveys/survey.csv")
         ]
+        self.response_store_file = os.path.join(os.getcwd(), "surveys/responses.sqlite3")
+        self.ledger_file = os.path.join(os.getcwd(), "surveys/ledger.sqlite3")
+        self.status = StatusCache()
+        self.status.register("survey_playlist", lambda: self.check_playlists("SURVEY"), ttl=300)
+        self.status.register("qual_playlist", lambda: self.check_playlists("QUALIFICATION"), ttl=300)
+        self.status.register("sandbox_hits", lambda: self.check_hits(sandbox=True), ttl=60)
+        self.status.register("live_hits", lambda: self.check_hits(sandbox=False), ttl=60)
 
 
     def prompt_user(self):
         self.config.load_config()
+        self.status.refresh_all()
         prompts = {
             'display_config': 'a',
             'edit_config': 'b',
@@ -44,6 +66,13 @@ class CLI:
             'create_sb_hit': 'f',
             'create_hit': 'g',
             'check_hit': 'h',
+            'watch_hits': 'n',
+            'allocate': 'o',
+            'analyze': 'i',
+            'create_qual_hit': 'j',
+            'grade_qual': 'k',
+            'pay': 'l',
+            'api_usage': 'm',
             'exit': 'x',
         }
 
@@ -51,25 +80,35 @@ class CLI:
             """ Dynamically create prompt text based on checks """
             good = colored('✔', 'green')
             bad = colored('✘', 'red')
+            unknown = colored('?', 'yellow')
+
+            def cached_status(name, is_good):
+                """ Mark and note for a background check, flagging stale values """
+                value, stale = self.status.get(name)
+                if value is None:
+                    return unknown, colored("(checking...)", 'yellow')
+                note = colored("(refreshing...)", 'yellow') if stale else ""
+                return (good if is_good(value) else bad), note
+
             youtube_config_filled = good if self.check_config("YOUTUBE") else bad
-            playlist_status = self.check_playlists("SURVEY")
-            playlist_created = good if playlist_status == "" else bad
-            qual_playlist_status = self.check_playlists("SURVEY")
-            qual_playlist_created = good if qual_playlist_status == "" else bad
+            playlist_created, playlist_note = cached_status("survey_playlist", lambda v: v == "")
+            qual_playlist_created, qual_playlist_note = cached_status("qual_playlist", lambda v: v == "")
+            playlist_status = self.status.get("survey_playlist")[0] or ""
+            qual_playlist_status = self.status.get("qual_playlist")[0] or ""
             survey_config_filled = good if self.check_config("SURVEY") else bad
             survey_created = good if self.check_surveys("survey") else bad
             qual_survey_created = good if self.check_surveys("qual") else bad
             aws_config_filled = good if self.check_config("AWS") else bad
             mturk_config_filled = good if self.check_config("MTURK") else bad
-            sandbox_hits_exist = good if self.check_hits(sandbox=True) else bad
-            actual_hits_exist = good if self.check_hits(sandbox=False) else bad
+            sandbox_hits_exist, sandbox_hits_note = cached_status("sandbox_hits", bool)
+            actual_hits_exist, actual_hits_note = cached_status("live_hits", bool)
             return ("Video Annotation CLI\n\n"
                 "Steps\n"
                 "-----\n"
                 f"1) YouTube Steps\n"
                 f" [{youtube_config_filled}] YouTube section of config.yml complete\n"
-                f" [{playlist_created}] Survey playlist created {playlist_status}\n"
-                f" [{qual_playlist_created}] Qualification playlist created {qual_playlist_status}\n"
+                f" [{playlist_created}] Survey playlist created {playlist_status} {playlist_note}\n"
+                f" [{qual_playlist_created}] Qualification playlist created {qual_playlist_status} {qual_playlist_note}\n"
                 f"2) Survey Steps\n"
                 f" [{survey_config_filled}] Survey section of config.yml complete\n"
                 f" [{survey_created}] Survey html created\n"
@@ -77,8 +116,8 @@ class CLI:
                 f"3) Create HITS in mechanical turk \n"
                 f" [{aws_config_filled}] AWS section of config.yml complete\n"
                 f" [{mturk_config_filled}] MTurk section of config.yml complete\n"
-                f" [{sandbox_hits_exist}] Hits have been created in the sandbox mode of MTURK\n"
-                f" [{actual_hits_exist}] Hits have been created in the normal mode of MTURK\n"
+                f" [{sandbox_hits_exist}] Hits have been created in the sandbox mode of MTURK {sandbox_hits_note}\n"
+                f" [{actual_hits_exist}] Hits have been created in the normal mode of MTURK {actual_hits_note}\n"
                 "\nOptions (enter the letter of the action you wish to perform)\n"
                 "------------------------------------------------------------\n"
                 " Config\n"
@@ -90,36 +129,66 @@ class CLI:
                 f"   {prompts['create_survey']} - Create survey html for mechanical turk\n"
                 f"   {prompts['verify_survey']} - Verify the sample survey is correct in your browser\n"
                 " Mechanical Turk\n"
+                f"   {prompts['create_qual_hit']} - Create qualification HITs\n"
+                f"   {prompts['grade_qual']} - Grade qualification HITs and qualify workers who pass\n"
                 f"   {prompts['create_sb_hit']} - Create HITs in mechanical turk sandbox mode\n"
                 f"   {prompts['create_hit']} - Create HITs in mechanical turk\n"
                 f"   {prompts['check_hit']} - Check status of HITs\n"
+                f"   {prompts['watch_hits']} - Watch HITs until they're done, showing work as it's submitted\n"
+                f"   {prompts['allocate']} - Expire HITs of settled videos and extend HITs of videos that need more ratings\n"
+                f"   {prompts['pay']} - Review and pay submitted HITs\n"
+                " Results\n"
+                f"   {prompts['analyze']} - Summarize ratings and rater agreement\n"
+                " API usage\n"
+                f"   {prompts['api_usage']} - Show API calls, latency and YouTube quota used\n"
                 "\n"
                 f"   {prompts['exit']} - Exit\n")
 
         prompt_response = True
         while prompt_response:
             prompt_response = click.prompt(get_prompt_text(), prompt_suffix='', type=str).lower()
-            if prompt_response == prompts['exit']:
-                exit()
-            elif prompt_response == prompts['display_config']:
-                print(f"\nCONFIG\n------\n{self.config}\n")
-            elif prompt_response == prompts['edit_config']:
-                self.edit_config()
-            elif prompt_response == prompts['yt_playlists']:
-                self.youtube_check_status()
-            elif prompt_response == prompts['create_survey']:
-                self.create_surveys()
-            elif prompt_response == prompts['verify_survey']:
-                self.verify_survey()
-            elif prompt_response == prompts['create_sb_hit']:
-                self.mturk_create_hit(sandbox=True)
-            elif prompt_response == prompts['create_hit']:
-                self.mturk_create_hit(sandbox=False)
-            elif prompt_response == prompts['check_hit']:
-                self.mturk_check_hit_status()
-            else:
-                print("Invalid choice, please try again.")
-                continue
+            # Calls made by the command are profiled under its name if PROFILE_COMMANDS is set
+            command = next((name for name, letter in prompts.items() if letter == prompt_response), None)
+            with self.api_metrics.command(command):
+                if prompt_response == prompts['exit']:
+                    exit()
+                elif prompt_response == prompts['display_config']:
+                    print(f"\nCONFIG\n------\n{self.config}\n")
+                elif prompt_response == prompts['edit_config']:
+                    self.edit_config()
+                    self.status.invalidate()
+                elif prompt_response == prompts['yt_playlists']:
+                    self.youtube_check_status()
+                elif prompt_response == prompts['create_survey']:
+                    self.create_surveys()
+                    self.status.invalidate("survey_playlist", "qual_playlist")
+                elif prompt_response == prompts['verify_survey']:
+                    self.verify_survey()
+                elif prompt_response == prompts['create_sb_hit']:
+                    self.mturk_create_hit(sandbox=True)
+                    self.status.invalidate("sandbox_hits")
+                elif prompt_response == prompts['create_hit']:
+                    self.mturk_create_hit(sandbox=False)
+                    self.status.invalidate("live_hits")
+                elif prompt_response == prompts['check_hit']:
+                    self.mturk_check_hit_status()
+                elif prompt_response == prompts['watch_hits']:
+                    self.mturk_watch_hits()
+                elif prompt_response == prompts['allocate']:
+                    self.mturk_allocate(sandbox=click.confirm("Use the sandbox?", default=True))
+                elif prompt_response == prompts['analyze']:
+                    self.analyze_ratings()
+                elif prompt_response == prompts['create_qual_hit']:
+                    self.mturk_create_qualification_hit(sandbox=click.confirm("Use the sandbox?", default=True))
+                elif prompt_response == prompts['grade_qual']:
+                    self.mturk_grade_qualification(sandbox=click.confirm("Use the sandbox?", default=True))
+                elif prompt_response == prompts['pay']:
+                    self.mturk_pay(sandbox=click.confirm("Use the sandbox?", default=True))
+                elif prompt_response == prompts['api_usage']:
+                    self.show_api_usage()
+                else:
+                    print("Invalid choice, please try again.")
+                    continue
 
             click.prompt(
                 "\nPress enter to show CLI again",
@@ -146,8 +215,11 @@ class CLI:
     def check_playlists(self, type):
         """ Check that YouTube playlists have been created """
         playlist_name = self.config["SURVEY"][f"{type}_PLAYLIST"]
-        if playlist_name == "":
+        if not playlist_name:
             return "Playlist name not filled in config"
+        # Runs in the background, so never open the browser to log in here
+        if not self.youtube_account.login(interactive=False):
+            return "Not logged in to YouTube (check the playlists to log in)"
         playlist_data = self.youtube_account.get_playlist(playlist_name)
         if playlist_data == None:
             return "Playlist not found in YouTube Account"
@@ -176,21 +248,39 @@ class CLI:
 
     def create_surveys(self):
         """ Create survey using videos from a selected playlist"""
-        # Get playlists
-        qual_playlist = self.youtube_account.get_playlist(self.config["SURVEY"]["QUALIFICATION_PLAYLIST"])
-        survey_playlist = self.youtube_account.get_playlist(self.config["SURVEY"]["SURVEY_PLAYLIST"])
+        # Get both playlists from one listing of the account's playlists
+        titles = [self.config["SURVEY"]["QUALIFICATION_PLAYLIST"], self.config["SURVEY"]["SURVEY_PLAYLIST"]]
+        playlists = self.youtube_account.find_playlists(titles)
+        qual_playlist, survey_playlist = playlists[titles[0]], playlists[titles[1]]
+
+        # Show how many surveys will be created and what they will cost
+        survey_config = self.config["SURVEY"]
+        ratings_per_video = survey_config["RATINGS_PER_VIDEO"]
+        print("\n")
+        for name, plist, num_vids in [("Qualification", qual_playlist, survey_config["QUALIFICATION_VIDEOS"]),
+                                      ("Survey", survey_playlist, survey_config["SURVEY_VIDEOS"])]:
+            if plist is None:
+                return
+            num_surveys = design_size(len(plist['videos']), num_vids, ratings_per_video)
+            cost = estimate_cost(num_surveys, self.config["MTURK"]["MAX_ASSIGNMENTS"],
+                                 self.config["MTURK"]["REWARD"])
+            print(f"{name}: {num_surveys} surveys of {num_vids} videos, each video in "
+                  f"{ratings_per_video} surveys (estimated cost ${cost:,.2f})")
+        if not click.confirm("Create these surveys?", default=True):
+            return
 
         def upload(plist, num_vids):
             """ Ensure playlist has the correct number of videos """
             try:
-                return HTMLSurvey(plist, num_vids)
+                return HTMLSurvey(plist, num_vids, ratings_per_video, survey_config["SEED"],
+                                  survey_config["CSV_SHARD_ROWS"], survey_config["TEMPLATE"])
             except ValueError as e:
                 print(e)
             return "ERROR"
 
         # Upload videos
-        qual_survey = upload(qual_playlist, self.config["SURVEY"]["QUALIFICATION_VIDEOS"])
-        survey = upload(survey_playlist, self.config["SURVEY"]["SURVEY_VIDEOS"])
+        qual_survey = upload(qual_playlist, survey_config["QUALIFICATION_VIDEOS"])
+        survey = upload(survey_playlist, survey_config["SURVEY_VIDEOS"])
         if "ERROR" in [qual_survey, survey]:
             return
 
@@ -203,32 +293,311 @@ class CLI:
 
     def verify_survey(self):
         """ Open the sample survey in a webbrowser """
+        import webbrowser
         file = f"file://{self.survey_files[1]}"
         webbrowser.open_new_tab(file)
 
 
     def mturk_create_hit(self, sandbox=True):
-        """ Create HIT """
-        self.mturk_account.create_hit(self.config["MTURK"], sandbox=sandbox)
+        """ Create a HIT for each survey in the survey csv """
+        if not self.check_surveys("survey"):
+            print("Create the surveys first")
+            return
+        qualification_type_id = None
+        if self.config["MTURK"]["REQUIRE_QUALIFICATION"]:
+            qualification_type_id = self.mturk_account.get_qualification_type(
+                self.config["MTURK"]["QUALIFICATION_NAME"], sandbox)
+            if qualification_type_id is None:
+                print("No workers have been qualified yet, grade the qualification HITs first "
+                      "(or set REQUIRE_QUALIFICATION to False in config.yml)")
+                return
+        self.mturk_account.create_hits_from_csv(
+            self.config["MTURK"], self.survey_files[0], self.survey_files[2],
+            self.hit_journal_file(sandbox), sandbox=sandbox,
+            qualification_type_id=qualification_type_id
+        )
+
+
+    def mturk_create_qualification_hit(self, sandbox=True):
+        """ Create a HIT for each survey in the qualification survey csv """
+        if not self.check_surveys("qual"):
+            print("Create the surveys first")
+            return
+        self.mturk_account.create_hits_from_csv(
+            self.config["MTURK"], self.qual_survey_files[0], self.qual_survey_files[2],
+            self.hit_journal_file(sandbox, qualification=True), sandbox=sandbox
+        )
+
+
+    def mturk_grade_qualification(self, sandbox=True):
+        """ Grade qualification HITs, qualify workers who pass and review their assignments """
+        hit_config = self.config["MTURK"]
+        gold_file = hit_config["QUALIFICATION_ANSWERS"]
+        if not gold_file or not os.path.isfile(gold_file):
+            print("Fill in QUALIFICATION_ANSWERS in config.yml with the csv of gold standard ratings")
+            return
+
+        grades, worker_scores = grade_qualifications(
+            self.mturk_account, self.hit_journal_file(sandbox, qualification=True), gold_file,
+            hit_config["QUALIFICATION_TOLERANCE"], sandbox)
+        passed = {w: round(score * 100) for w, score in worker_scores.items()
+                  if score >= hit_config["QUALIFICATION_PASS_SCORE"]}
+        print(f"Graded {len(grades)} assignments from {len(worker_scores)} workers, {len(passed)} passed")
+        if not grades:
+            return
+
+        # Qualify workers who passed
+        name = hit_config["QUALIFICATION_NAME"]
+        qualification_type_id = self.mturk_account.get_qualification_type(name, sandbox)
+        if qualification_type_id is None:
+            qualification_type_id = self.mturk_account.create_qualification_type(
+                name, "Passed the qualification survey for rating surgical videos", sandbox)
+        limiter = self.mturk_account.get_limiter(hit_config)
+        results = self.mturk_account.qualify_workers(qualification_type_id, passed, limiter, sandbox)
+
+        # Review the qualification assignments
+        failed = [a for a, g in grades.items() if g['graded'] and g['worker_id'] not in passed]
+        if hit_config["REJECT_FAILED_QUALIFICATIONS"]:
+            approve = [a for a in grades if a not in failed]
+            results += self.mturk_account.reject_assignments(
+                failed, "Your ratings did not match the expected ratings closely enough.", limiter, sandbox)
+        else:
+            approve = list(grades)
+        results += self.mturk_account.approve_assignments(approve, None, limiter, sandbox)
+
+        errors = [error for _, _, error in results if error is not None]
+        print(f"Qualified {len(passed)} workers and reviewed {len(grades)} assignments "
+              f"({len(errors)} errors)")
+        for error in errors[:10]:
+            print(f"  {error}")
 
 
     def check_hits(self, sandbox=True):
         """ Check if hits exist """
         if not self.check_config("AWS"):
             return False
-        hits = self.mturk_account.get_hits(sandbox=sandbox)
-        return True if len(hits) > 0 else False
+        return self.mturk_account.has_hits(sandbox=sandbox)
 
 
     def mturk_check_hit_status(self):
-        """ Pring status of all HITS """
-        print("HITS (sandbox):")
-        pprint.pprint(self.mturk_account.get_hits(sandbox=True))
-        print("HITS:")
-        pprint.pprint(self.mturk_account.get_hits(sandbox=False))
-
+        """ Sync new work into the local response store and print status of all HITS """
+        store = ResponseStore(self.response_store_file)
+        for name, sandbox in [("HITS (sandbox)", True), ("HITS", False)]:
+            changes = store.sync(self.mturk_account, sandbox, self.hit_journal_file(sandbox))
+            print(f"{name}: {changes['changed_hits']} HITs changed, "
+                  f"{changes['new_assignments']} new assignments")
+            pprint.pprint(store.summary(sandbox), sort_dicts=False)
+            from src.export import RatingExport
+            export_dir = self.rating_export_dir(sandbox)
+            exported = RatingExport(export_dir).append(store, sandbox)
+            print(f"Exported {exported} new ratings to {export_dir}")
+        store.close()
+
+
+    def mturk_watch_hits(self, modes=(True, False)):
+        """ Poll the sandbox and/or live HITs until they're finished or Ctrl+C is pressed """
+        if not self.check_config("AWS"):
+            print("Fill out the AWS section of config.yml first")
+            return None
+        from src.watch import HITWatcher
+        watch_config = self.config["WATCH"]
+        watcher = HITWatcher(self, watch_config["MIN_INTERVAL_SECONDS"], watch_config["MAX_INTERVAL_SECONDS"],
+                             allocate=self.config["ALLOCATION"]["WHILE_WATCHING"])
+        print("Watching HITs, press Ctrl+C to stop")
+        try:
+            return watcher.run(modes)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+            return None
+
+
+    def mturk_allocate(self, sandbox=True):
+        """ Sync the HITs, then expire or extend them based on how settled their videos' ratings are """
+        store = ResponseStore(self.response_store_file)
+        store.sync(self.mturk_account, sandbox, self.hit_journal_file(sandbox))
+        self.allocation_round(store, sandbox, confirm=True)
+        store.close()
+
+
+    def allocation_round(self, store, sandbox=True, confirm=False):
+        """ Expire the HITs of settled videos and extend HITs of videos that need more ratings
+
+        Args:
+            store (ResponseStore): Synced response store.
+            sandbox (bool): Use the sandbox HITs instead of the live ones.
+            confirm (bool): Ask before sending the changes to MTurk.
+
+        Returns:
+            dict: Results of apply_allocation, or None if nothing was sent.
+        """
+        from src.analysis import RatingArray
+        from src.allocation import AllocationRules, plan_allocation, apply_allocation
+        question_order = [question_name(q['title']) for q in HTMLSurvey.get_questions()]
+        # Ratings the payment rules would reject mustn't settle a video
+        rejected = set(a['assignment_id'] for a, action, _ in review_assignments(
+            store, PaymentRules.from_config(self.config["MTURK"]), sandbox) if action == 'reject')
+        ratings = RatingArray.from_store(store, sandbox, question_order, exclude=rejected)
+        plan = plan_allocation(store, ratings, AllocationRules.from_config(self.config["ALLOCATION"]), sandbox)
+        added = sum(after - before for before, after in plan['extend'].values())
+        print(f"Videos: {plan['settled']} settled, {plan['waiting']} waiting for ratings, "
+              f"{plan['stuck']} unsettled with no HIT left to extend")
+        print(f"To send: expire {len(plan['expire'])} HITs, add {added} assignments to "
+              f"{len(plan['extend'])} HITs")
+        if not (plan['expire'] or plan['extend']) or (confirm and not click.confirm("Send them now?")):
+            return None
+        results = apply_allocation(self.mturk_account, plan, self.mturk_account.get_limiter(self.config["MTURK"]),
+                                   sandbox)
+        print(f"Expired {results['expired_hits']} HITs, added {results['added_assignments']} assignments to "
+              f"{results['extended_hits']} HITs ({len(results['errors'])} failed, run again to retry them)")
+        for error in results['errors'][:10]:
+            print(f"  {error}")
+        return results
+
+
+    def mturk_pay(self, sandbox=True):
+        """ Approve, reject and bonus submitted survey HITs using the rules in config.yml """
+        hit_config = self.config["MTURK"]
+        qualified_workers = None
+        if hit_config["REQUIRE_QUALIFICATION"]:
+            qualification_type_id = self.mturk_account.get_qualification_type(
+                hit_config["QUALIFICATION_NAME"], sandbox)
+            if qualification_type_id is None:
+                # Every assignment would be rejected for a qualification nobody could get yet
+                print(f"The qualification '{hit_config['QUALIFICATION_NAME']}' doesn't exist yet, grade the "
+                      "qualification HITs first or set REQUIRE_QUALIFICATION to False in config.yml")
+                return
+            qualified_workers = self.mturk_account.get_qualified_workers(qualification_type_id, sandbox)
+
+        journal_file = self.hit_journal_file(sandbox)
+        store = ResponseStore(self.response_store_file)
+        ledger = PaymentLedger(self.ledger_file)
+        store.sync(self.mturk_account, sandbox, journal_file)
+        rules = PaymentRules.from_config(hit_config)
+        actions = plan_payments(store, ledger, rules, sandbox, set(HITJournal(journal_file).hit_videos()),
+                                qualified_workers)
+        store.close()
+
+        counts = {}
+        for row in actions:
+            counts[row['action']] = counts.get(row['action'], 0) + 1
+        bonus = sum(float(row['amount']) for row in actions if row['action'] == 'bonus')
+        print(f"To send: {counts.get('approve', 0)} approvals, {counts.get('reject', 0)} rejections, "
+              f"{counts.get('bonus', 0)} bonuses (${bonus:.2f})")
+        if actions and click.confirm("Send them now?"):
+            results = send_payments(self.mturk_account, ledger, actions,
+                                    self.mturk_account.get_limiter(hit_config), sandbox)
+            print(f"Sent {results['succeeded']} actions ({results['failed']} failed, "
+                  "run again to retry them)")
+            for row in [row for row in ledger.pending(sandbox) if row['error']][:10]:
+                print(f"  {row['action']} {row['assignment_id']}: {row['error']}")
+        done, paid = ledger.totals(sandbox)
+        print(f"Ledger: {done.get('approve', 0)} approved, {done.get('reject', 0)} rejected, "
+              f"${paid:.2f} paid in bonuses")
+        ledger.close()
+
+
+    def analyze_ratings(self):
+        """ Summarize the ratings in the response store and save them to a csv """
+        import numpy as np
+        from src.analysis import RatingArray, DawidSkeneFit
+        store = ResponseStore(self.response_store_file)
+        question_order = [question_name(q['title']) for q in HTMLSurvey.get_questions()]
+        for name, sandbox in [("sandbox", True), ("live", False)]:
+            ratings = RatingArray.from_store(store, sandbox, question_order)
+            if not ratings.mask.any():
+                print(f"No {name} ratings yet (check the status of HITs to collect them)")
+                continue
+            # Weight workers by reliability, starting from the last fit if there is one
+            weighted_scores = np.full(ratings.mask.shape[:2], np.nan)
+            for q, question in enumerate(ratings.questions):
+                fit_file = os.path.join(os.getcwd(), f"surveys/dawid_skene_{name}_{question}.npz")
+                warm_start = DawidSkeneFit.load(fit_file) if os.path.isfile(fit_file) else None
+                fit = ratings.dawid_skene(q, warm_start=warm_start)
+                fit.save(fit_file)
+                weighted_scores[:, q] = fit.scores()
+            weighted_scores[~ratings.mask.any(axis=2)] = np.nan
+            results_file = os.path.join(os.getcwd(), f"surveys/results_{name}.csv")
+            ratings.save_csv(results_file, {'weighted_score': weighted_scores})
+            alpha = ratings.krippendorff_alpha("ordinal", categories=[1, 2, 3, 4, 5])
+            icc1, icck = ratings.icc()
+            print(f"\n{name.capitalize()}: {int(ratings.mask.sum())} ratings of {len(ratings.videos)} videos")
+            print(f"  {'Question':<20} {'Alpha':>7} {'ICC(1)':>7} {'ICC(k)':>7}")
+            for q, question in enumerate(ratings.questions):
+                print(f"  {question:<20} {alpha[q]:>7.3f} {icc1[q]:>7.3f} {icck[q]:>7.3f}")
+            print(f"  Per video results are here: {results_file}")
+        store.close()
+
+
+    def show_api_usage(self):
+        """ Print the API calls made this session and optionally export them as JSON """
+        print(self.api_metrics.report(self.config["YOUTUBE"]["DAILY_QUOTA"]))
+        profiles = self.api_metrics.to_dict()['commands']
+        if profiles:
+            print("\nBy command:")
+            for command, operations in profiles.items():
+                calls = sum(op['calls'] for op in operations.values())
+                quota = sum(op['quota'] for op in operations.values())
+                seconds = sum(op['seconds'] for op in operations.values())
+                print(f"  {command:<20} {calls:>6} calls {seconds:>8.1f}s {quota:>6} quota")
+        export = self.config["METRICS"]["EXPORT"]
+        if export and click.confirm(f"Export to {export}?", default=False):
+            os.makedirs(os.path.dirname(os.path.abspath(export)), exist_ok=True)
+            self.api_metrics.save(export)
+            print(f"API usage is here: {os.path.abspath(export)}")
+
+
+    def hit_journal_file(self, sandbox=True, qualification=False):
+        """ Journal of HITs created from the survey (or qualification survey) csv """
+        prefix = "qualification_hits" if qualification else "hits"
+        return os.path.join(os.getcwd(), f"surveys/{prefix}_{'sandbox' if sandbox else 'live'}.jsonl")
+
+
+    def rating_export_dir(self, sandbox=True):
+        """ Folder of the columnar export of the sandbox or live ratings """
+        return os.path.join(os.getcwd(), f"surveys/ratings_{'sandbox' if sandbox else 'live'}")
+
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(ctx):
+    """ Video crowdsourcing CLI, shows the interactive menu when run without a command """
+    if ctx.invoked_subcommand is None:
+        cli = CLI()
+        cli.prompt_user()
+
+
+@main.command()
+@click.option("--stage", "stages", multiple=True, type=click.Choice(STAGES),
+              help="Stage to run (can be repeated), all stages if not given.")
+@click.option("--mode", type=click.Choice(["sandbox", "live", "both"]), default="sandbox", show_default=True,
+              help="Create and collect HITs in the sandbox, the live site or both at once.")
+@click.option("--qualification", is_flag=True, help="Create qualification HITs instead of survey HITs.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Also save the JSON results to this file.")
+def run(stages, mode, qualification, output):
+    """ Run the stages without prompts and print the results as JSON
+
+    playlists -> surveys -> hits -> collect -> export
+    """
+    modes = {"sandbox": [True], "live": [False], "both": [True, False]}[mode]
+    results = Pipeline(CLI()).run(stages or STAGES, modes, qualification)
+    text = json.dumps(results, indent=2, default=str)
+    if output:
+        utils.save_text(output, text)
+    print(text)
+    sys.exit(0 if results['ok'] else 1)
+
+
+@main.command()
+@click.option("--mode", type=click.Choice(["sandbox", "live", "both"]), default="both", show_default=True,
+              help="Watch the sandbox HITs, the live HITs or both.")
+def watch(mode):
+    """ Poll HITs until they're finished, printing new submissions as they arrive """
+    modes = {"sandbox": [True], "live": [False], "both": [True, False]}[mode]
+    cli = CLI()
+    if cli.mturk_watch_hits(modes) is None:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    cli = CLI()
-    cli.prompt_user()
+    main()
@@ -0,0 +1,144 @@
+import datetime
+from src.ratelimit import call_many
+from src.watch import expired
+
+# Expiring a HIT is done by moving its expiration into the past
+EXPIRE_AT = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class AllocationRules:
+    """When a video has enough ratings, and how far HITs can be extended.
+
+    A video is settled once every question has at least min_ratings ratings
+    and a confidence interval of its mean rating no wider than max_width.
+
+    Args:
+        confidence (float): Confidence level of the intervals, e.g. 0.95.
+        max_width (float): Widest interval (in rating points) that counts as settled.
+        min_ratings (int): Ratings each question needs before it can be settled.
+        max_assignments (int): Most assignments a HIT can be extended to.
+        step (int): Assignments added to a HIT at a time.
+    """
+    def __init__(self, confidence=0.95, max_width=1.0, min_ratings=3, max_assignments=9, step=1):
+        self.confidence = confidence
+        self.max_width = max_width
+        self.min_ratings = min_ratings
+        self.max_assignments = max_assignments
+        self.step = step
+
+
+    @classmethod
+    def from_config(cls, allocation_config):
+        return cls(
+            confidence=allocation_config["CONFIDENCE"],
+            max_width=allocation_config["MAX_INTERVAL_WIDTH"],
+            min_ratings=allocation_config["MIN_RATINGS"],
+            max_assignments=allocation_config["MAX_TOTAL_ASSIGNMENTS"],
+            step=allocation_config["ASSIGNMENTS_PER_ROUND"],
+        )
+
+
+    def settled_videos(self, ratings):
+        """ Video urls of a RatingArray whose ratings have converged """
+        if not ratings.mask.any():
+            return set()
+        count = ratings.mask.sum(axis=2)
+        width = 2 * ratings.confidence_half_width(self.confidence)
+        settled = (count.min(axis=1) >= self.min_ratings) & (width.max(axis=1) <= self.max_width)
+        return set(ratings.videos[settled])
+
+
+
+def plan_allocation(store, ratings, rules, sandbox=False):
+    """ Decide which HITs to expire and which to extend with more assignments
+
+    HITs whose videos are all settled are expired so no more of their
+    assignments are paid for. Videos that aren't settled and have no
+    assignments left to come get more ratings by extending the fewest
+    finished HITs that cover them, picking the HITs with the most
+    unsettled videos first.
+
+    Args:
+        store (ResponseStore): Synced store with the HITs and their videos.
+        ratings (RatingArray): Current ratings of the videos.
+        rules (AllocationRules): When videos are settled.
+        sandbox (bool): Plan for the sandbox HITs instead of the live ones.
+
+    Returns:
+        dict: Hit ids to 'expire', {hit id: (assignments now, assignments
+            after)} to 'extend', and the number of 'settled', 'waiting'
+            (ratings still to come) and 'stuck' (no HIT left to extend) videos.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    hits = {}
+    for hit_id, status, max_assignments, available, pending, expiration, video_url in store.db.execute(
+            "SELECT h.hit_id, h.status, h.max_assignments, h.available, h.pending, h.expiration, v.video_url "
+            "FROM hits h JOIN hit_videos v ON h.hit_id = v.hit_id WHERE h.sandbox = ?", (int(sandbox),)):
+        hit = hits.setdefault(hit_id, {
+            'max_assignments': max_assignments or 0, 'available': available, 'pending': pending,
+            # Finished HITs can still be extended until they're disposed of or expire
+            'closed': status == "Disposed" or expired(expiration, now),
+            'videos': set()})
+        hit['videos'].add(video_url)
+
+    settled = rules.settled_videos(ratings)
+    expire = [hit_id for hit_id, hit in hits.items()
+              if hit['available'] and not hit['closed'] and hit['videos'] <= settled]
+
+    # Videos that still have assignments on the way don't need more yet
+    waiting = set()
+    for hit_id, hit in hits.items():
+        # Accepted assignments can still be submitted after the HIT expires
+        if hit['pending'] or (hit['available'] and not hit['closed'] and hit_id not in expire):
+            waiting |= hit['videos']
+    needed = set().union(*[hit['videos'] for hit in hits.values()]) - settled - waiting
+
+    candidates = {hit_id: hit for hit_id, hit in hits.items()
+                  if not hit['closed'] and not hit['available'] and not hit['pending']
+                  and hit['max_assignments'] < rules.max_assignments}
+    extend = {}
+    while needed and candidates:
+        hit_id = max(candidates, key=lambda h: (len(candidates[h]['videos'] & needed), h))
+        hit = candidates.pop(hit_id)
+        if not hit['videos'] & needed:
+            break
+        extend[hit_id] = (hit['max_assignments'],
+                          min(hit['max_assignments'] + rules.step, rules.max_assignments))
+        needed -= hit['videos']
+
+    videos = set().union(*[hit['videos'] for hit in hits.values()])
+    return {'expire': expire, 'extend': extend, 'settled': len(videos & settled),
+            'waiting': len(waiting - settled), 'stuck': len(needed)}
+
+
+def apply_allocation(account, plan, limiter=None, sandbox=False):
+    """ Expire and extend the HITs of a plan made by plan_allocation
+
+    Extensions use a request token made from the HIT and its new number of
+    assignments, so running a round again before the store is synced
+    doesn't extend a HIT twice.
+
+    Returns:
+        dict: Number of HITs expired, extended and assignments added, and
+            the errors of any calls that failed.
+    """
+    client = account.get_client(sandbox)
+    errors = []
+    results = call_many(client.update_expiration_for_hit,
+                        [{'HITId': hit_id, 'ExpireAt': EXPIRE_AT} for hit_id in plan['expire']], limiter)
+    expired_hits = sum(error is None for _, _, error in results)
+    errors += [f"expire {kwargs['HITId']}: {error}" for kwargs, _, error in results if error is not None]
+
+    results = call_many(client.create_additional_assignments_for_hit, [
+        {'HITId': hit_id, 'NumberOfAdditionalAssignments': after - before,
+         'UniqueRequestToken': f"{hit_id}-extend-{after}"}
+        for hit_id, (before, after) in plan['extend'].items()], limiter)
+    extended = added = 0
+    for kwargs, _, error in results:
+        if error is not None and "UniqueRequestToken" not in str(error):
+            errors.append(f"extend {kwargs['HITId']}: {error}")
+            continue
+        extended += 1
+        added += kwargs['NumberOfAdditionalAssignments']
+    return {'expired_hits': expired_hits, 'extended_hits': extended, 'added_assignments': added,
+            'errors': errors}
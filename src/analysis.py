@@ -0,0 +1,449 @@
+import csv
+import math
+import numpy as np
+
+
+class RatingArray:
+    """Ratings arranged as a (video x question x rater) array.
+
+    The rater axis holds the ratings of each video/question in the order
+    they were given, so different videos can be rated by different workers.
+    Missing ratings are NaN in `ratings` and False in `mask`.
+
+    Args:
+        videos (list): Video url of each rating.
+        questions (list): Question name of each rating.
+        workers (list): Worker id of each rating.
+        values (list): The ratings.
+        question_order (list): Optional order of the question axis, e.g.
+            the names of HTMLSurvey.get_questions.
+
+    Attributes:
+        videos (np.ndarray): Video url of each index of the first axis.
+        questions (np.ndarray): Question name of each index of the second axis.
+        ratings (np.ndarray): float array of shape (video, question, rater).
+        workers (np.ndarray): Index into worker_ids of each rating, -1 if missing.
+        worker_ids (np.ndarray): Worker id of each worker index.
+        mask (np.ndarray): bool array, True where there is a rating.
+    """
+    def __init__(self, videos, questions, workers, values, question_order=None):
+        self.videos, video_idx = np.unique(np.asarray(videos, dtype=object).astype(str), return_inverse=True)
+        if question_order is None:
+            self.questions, question_idx = np.unique(np.asarray(questions, dtype=str), return_inverse=True)
+        else:
+            self.questions = np.asarray(question_order, dtype=str)
+            lookup = {q: i for i, q in enumerate(question_order)}
+            names, question_idx = np.unique(np.asarray(questions, dtype=str), return_inverse=True)
+            question_idx = np.array([lookup[q] for q in names], dtype=np.int64)[question_idx]
+        self.worker_ids, worker_idx = np.unique(np.asarray(workers, dtype=str), return_inverse=True)
+        values = np.asarray(values, dtype=float)
+
+        # Rater slot = how many ratings of the same video/question came before
+        cell = video_idx * len(self.questions) + question_idx
+        order = np.argsort(cell, kind="stable")
+        sorted_cell = cell[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_cell)) + 1] if len(cell) else np.array([], dtype=int)
+        counts = np.diff(np.r_[starts, len(cell)])
+        slot = np.empty(len(cell), dtype=np.int64)
+        slot[order] = np.arange(len(cell)) - np.repeat(starts, counts)
+        num_raters = int(slot.max()) + 1 if len(slot) else 0
+
+        shape = (len(self.videos), len(self.questions), num_raters)
+        self.ratings = np.full(shape, np.nan)
+        self.ratings[video_idx, question_idx, slot] = values
+        self.workers = np.full(shape, -1, dtype=np.int64)
+        self.workers[video_idx, question_idx, slot] = worker_idx
+        self.mask = ~np.isnan(self.ratings)
+
+
+    @classmethod
+    def from_store(cls, store, sandbox=False, question_order=None, exclude=None):
+        """ Load every rating with a known video url from a ResponseStore
+
+        Ratings of rejected assignments are left out, along with those of
+        the assignment ids in exclude (e.g. ones that are about to be rejected).
+        """
+        exclude = exclude or set()
+        rows = store.db.execute(
+            "SELECT a.assignment_id, a.video_url, a.question, a.worker_id, a.rating FROM answers a "
+            "JOIN hits h ON a.hit_id = h.hit_id JOIN assignments s ON a.assignment_id = s.assignment_id "
+            "WHERE h.sandbox = ? AND s.status != 'Rejected' AND a.video_url IS NOT NULL AND a.rating IS NOT NULL",
+            (int(sandbox),)).fetchall()
+        rows = [row[1:] for row in rows if row[0] not in exclude]
+        columns = list(zip(*rows)) if rows else [[], [], [], []]
+        return cls(*columns, question_order=question_order)
+
+
+    @classmethod
+    def from_export(cls, ratings, question_order=None):
+        """ Load every rating from load_ratings (see src.export), leaving out those of rejected assignments """
+        keep = ratings['status'] != list(ratings['statuses']).index("Rejected")
+        return cls(ratings['videos'][ratings['video'][keep]], ratings['questions'][ratings['question'][keep]],
+                   ratings['workers'][ratings['worker'][keep]], ratings['rating'][keep],
+                   question_order=question_order)
+
+
+    def summary(self):
+        """ Per video and question statistics
+
+        Returns:
+            dict: Arrays of shape (video, question) for 'count', 'mean',
+                'median', 'std' (sample standard deviation), 'min' and 'max'.
+                Statistics of cells without ratings are NaN.
+        """
+        count = self.mask.sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            total = np.where(self.mask, self.ratings, 0).sum(axis=2)
+            mean = total / count
+            sq_dev = np.where(self.mask, (self.ratings - mean[..., None]) ** 2, 0).sum(axis=2)
+            std = np.sqrt(sq_dev / (count - 1))
+        std[count < 2] = np.nan
+        # NaNs sort last, so the median is the middle of the first `count` values
+        ordered = np.sort(self.ratings, axis=2)
+        lower = np.take_along_axis(ordered, np.maximum((count - 1) // 2, 0)[..., None], axis=2)[..., 0]
+        upper = np.take_along_axis(ordered, np.maximum(count // 2, 0)[..., None], axis=2)[..., 0]
+        median = np.where(count > 0, (lower + upper) / 2, np.nan)
+        return {
+            'count': count,
+            'mean': mean,
+            'median': median,
+            'std': std,
+            'min': np.where(count > 0, np.where(self.mask, self.ratings, np.inf).min(axis=2), np.nan),
+            'max': np.where(count > 0, np.where(self.mask, self.ratings, -np.inf).max(axis=2), np.nan),
+        }
+
+
+    def save_csv(self, file, extra=None):
+        """ Save the summary statistics of each video and question to a csv file
+
+        Args:
+            file (str): Path of the csv file.
+            extra (dict): Optional more (video, question) arrays to save, by column name.
+        """
+        stats = self.summary()
+        stats.update(extra or {})
+        with open(file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["video_url", "question"] + list(stats))
+            for v, video in enumerate(self.videos):
+                for q, question in enumerate(self.questions):
+                    writer.writerow([video, question] + [stats[name][v, q] for name in stats])
+
+
+    def confidence_half_width(self, confidence=0.95):
+        """ Half width of the t confidence interval of each video and question's mean rating
+
+        Returns:
+            np.ndarray: Array of shape (video, question), inf where there are
+                fewer than 2 ratings.
+        """
+        stats = self.summary()
+        count = stats['count']
+        critical = np.full(count.shape, np.inf)
+        for n in np.unique(count[count >= 2]):
+            critical[count == n] = t_critical(int(n) - 1, confidence)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            half_width = critical * stats['std'] / np.sqrt(count)
+        half_width[count < 2] = np.inf
+        return half_width
+
+
+    def krippendorff_alpha(self, metric="interval", categories=None):
+        """ Krippendorff's alpha of each question
+
+        Args:
+            metric (str): 'interval', 'ordinal' or 'nominal'.
+            categories (list): Possible rating values, defaults to every value
+                that was given.
+
+        Returns:
+            np.ndarray: Alpha of each question, NaN if it can't be computed.
+        """
+        if categories is None:
+            categories = np.unique(self.ratings[self.mask])
+        categories = np.asarray(categories, dtype=float)
+        delta = distance_matrix(categories, metric)
+        return np.array([alpha_from_counts(self.value_counts(q, categories), delta)
+                         for q in range(len(self.questions))])
+
+
+    def dawid_skene(self, question, classes=(1, 2, 3, 4, 5), warm_start=None, **kwargs):
+        """ Fit the Dawid-Skene worker reliability model to one question
+
+        Args:
+            question (int): Index of the question.
+            classes (list): Possible rating values.
+            warm_start (DawidSkeneFit): Previous fit of the same question.
+
+        Returns:
+            DawidSkeneFit: Fit whose posteriors have one row per video.
+        """
+        mask = self.mask[:, question, :]
+        items = np.nonzero(mask)[0]
+        values = self.ratings[:, question, :][mask]
+        labels = np.searchsorted(np.asarray(classes, dtype=float), values)
+        workers = self.workers[:, question, :][mask]
+        fit = dawid_skene(items, workers, labels, classes, worker_ids=self.worker_ids,
+                          warm_start=warm_start, **kwargs)
+        if len(fit.posteriors) < len(self.videos):
+            # Videos after the last rated one have no ratings, use the class priors
+            missing = np.tile(fit.priors, (len(self.videos) - len(fit.posteriors), 1))
+            fit.posteriors = np.vstack([fit.posteriors, missing])
+        return fit
+
+
+    def value_counts(self, question, categories):
+        """ Number of ratings of each category for each video, shape (video, category) """
+        values = self.ratings[:, question, :]
+        return (values[..., None] == categories).sum(axis=1)
+
+
+    def icc(self):
+        """ One-way random effects intraclass correlation of each question
+
+        Each video is rated by a different set of workers, so this is the
+        ICC(1) model, adjusted for videos having different numbers of ratings.
+
+        Returns:
+            tuple: (icc1, icck) arrays with one value per question. icc1 is
+                the reliability of a single rating, icck of the mean rating.
+        """
+        count = self.mask.sum(axis=2).astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            video_mean = np.where(self.mask, self.ratings, 0).sum(axis=2) / count
+            rated = count > 0
+            n_videos = rated.sum(axis=0)
+            n_ratings = count.sum(axis=0)
+            grand_mean = np.where(rated, video_mean * count, 0).sum(axis=0) / n_ratings
+            ss_between = np.where(rated, count * (video_mean - grand_mean) ** 2, 0).sum(axis=0)
+            ss_within = np.where(self.mask, (self.ratings - video_mean[..., None]) ** 2, 0).sum(axis=(0, 2))
+            ms_between = ss_between / (n_videos - 1)
+            ms_within = ss_within / (n_ratings - n_videos)
+            k0 = (n_ratings - (count ** 2).sum(axis=0) / n_ratings) / (n_videos - 1)
+            icc1 = (ms_between - ms_within) / (ms_between + (k0 - 1) * ms_within)
+            icck = (ms_between - ms_within) / ms_between
+        return icc1, icck
+
+
+
+def t_critical(df, confidence=0.95):
+    """ Two sided critical value of Student's t distribution, e.g. 4.303 for 2 degrees of freedom at 95%
+
+    Uses the closed form of the t distribution for whole degrees of freedom
+    (Abramowitz and Stegun 26.7.3-4), so scipy isn't needed.
+    """
+    def central_probability(t):
+        # Probability that |T| < t
+        theta = math.atan(t / math.sqrt(df))
+        sin, cos_sq = math.sin(theta), math.cos(theta) ** 2
+        if df % 2:
+            term = total = math.cos(theta) if df > 1 else 0.0
+            for j in range(1, (df - 1) // 2):
+                term *= cos_sq * 2 * j / (2 * j + 1)
+                total += term
+            return 2 / math.pi * (theta + sin * total)
+        term = total = 1.0
+        for j in range(1, df // 2):
+            term *= cos_sq * (2 * j - 1) / (2 * j)
+            total += term
+        return sin * total
+
+    low, high = 0.0, 1.0
+    while central_probability(high) < confidence:
+        low, high = high, high * 2
+    for _ in range(100):
+        middle = (low + high) / 2
+        if central_probability(middle) < confidence:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def distance_matrix(categories, metric="interval"):
+    """ Squared distance between each pair of categories for Krippendorff's alpha """
+    if metric == "interval":
+        return (categories[:, None] - categories[None, :]) ** 2
+    if metric == "nominal":
+        return (categories[:, None] != categories[None, :]).astype(float)
+    if metric == "ordinal":
+        # Distance depends on how many values fall between the two categories,
+        # which is filled in from the marginal counts in alpha_from_counts
+        return None
+    raise ValueError(f"Unknown metric '{metric}'")
+
+
+def alpha_from_counts(counts, delta):
+    """ Krippendorff's alpha from a (unit x category) matrix of value counts
+
+    Args:
+        counts (np.ndarray): Number of times each unit got each value.
+        delta (np.ndarray): Distance between categories, None for ordinal.
+    """
+    counts = counts[counts.sum(axis=1) >= 2].astype(float)
+    pairable = counts.sum(axis=1)
+    n = pairable.sum()
+    if n <= 1:
+        return np.nan
+
+    # Coincidence matrix of values that were given to the same unit
+    weighted = counts / (pairable - 1)[:, None]
+    coincidence = weighted.T @ counts
+    coincidence[np.diag_indices_from(coincidence)] -= weighted.sum(axis=0)
+    marginals = coincidence.sum(axis=0)
+
+    if delta is None:
+        cumulative = np.cumsum(marginals)
+        between = cumulative[None, :] - cumulative[:, None] + marginals[:, None] / 2 - marginals[None, :] / 2
+        delta = np.triu(between) + np.triu(between).T
+        delta = delta ** 2
+
+    observed = (coincidence * delta).sum()
+    expected = (np.outer(marginals, marginals) * delta).sum() / (n - 1)
+    if expected == 0:
+        return np.nan
+    return 1 - observed / expected
+
+
+
+class DawidSkeneFit:
+    """Result of fitting the Dawid-Skene model to one question's ratings.
+
+    Attributes:
+        classes (np.ndarray): Rating value of each class, e.g. [1, 2, 3, 4, 5].
+        worker_ids (np.ndarray): Worker id of each row of `confusion`.
+        confusion (np.ndarray): (worker, true class, given class) probability
+            that a worker gives a rating when the true class is known.
+        priors (np.ndarray): Probability of each true class.
+        posteriors (np.ndarray): (item, class) probability of each true class.
+        log_likelihood (float): Log likelihood of the ratings at the end of the fit.
+        iterations (int): Number of EM iterations run.
+    """
+    def __init__(self, classes, worker_ids, confusion, priors, posteriors, log_likelihood, iterations):
+        self.classes = classes
+        self.worker_ids = worker_ids
+        self.confusion = confusion
+        self.priors = priors
+        self.posteriors = posteriors
+        self.log_likelihood = log_likelihood
+        self.iterations = iterations
+
+
+    def scores(self):
+        """ Posterior mean rating of each item """
+        return self.posteriors @ self.classes
+
+
+    def worker_bias(self):
+        """ Average amount each worker rates above (+) or below (-) the true class """
+        given_mean = self.confusion @ self.classes
+        return (given_mean - self.classes) @ self.priors
+
+
+    def worker_accuracy(self):
+        """ Probability each worker gives the true class """
+        return np.einsum("jkk,k->j", self.confusion, self.priors)
+
+
+    def save(self, file):
+        """ Save the fit to an .npz file, e.g. to warm start the next fit """
+        np.savez(file, classes=self.classes, worker_ids=self.worker_ids,
+                 confusion=self.confusion, priors=self.priors, posteriors=self.posteriors,
+                 log_likelihood=self.log_likelihood, iterations=self.iterations)
+
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file, allow_pickle=False) as data:
+            return cls(data['classes'], data['worker_ids'], data['confusion'], data['priors'],
+                       data['posteriors'], float(data['log_likelihood']), int(data['iterations']))
+
+
+
+def dawid_skene(items, workers, labels, classes, worker_ids=None, warm_start=None,
+                max_iterations=100, tolerance=1e-6, smoothing=0.5):
+    """ Estimate worker confusion matrices and true classes with EM (Dawid-Skene)
+
+    All updates are done with bincount over the list of ratings, so each
+    iteration is linear in the number of ratings and never builds an
+    (item x worker) matrix.
+
+    Args:
+        items (np.ndarray): Item index of each rating.
+        workers (np.ndarray): Worker index of each rating.
+        labels (np.ndarray): Class index (0 based) of each rating.
+        classes (list): Rating value of each class.
+        worker_ids (np.ndarray): Worker id of each worker index, used to match
+            workers to the warm start fit.
+        warm_start (DawidSkeneFit): Previous fit, its confusion matrices and
+            priors are used as the starting point for workers it knows about.
+        max_iterations (int): Max number of EM iterations.
+        tolerance (float): Stop when the log likelihood per rating improves
+            by less than this.
+        smoothing (float): Strength of the prior on the confusion matrices,
+            which favors ratings close to the true class (ordinal scales).
+
+    Returns:
+        DawidSkeneFit: The fitted model.
+    """
+    items = np.asarray(items, dtype=np.int64)
+    workers = np.asarray(workers, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    classes = np.asarray(classes, dtype=float)
+    num_items = int(items.max()) + 1 if len(items) else 0
+    if worker_ids is None:
+        worker_ids = np.arange(int(workers.max()) + 1 if len(workers) else 0).astype(str)
+    num_workers = len(worker_ids)
+    num_classes = len(classes)
+
+    # Dirichlet prior on each row of a confusion matrix, decaying away from the diagonal
+    distance = np.abs(np.arange(num_classes)[:, None] - np.arange(num_classes)[None, :])
+    prior_counts = smoothing * 2.0 ** -distance
+    worker_label = workers * num_classes + labels
+
+    def m_step(posteriors):
+        counts = np.empty((num_workers, num_classes, num_classes))
+        for k in range(num_classes):
+            counts[:, k, :] = np.bincount(worker_label, weights=posteriors[items, k],
+                minlength=num_workers * num_classes).reshape(num_workers, num_classes)
+        counts += prior_counts
+        confusion = counts / counts.sum(axis=2, keepdims=True)
+        priors = posteriors.sum(axis=0) + 1.0
+        return confusion, priors / priors.sum()
+
+    def e_step(confusion, priors):
+        log_confusion = np.log(confusion)
+        log_post = np.tile(np.log(priors), (num_items, 1))
+        for k in range(num_classes):
+            log_post[:, k] += np.bincount(items, weights=log_confusion[workers, k, labels],
+                                          minlength=num_items)
+        top = log_post.max(axis=1, keepdims=True)
+        normalizer = top[:, 0] + np.log(np.exp(log_post - top).sum(axis=1))
+        return np.exp(log_post - normalizer[:, None]), normalizer.sum()
+
+    if warm_start is not None:
+        # Start from the previous confusion matrices, new workers start from the prior
+        confusion = np.tile(prior_counts / prior_counts.sum(axis=1, keepdims=True), (num_workers, 1, 1))
+        previous = {w: i for i, w in enumerate(warm_start.worker_ids)}
+        known = np.array([previous.get(w, -1) for w in worker_ids], dtype=np.int64)
+        confusion[known >= 0] = warm_start.confusion[known[known >= 0]]
+        priors = warm_start.priors
+    else:
+        # Start from a majority vote
+        votes = np.zeros((num_items, num_classes))
+        np.add.at(votes, (items, labels), 1)
+        votes += 1e-3
+        confusion, priors = m_step(votes / votes.sum(axis=1, keepdims=True))
+
+    log_likelihood = -np.inf
+    for iteration in range(1, max_iterations + 1):
+        posteriors, new_log_likelihood = e_step(confusion, priors)
+        confusion, priors = m_step(posteriors)
+        converged = (new_log_likelihood - log_likelihood) < tolerance * max(len(items), 1)
+        log_likelihood = new_log_likelihood
+        if converged:
+            break
+    posteriors, log_likelihood = e_step(confusion, priors)
+
+    return DawidSkeneFit(classes, np.asarray(worker_ids), confusion, priors, posteriors,
+                         log_likelihood, iteration)
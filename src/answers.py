@@ -0,0 +1,137 @@
+import re
+import html
+import json
+import time
+import collections
+from collections import namedtuple
+
+# Rating fields of the survey in the answer JSON, e.g. "video0_depth_perception":"3"
+RATING_FIELD = re.compile(r'"video(\d+)_([^"]+)"\s*:\s*"?(\d+)')
+
+# The same fields in answer xml that escapes the JSON's quotes, as MTurk usually does
+ESCAPED_RATING_FIELD = re.compile(r'&quot;video(\d+)_([^&"]+)&quot;\s*:\s*(?:&quot;)?(\d+)')
+
+Rating = namedtuple("Rating", ["position", "question", "rating"])
+
+
+def free_texts(answer_xml):
+    """ Unescaped answer text of every <Answer> element in the xml """
+    texts = []
+    end = 0
+    while True:
+        start = answer_xml.find("<FreeText>", end)
+        if start == -1:
+            break
+        end = answer_xml.find("</FreeText>", start)
+        text = answer_xml[start + 10:end]
+        if text.startswith("<![CDATA["):
+            text = text[9:-3]
+        elif "&" in text:
+            text = html.unescape(text)
+        texts.append(text)
+    return texts
+
+
+def rating_fields(answer_xml):
+    """ (position, question, rating) strings of every rating field in the answer xml, read as is """
+    if "&quot;" not in answer_xml:
+        return RATING_FIELD.findall(answer_xml)
+    fields = ESCAPED_RATING_FIELD.findall(answer_xml)
+    if "<![CDATA[" in answer_xml:
+        fields += RATING_FIELD.findall(answer_xml)
+    return fields
+
+
+def decode_answer(answer_xml):
+    """ Decode the crowd-form answers of an assignment
+
+    Pulls the JSON payload of every <Answer> element straight out of the
+    QuestionFormAnswers xml instead of building the whole document, and
+    works with any number of <Answer> elements.
+
+    Returns:
+        list: The answer dicts submitted by the crowd-form (usually one).
+    """
+    answers = []
+    for text in free_texts(answer_xml):
+        if not text.strip():
+            continue
+        decoded = json.loads(text)
+        answers.extend(decoded if isinstance(decoded, list) else [decoded])
+    return answers
+
+
+def decode_ratings(answer_xml):
+    """ Decode the video ratings of an assignment
+
+    The video{i}_{question} radio fields of survey_template.html are
+    matched in the answer xml as is, without unescaping or decoding the
+    rest of the JSON.
+
+    Returns:
+        list: Rating(position, question, rating) for each rating field,
+            e.g. Rating(0, 'depth_perception', 3).
+    """
+    return [Rating(int(position), question, int(rating))
+            for position, question, rating in rating_fields(answer_xml)]
+
+
+def decode_assignments(assignments):
+    """ Decode the ratings of many assignments
+
+    Yields:
+        tuple: (assignment_id, hit_id, worker_id, position, question, rating)
+            for every rating, one assignment at a time.
+    """
+    for a in assignments:
+        assignment_id, hit_id, worker_id = a['AssignmentId'], a.get('HITId'), a['WorkerId']
+        for position, question, rating in rating_fields(a['Answer']):
+            yield (assignment_id, hit_id, worker_id, int(position), question, int(rating))
+
+
+def benchmark(num_assignments=20000, num_videos=5):
+    """ Time decoding ratings against parsing with xmltodict (best of 5 runs), prints the results """
+    import xmltodict
+    questions = ["depth_perception", "bimanual_dexterity", "efficiency",
+                 "force_sensitivity", "robotic_control"]
+    payload = json.dumps([{f"video{v}_{q}": str((v + len(q)) % 5 + 1)
+                           for v in range(num_videos) for q in questions}])
+    answer_xml = ('<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers xmlns='
+        '"http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">'
+        f'<Answer><QuestionIdentifier>taskAnswers</QuestionIdentifier><FreeText>{payload.replace(chr(34), "&quot;")}'
+        '</FreeText></Answer></QuestionFormAnswers>')
+    assignments = [{'AssignmentId': str(i), 'WorkerId': 'w', 'Answer': answer_xml}
+                   for i in range(num_assignments)]
+
+    def best_time(func, repeat=5):
+        """ Fastest of several runs, since single runs are noisy """
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def decode_each():
+        for a in assignments:
+            decode_ratings(a['Answer'])
+
+    def parse_xmltodict():
+        for a in assignments:
+            answers = json.loads(xmltodict.parse(a['Answer'])['QuestionFormAnswers']['Answer']['FreeText'])
+            [(field, int(value)) for field, value in answers[0].items() if field.startswith("video")]
+
+    xmltodict_time = best_time(parse_xmltodict)
+    decode_time = best_time(decode_each)
+    bulk_time = best_time(lambda: collections.deque(decode_assignments(assignments), maxlen=0))
+
+    print(f"{num_assignments} assignments of {num_videos} videos:")
+    assert sorted(decode_ratings(answer_xml)) == sorted(
+        Rating(v, q, (v + len(q)) % 5 + 1) for v in range(num_videos) for q in questions)
+    print(f"  xmltodict + json:   {xmltodict_time:.3f}s")
+    print(f"  decode_ratings:     {decode_time:.3f}s ({xmltodict_time / decode_time:.1f}x faster)")
+    print(f"  decode_assignments: {bulk_time:.3f}s ({xmltodict_time / bulk_time:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,193 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import tempfile
+import contextlib
+import click
+from src.fakes import FakeMTurkClient, FakeYouTubeClient
+from src.mturk import MTurkAccount
+from src.youtube import YouTubeAccount
+from src.survey import HTMLSurvey
+
+# Number of HITs, videos or survey rows each benchmark is run with by default
+SCALES = [10, 1000, 100000]
+
+# Videos in each playlist of the fake YouTube account
+PLAYLIST_SIZE = 100
+
+HIT_CONFIG = {
+    "TITLE": "Rate surgical videos",
+    "DESCRIPTION": "Watch short videos and rate the surgeon's skill",
+    "KEYWORDS": "video, rating",
+    "REWARD": 0.5,
+    "MAX_ASSIGNMENTS": 3,
+    "LIFETIME_SECONDS": 604800,
+    "ASSIGNMENT_DURATION_SECONDS": 3600,
+    "AUTO_APPROVAL_SECONDS": 259200,
+    "REQUESTS_PER_SECOND": 1e9,
+}
+
+
+def bench_get_hits(scale, backend):
+    """ List every HIT of an account with scale HITs """
+    client = FakeMTurkClient(num_hits=scale, **backend)
+    account = MTurkAccount(None, None, sandbox_client=client, live_client=client)
+    client.reset_calls()
+    start = time.perf_counter()
+    hits = account.get_hits(sandbox=True)
+    elapsed = time.perf_counter() - start
+    assert len(hits) == scale
+    return elapsed, client.calls
+
+
+def bench_get_playlists_info(scale, backend):
+    """ Fetch the videos of every playlist of an account with scale videos """
+    client = FakeYouTubeClient(num_playlists=max(1, scale // PLAYLIST_SIZE),
+                               videos_per_playlist=min(scale, PLAYLIST_SIZE), **backend)
+    account = YouTubeAccount(None, None, client=client)
+    start = time.perf_counter()
+    playlists = account.get_playlists_info()
+    elapsed = time.perf_counter() - start
+    assert sum(len(p['videos']) for p in playlists) == max(1, scale // PLAYLIST_SIZE) * min(scale, PLAYLIST_SIZE)
+    return elapsed, client.calls
+
+
+def bench_create_hits(scale, backend):
+    """ Create a HIT for each row of a survey csv with scale rows """
+    client = FakeMTurkClient(**backend)
+    account = MTurkAccount(None, None, sandbox_client=client, live_client=client)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        html_file = os.path.join(tmp_dir, "survey.html")
+        csv_file = os.path.join(tmp_dir, "survey.csv")
+        with open(html_file, "w") as f:
+            f.write("".join(f'<iframe src="${{video_url_{i}}}"></iframe>' for i in range(5)))
+        with open(csv_file, "w") as f:
+            f.write(",".join(f"video_url_{i}" for i in range(5)) + "\n")
+            for row in range(scale):
+                f.write(",".join(f"https://www.youtube.com/embed/{row}_{i}" for i in range(5)) + "\n")
+        start = time.perf_counter()
+        created = account.create_hits_from_csv(HIT_CONFIG, html_file, csv_file,
+                                               os.path.join(tmp_dir, "hits.jsonl"), sandbox=True)
+        elapsed = time.perf_counter() - start
+    assert created == scale
+    return elapsed, client.calls
+
+
+def bench_html_survey(scale, backend):
+    """ Generate and save the survey html and csv for a playlist of scale videos """
+    playlist = {'title': "Survey", 'videos': [
+        {'url': f"https://www.youtube.com/embed/{i}"} for i in range(max(scale, 5))]}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        survey = HTMLSurvey(playlist, 5, 3, seed=0)
+        survey.save_survey(os.path.join(tmp_dir, "survey.html"),
+                           os.path.join(tmp_dir, "sample_survey.html"),
+                           os.path.join(tmp_dir, "survey.csv"))
+        elapsed = time.perf_counter() - start
+    return elapsed, {}
+
+
+BENCHMARKS = {
+    'get_hits': bench_get_hits,
+    'get_playlists_info': bench_get_playlists_info,
+    'create_hits': bench_create_hits,
+    'html_survey': bench_html_survey,
+}
+
+
+def run_benchmarks(names, scales, latency=0.0, throttle_rate=0.0):
+    """ Run benchmarks against the fake backends
+
+    Returns:
+        dict: {name: {scale: {'seconds': wall time, 'calls': {operation: count}}}}
+    """
+    backend = {'latency': latency, 'throttle_rate': throttle_rate}
+    results = {}
+    for name in names:
+        results[name] = {}
+        for scale in scales:
+            # Keep the progress messages of the code being timed out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed, calls = BENCHMARKS[name](scale, backend)
+            results[name][str(scale)] = {'seconds': round(elapsed, 4), 'calls': dict(sorted(calls.items()))}
+            print(f"  {name:<20} {scale:>7}  {elapsed:>8.3f}s  {sum(calls.values()):>7} calls")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Regressions of the results against a baseline
+
+    A benchmark regresses if it takes more than tolerance times as long
+    as the baseline, or makes more API calls.
+
+    Returns:
+        list: Description of each regression.
+    """
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            base = baseline.get(name, {}).get(scale)
+            if base is None:
+                continue
+            calls, base_calls = sum(result['calls'].values()), sum(base['calls'].values())
+            if calls > base_calls:
+                regressions.append(f"{name} at {scale}: {calls} API calls, was {base_calls}")
+            if result['seconds'] > tolerance * max(base['seconds'], 1e-3):
+                regressions.append(f"{name} at {scale}: {result['seconds']:.3f}s, "
+                                   f"was {base['seconds']:.3f}s")
+    return regressions
+
+
+@click.command()
+@click.option("--scales", default=",".join(map(str, SCALES)), show_default=True,
+              help="Comma separated sizes to run each benchmark at.")
+@click.option("--only", "names", multiple=True, type=click.Choice(list(BENCHMARKS)),
+              help="Only run this benchmark (can be repeated).")
+@click.option("--latency", default=0.0, show_default=True, help="Seconds each fake API call takes.")
+@click.option("--throttle-rate", default=0.0, show_default=True,
+              help="Fraction of fake API calls that are throttled.")
+@click.option("--baseline", default="benchmark_baseline.json", show_default=True,
+              help="JSON file of baseline results to compare against.")
+@click.option("--save", is_flag=True, help="Save the results as the new baseline.")
+@click.option("--tolerance", default=1.5, show_default=True,
+              help="Slowdown over the baseline that counts as a regression.")
+def main(scales, names, latency, throttle_rate, baseline, save, tolerance):
+    """ Time the MTurk, YouTube and survey code against in-process fake backends """
+    scales = [int(scale) for scale in scales.split(",")]
+    print(f"Running benchmarks (latency {latency}s, throttle rate {throttle_rate})")
+    results = run_benchmarks(names or list(BENCHMARKS), scales, latency, throttle_rate)
+
+    regressions = []
+    saved = {}
+    if os.path.isfile(baseline):
+        with open(baseline, "r") as f:
+            saved = json.load(f)['results']
+        regressions = compare(results, saved, tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if not regressions:
+            print(f"No regressions against {baseline}")
+    if save or not saved:
+        # Keep the baseline of benchmarks and scales that weren't run this time
+        for name, scales in results.items():
+            saved.setdefault(name, {}).update(scales)
+        results = saved
+        with open(baseline, "w") as f:
+            json.dump({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'latency': latency,
+                'throttle_rate': throttle_rate,
+                'results': results,
+            }, f, indent=2)
+        print(f"Saved baseline to {baseline}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ from termcolor import colored
 
 config_defaults = {
     "YOUTUBE.OAUTH_CLIENT_SECRETS_FILE": {"default": None, "default_ok": False},
+    "YOUTUBE.TOKEN_CACHE": {"default": ".youtube_token.json", "default_ok": True},
+    "YOUTUBE.DAILY_QUOTA": {"default": 10000, "default_ok": True},
     "AWS.ACCESS_KEY_ID": {"default": None, "default_ok": False},
     "AWS.SECRET_ACCESS_KEY": {"default": None, "default_ok": False},
     "MTURK.TITLE": {"default": None, "default_ok": False},
@@ -14,24 +16,90 @@ config_defaults = {
     "MTURK.LIFETIME_SECONDS": {"default": 604800, "default_ok": True},
     "MTURK.ASSIGNMENT_DURATION_SECONDS": {"default": 3600, "default_ok": True},
     "MTURK.AUTO_APPROVAL_SECONDS": {"default": 259200, "default_ok": True},
+    "MTURK.REQUESTS_PER_SECOND": {"default": 5, "default_ok": True},
+    "MTURK.QUALIFICATION_NAME": {"default": "Surgical video rating qualification", "default_ok": True},
+    "MTURK.QUALIFICATION_ANSWERS": {"default": None, "default_ok": True},
+    "MTURK.QUALIFICATION_TOLERANCE": {"default": 1, "default_ok": True},
+    "MTURK.QUALIFICATION_PASS_SCORE": {"default": 0.8, "default_ok": True},
+    "MTURK.REQUIRE_QUALIFICATION": {"default": True, "default_ok": True},
+    "MTURK.REJECT_FAILED_QUALIFICATIONS": {"default": False, "default_ok": True},
+    "MTURK.MIN_WORK_SECONDS": {"default": 0, "default_ok": True},
+    "MTURK.REJECT_STRAIGHTLINING": {"default": False, "default_ok": True},
+    "MTURK.BONUS": {"default": 0.0, "default_ok": True},
+    "MTURK.BONUS_REASON": {"default": "Thank you for your careful ratings!", "default_ok": True},
     "SURVEY.SURVEY_VIDEOS": {"default": 5, "default_ok": True},
     "SURVEY.SURVEY_PLAYLIST": {"default": None, "default_ok": False},
+    "SURVEY.RATINGS_PER_VIDEO": {"default": 3, "default_ok": True},
+    "SURVEY.SEED": {"default": None, "default_ok": True},
+    "SURVEY.CSV_SHARD_ROWS": {"default": None, "default_ok": True},
     "SURVEY.QUALIFICATION_VIDEOS": {"default": 5, "default_ok": True},
     "SURVEY.QUALIFICATION_PLAYLIST": {"default": None, "default_ok": False},
+    "SURVEY.TEMPLATE": {"default": "lite", "default_ok": True},
+    "METRICS.PROFILE_COMMANDS": {"default": False, "default_ok": True},
+    "METRICS.EXPORT": {"default": "surveys/api_metrics.json", "default_ok": True},
+    "WATCH.MIN_INTERVAL_SECONDS": {"default": 15, "default_ok": True},
+    "WATCH.MAX_INTERVAL_SECONDS": {"default": 600, "default_ok": True},
+    "ALLOCATION.WHILE_WATCHING": {"default": False, "default_ok": True},
+    "ALLOCATION.CONFIDENCE": {"default": 0.95, "default_ok": True},
+    "ALLOCATION.MAX_INTERVAL_WIDTH": {"default": 1.0, "default_ok": True},
+    "ALLOCATION.MIN_RATINGS": {"default": 3, "default_ok": True},
+    "ALLOCATION.MAX_TOTAL_ASSIGNMENTS": {"default": 9, "default_ok": True},
+    "ALLOCATION.ASSIGNMENTS_PER_ROUND": {"default": 1, "default_ok": True},
 }
 
+def section_defaults(section):
+    """ Default value of each option of a config section """
+    return {name.split(".", 1)[1]: option["default"] for name, option in config_defaults.items()
+            if name.split(".", 1)[0] == section}
+
+
+class ConfigSnapshot:
+    """ A parsed copy of config.yml along with the file stamp it was read at
+
+    Attributes:
+        data (dict): Parsed contents of config.yml.
+        stamp (tuple): (mtime_ns, size) of the file when it was parsed.
+    """
+    def __init__(self, data, stamp):
+        self.data = data if data is not None else {}
+        self.stamp = stamp
+        self.completeness = {}
+
+
 class Config(dict):
-    def __init__(self):
-        pass
+    def __init__(self, path="config.yml"):
+        self.path = path
+        self.snapshot = None
 
 
     def load_config(self):
-        return yaml.safe_load(open("config.yml", "r"))
+        """ Return the parsed config, re-reading config.yml only if it changed """
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if self.snapshot is None or self.snapshot.stamp != stamp:
+            with open(self.path, "r") as f:
+                self.snapshot = ConfigSnapshot(yaml.safe_load(f), stamp)
+        return self.snapshot.data
 
 
     def __getitem__(self, key):
+        """ A section of the config, with the defaults of any options missing from config.yml
+
+        Options added after a config.yml was written fall back to
+        config_defaults, so older config files keep working.
+        """
         config = self.load_config()
-        return config[key]
+        defaults = section_defaults(key)
+        if key not in config and not defaults:
+            raise KeyError(key)
+        return {**defaults, **(config.get(key) or {})}
+
+
+    def sections(self):
+        """ Every section of the config with its defaults filled in, config.yml's sections first """
+        config = self.load_config()
+        names = list(config) + [name.split(".", 1)[0] for name in config_defaults]
+        return {section: self[section] for section in dict.fromkeys(names)}
 
 
     def __str__(self):
@@ -39,11 +107,10 @@ class Config(dict):
         This will display whether the info in config.yml has been filled out
         """
         config_string = ""
-        config = self.load_config()
         def status(section, option, value):
             # Check that files have a valid path
-            if "FILE" in option:
-                if not os.path.isfile(value):
+            if option.endswith("_FILE"):
+                if not value or not os.path.isfile(value):
                     return f"[{colored('NOT A VALID PATH', 'red')}]"
 
             if value == config_defaults[f"{section}.{option}"]["default"]:
@@ -54,7 +121,7 @@ class Config(dict):
             else:
                 return f"({colored('complete', 'green')}) - {value}"
 
-        for section, options_dict in config.items():
+        for section, options_dict in self.sections().items():
             config_string += f"{section}:\n"
             for option, value in options_dict.items():
                 config_string += f"  {option}: {status(section, option, value)}\n"
@@ -66,12 +133,18 @@ class Config(dict):
 
 
     def config_complete(self, section_to_check="all"):
-        """ Returns whether the config.yml file is filled out or not """
-        config = self.load_config()
+        """ Returns whether the config.yml file is filled out or not
+
+        Results are memoized on the current snapshot, so they are only
+        recomputed after config.yml changes.
+        """
+        self.load_config()
+        if section_to_check in self.snapshot.completeness:
+            return self.snapshot.completeness[section_to_check]
         sections_complete = {}
 
         # Check each section
-        for section, options_dict in config.items():
+        for section, options_dict in self.sections().items():
             section_options = []
 
             # Check all options in the section
@@ -88,8 +161,10 @@ class Config(dict):
 
         # Return whether all options are ok unless specificed
         if section_to_check == "all":
-            return all(list(sections_complete.values()))
+            complete = all(list(sections_complete.values()))
         else:
-            return sections_complete[section_to_check]
+            complete = sections_complete[section_to_check]
+        self.snapshot.completeness[section_to_check] = complete
+        return complete
 
 
@@ -0,0 +1,138 @@
+import math
+import random
+
+
+def design_size(total_videos, num_videos, ratings_per_video):
+    """ Number of surveys (csv rows) needed so each video is in ratings_per_video surveys """
+    return math.ceil(total_videos * ratings_per_video / num_videos)
+
+
+def estimate_cost(num_surveys, max_assignments, reward):
+    """ Estimated cost in dollars of posting every survey as a HIT
+
+    Includes the MTurk commission of 20%, plus another 20% for HITs with 10
+    or more assignments.
+    """
+    commission = 0.4 if max_assignments >= 10 else 0.2
+    return num_surveys * max_assignments * reward * (1 + commission)
+
+
+# Max number of videos designed together, bounds the memory of the pair and position counts
+GROUP_SIZE = 1000
+
+
+def create_design(videos, num_videos, ratings_per_video, seed=None, candidates=50, group_size=GROUP_SIZE):
+    """Create a balanced, randomized assignment of videos to surveys.
+
+    Playlists longer than group_size are split into consecutive groups of
+    about the same size, each designed on its own (see design_group), so
+    the counts kept while designing take the same memory for any number of
+    surveys. Videos are only paired with videos of their own group.
+
+    Args:
+        videos (list): Items to put in surveys (e.g. video urls).
+        num_videos (int): Number of videos per survey.
+        ratings_per_video (int): Number of surveys each video should be in.
+        seed (int): Seed for the random number generator, for a repeatable design.
+        candidates (int): Max number of videos compared when picking each
+            video, bounds the run time for large playlists.
+        group_size (int): Max number of videos designed together.
+
+    Yields:
+        tuple: The videos of one survey in order, one survey at a time.
+    """
+    if num_videos > len(videos):
+        raise ValueError(f"Can't put {num_videos} videos in a survey with only "
+            f"{len(videos)} videos")
+    rng = random.Random(seed)
+    # Groups are at least half of group_size, so each has enough videos for a survey
+    groups = math.ceil(len(videos) / max(group_size, 2 * num_videos))
+    for g in range(groups):
+        group = videos[g * len(videos) // groups:(g + 1) * len(videos) // groups]
+        yield from design_group(group, num_videos, ratings_per_video, rng, candidates)
+
+
+def design_group(videos, num_videos, ratings_per_video, rng, candidates=50):
+    """Create a balanced, randomized assignment of a group of videos to surveys.
+
+    Instead of every combination of videos, each video is put in
+    ratings_per_video different surveys, so the number of surveys grows
+    linearly with the number of videos. The design is built one round at a
+    time (each round uses every video once) and greedily balanced:
+
+    - Videos are added to a survey preferring those that have appeared
+      together with the survey's current videos the least, so pairs of
+      videos co-occur as evenly as possible.
+    - Videos in a survey are ordered so each video is shown in each
+      position as evenly as possible.
+
+    If the videos don't divide evenly into surveys, the last survey is
+    filled with the least used videos.
+
+    Args:
+        videos (list): Items to put in surveys (e.g. video urls).
+        num_videos (int): Number of videos per survey.
+        ratings_per_video (int): Number of surveys each video should be in.
+        rng (random.Random): Random number generator of the design.
+        candidates (int): Max number of videos compared when picking each
+            video, bounds the run time for large playlists.
+
+    Yields:
+        tuple: The videos of one survey in order, one survey at a time.
+    """
+    total = len(videos)
+    pair_counts = {}
+    position_counts = [[0] * num_videos for _ in range(total)]
+    appearances = [0] * total
+
+    def pair_cost(video, block):
+        return sum(pair_counts.get((min(video, b), max(video, b)), 0) for b in block)
+
+    def add_block(block):
+        for i, a in enumerate(block):
+            appearances[a] += 1
+            for b in block[i + 1:]:
+                key = (min(a, b), max(a, b))
+                pair_counts[key] = pair_counts.get(key, 0) + 1
+        return order_block(block)
+
+    def order_block(block):
+        """ Assign each position to the remaining video that has been there least """
+        remaining = list(block)
+        ordered = []
+        for position in range(num_videos):
+            best = min(remaining, key=lambda v: (position_counts[v][position], rng.random()))
+            remaining.remove(best)
+            position_counts[best][position] += 1
+            ordered.append(best)
+        return ordered
+
+    pool = []
+    for _ in range(ratings_per_video):
+        round_videos = list(range(total))
+        rng.shuffle(round_videos)
+        pool.extend(round_videos)
+        while len(pool) >= num_videos:
+            block = [pool.pop()]
+            while len(block) < num_videos:
+                # Only videos that aren't already in the block are eligible
+                eligible = [i for i in range(min(len(pool), candidates)) if pool[-1 - i] not in block]
+                if not eligible:
+                    break
+                best = min(eligible, key=lambda i: pair_cost(pool[-1 - i], block))
+                block.append(pool.pop(-1 - best))
+            if len(block) < num_videos:
+                # Rest of the pool are repeats of videos in the block, save for later
+                pool = block + pool
+                break
+            yield tuple(videos[v] for v in add_block(block))
+
+    # Fill the last surveys with the least used videos
+    while pool:
+        block = list(dict.fromkeys(pool))[:num_videos]
+        for v in block:
+            pool.remove(v)
+        others = sorted((v for v in range(total) if v not in block),
+                        key=lambda v: (appearances[v], rng.random()))
+        block += others[:num_videos - len(block)]
+        yield tuple(videos[v] for v in add_block(block))
@@ -0,0 +1,284 @@
+import io
+import os
+import json
+import datetime
+from pathlib import Path
+import numpy as np
+
+# Column of each rating and its dtype, one .npy file each
+COLUMNS = {
+    'video': np.int32,          # Index into videos
+    'worker': np.int32,         # Index into workers
+    'assignment': np.int32,     # Index into assignments
+    'question': np.int16,       # Index into questions
+    'rating': np.int8,
+    'submit_time': 'datetime64[s]',  # UTC, NaT if unknown
+}
+
+# String dictionaries, one text file each with a string per line
+DICTIONARIES = {'video': "videos", 'worker': "workers", 'assignment': "assignments", 'question': "questions"}
+
+# Max number of skipped ratings looked up in the store at a time
+SKIPPED_BATCH = 500
+
+META_FILE = "export.json"
+
+# Review status of each exported assignment, as an index into STATUSES
+STATUS_FILE = "assignment_status.npy"
+STATUSES = ["Unknown", "Submitted", "Approved", "Rejected"]
+
+
+class RatingExport:
+    """Ratings of a ResponseStore as memory-mappable columns.
+
+    Each column is a .npy file with one value per rating, and strings (video
+    urls, worker ids, assignment ids and question names) are stored once in
+    dictionary files that the columns index into. Exports only append the
+    ratings stored since the last export, and export.json records how much
+    of each file is complete, so an interrupted export is redone on the
+    next one. Ratings whose video url isn't known yet (their HIT is missing
+    from the HIT journal) are skipped and their rowids kept in export.json,
+    so they're appended once ResponseStore.add_hit_videos fills the url in.
+    The review status of each assignment is rewritten on every export,
+    since assignments are approved or rejected after their ratings are
+    exported. Load an export with load_ratings.
+
+    Args:
+        directory (str): Folder of the export, created if it doesn't exist.
+    """
+    def __init__(self, directory):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        meta_file = os.path.join(directory, META_FILE)
+        if os.path.isfile(meta_file):
+            with open(meta_file, "r") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'rows': 0, 'last_answer': 0,
+                         'dictionaries': {name: {'count': 0, 'bytes': 0} for name in DICTIONARIES.values()}}
+        self.meta.setdefault('skipped', [])
+        self.indexes = {name: {value: i for i, value in enumerate(self.read_dictionary(name))}
+                        for name in DICTIONARIES.values()}
+
+
+    def append(self, store, sandbox=False, batch_size=100000):
+        """ Append the ratings stored since the last export, and skipped ones whose video is now known
+
+        Args:
+            store (ResponseStore): Store to export from.
+            sandbox (bool): Export the ratings of sandbox HITs instead of live ones.
+            batch_size (int): Number of ratings read from the store at a time.
+
+        Returns:
+            int: Number of ratings appended.
+        """
+        query = ("SELECT a.rowid, a.video_url, a.worker_id, a.assignment_id, a.question, a.rating, s.submit_time "
+                 "FROM answers a JOIN hits h ON a.hit_id = h.hit_id "
+                 "JOIN assignments s ON a.assignment_id = s.assignment_id "
+                 "WHERE h.sandbox = ? AND a.rating IS NOT NULL ")
+        appended = 0
+        skipped = list(self.meta['skipped'])
+        for start in range(0, len(skipped), SKIPPED_BATCH):
+            batch = skipped[start:start + SKIPPED_BATCH]
+            rows = store.db.execute(
+                query + f"AND a.video_url IS NOT NULL AND a.rowid IN ({', '.join('?' * len(batch))}) "
+                "ORDER BY a.rowid", (int(sandbox), *batch)).fetchall()
+            if rows:
+                found = set(row[0] for row in rows)
+                self.meta['skipped'] = [rowid for rowid in self.meta['skipped'] if rowid not in found]
+                self.append_rows(rows)
+                appended += len(rows)
+
+        cursor = store.db.execute(query + "AND a.rowid > ? ORDER BY a.rowid", (int(sandbox), self.meta['last_answer']))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            last_answer = rows[-1][0]
+            self.meta['skipped'] += [row[0] for row in rows if row[1] is None]
+            rows = [row for row in rows if row[1] is not None]
+            self.append_rows(rows, last_answer)
+            appended += len(rows)
+        self.write_statuses(store)
+        return appended
+
+
+    def append_rows(self, rows, last_answer=None):
+        """ Append (rowid, video_url, worker_id, assignment_id, question, rating, submit_time) rows
+
+        Args:
+            rows (list): Ratings to append.
+            last_answer (int): Rowid of the last answer read from the store,
+                recorded as where the next export starts.
+        """
+        new_strings = {name: [] for name in DICTIONARIES.values()}
+
+        def index(name, value):
+            if value is None:
+                return -1
+            lookup = self.indexes[name]
+            if value not in lookup:
+                lookup[value] = len(lookup)
+                new_strings[name].append(value)
+            return lookup[value]
+
+        submit_times = {}
+        columns = {name: [] for name in COLUMNS}
+        for _, video_url, worker_id, assignment_id, question, rating, submit_time in rows:
+            columns['video'].append(index("videos", video_url))
+            columns['worker'].append(index("workers", worker_id))
+            columns['assignment'].append(index("assignments", assignment_id))
+            columns['question'].append(index("questions", question))
+            columns['rating'].append(rating)
+            if submit_time not in submit_times:
+                submit_times[submit_time] = utc_seconds(submit_time)
+            columns['submit_time'].append(submit_times[submit_time])
+
+        # Write the data first, then record it as complete in export.json
+        for name, values in new_strings.items():
+            info = self.meta['dictionaries'][name]
+            info['bytes'] = write_lines(os.path.join(self.directory, f"{name}.txt"), values, info['bytes'])
+            info['count'] += len(values)
+        for name, dtype in COLUMNS.items():
+            write_npy_rows(os.path.join(self.directory, f"{name}.npy"),
+                           np.asarray(columns[name], dtype=dtype), self.meta['rows'])
+        self.meta['rows'] += len(rows)
+        if last_answer is not None:
+            self.meta['last_answer'] = last_answer
+        self.meta['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+        self.save_meta()
+
+
+    def write_statuses(self, store):
+        """ Rewrite the current review status of every exported assignment """
+        lookup = self.indexes['assignments']
+        codes = {status: i for i, status in enumerate(STATUSES)}
+        statuses = np.zeros(self.meta['dictionaries']['assignments']['count'], dtype=np.int8)
+        for assignment_id, status in store.db.execute("SELECT assignment_id, status FROM assignments"):
+            i = lookup.get(assignment_id)
+            if i is not None and i < len(statuses):
+                statuses[i] = codes.get(status, 0)
+        path = os.path.join(self.directory, STATUS_FILE)
+        np.save(path + ".tmp.npy", statuses)
+        os.replace(path + ".tmp.npy", path)
+
+
+    def read_dictionary(self, name):
+        """ Strings of a dictionary that are part of the export """
+        return read_lines(os.path.join(self.directory, f"{name}.txt"),
+                          self.meta['dictionaries'][name]['count'])
+
+
+    def save_meta(self):
+        meta_file = os.path.join(self.directory, META_FILE)
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(meta_file + ".tmp", meta_file)
+
+
+
+def load_ratings(directory, mmap_mode="r"):
+    """ Load an export made by RatingExport, memory-mapping its columns
+
+    Args:
+        directory (str): Folder of the export.
+        mmap_mode (str): Passed to np.load, None to read the columns into memory.
+
+    Returns:
+        dict: Array of each column (see COLUMNS), e.g. 'rating', and the
+            strings of each dictionary, e.g. 'videos', so that
+            ratings['videos'][ratings['video']] is the video url of each rating.
+            'status' is the review status of each rating's assignment as of
+            the last export, an index into 'statuses' (see STATUSES).
+    """
+    export = RatingExport(directory)
+    rows = export.meta['rows']
+    ratings = {}
+    for name, dtype in COLUMNS.items():
+        path = os.path.join(directory, f"{name}.npy")
+        # Rows past the recorded count are from an interrupted export
+        ratings[name] = np.load(path, mmap_mode=mmap_mode)[:rows] if rows else np.empty(0, dtype=dtype)
+    for name in DICTIONARIES.values():
+        ratings[name] = np.array(export.read_dictionary(name), dtype=str)
+    statuses = np.zeros(len(ratings['assignments']), dtype=np.int8)
+    status_file = os.path.join(directory, STATUS_FILE)
+    if os.path.isfile(status_file):
+        saved = np.load(status_file)[:len(statuses)]
+        statuses[:len(saved)] = saved
+    ratings['status'] = statuses[ratings['assignment']]
+    ratings['statuses'] = np.array(STATUSES)
+    return ratings
+
+
+
+def utc_seconds(timestamp):
+    """ Stored timestamp string as a datetime64 in UTC, NaT if it can't be parsed """
+    try:
+        value = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return np.datetime64("NaT")
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "s")
+
+
+def write_lines(path, lines, offset):
+    """ Write lines to a text file starting at a byte offset, dropping anything after it
+
+    Returns:
+        int: Size of the file in bytes.
+    """
+    mode = "r+b" if os.path.isfile(path) else "wb"
+    with open(path, mode) as f:
+        f.seek(offset)
+        f.truncate()
+        f.write("".join(f"{line}\n" for line in lines).encode("utf-8"))
+        return f.tell()
+
+
+def read_lines(path, count):
+    """ First count lines of a text file, without their newlines """
+    if not count:
+        return []
+    lines = []
+    with open(path, "r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            if len(lines) == count:
+                break
+            lines.append(line[:-1])
+    return lines
+
+
+def write_npy_rows(path, values, start):
+    """ Write a 1d array into a .npy file starting at row start, dropping any rows after it
+
+    The header is rewritten in place with the new length, so appending
+    doesn't copy the rows already in the file (unless the longer length
+    no longer fits in the header's padding).
+    """
+    if not os.path.isfile(path):
+        np.save(path, values[:0])
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                       else np.lib.format.read_array_header_2_0)
+        shape, fortran_order, dtype = read_header(f)
+        data_offset = f.tell()
+        if start > shape[0]:
+            raise ValueError(f"Can't write row {start} of {path}, it only has {shape[0]} rows")
+        header = io.BytesIO()
+        write_header = (np.lib.format.write_array_header_1_0 if version == (1, 0)
+                        else np.lib.format.write_array_header_2_0)
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (start + len(values),)})
+        if len(header.getvalue()) == data_offset:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.seek(data_offset + start * dtype.itemsize)
+            f.truncate()
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            return
+    # The header grew, so write a new file
+    existing = np.load(path)[:start]
+    np.save(path + ".tmp.npy", np.concatenate([existing, values.astype(existing.dtype)]))
+    os.replace(path + ".tmp.npy", path)
@@ -0,0 +1,479 @@
+import abc
+import json
+import time
+import random
+import hashlib
+import datetime
+import itertools
+import threading
+from collections import Counter
+import httplib2
+from botocore.exceptions import ClientError
+from googleapiclient.errors import HttpError
+
+# Page sizes the real APIs allow at most
+MTURK_PAGE_SIZE = 100
+YOUTUBE_PAGE_SIZE = 50
+
+QUESTIONS = ["depth_perception", "bimanual_dexterity", "efficiency", "force_sensitivity", "robotic_control"]
+
+
+class FakeBackend(abc.ABC):
+    """Shared behaviour of the local API stand-ins.
+
+    Every call is counted by operation name, can be delayed to simulate
+    network latency and can fail with a throttling error at random.
+
+    Args:
+        latency (float): Seconds each call takes.
+        throttle_rate (float): Fraction of calls that fail with a throttling error.
+        seed (int): Seed for the random throttling and generated data.
+
+    Attributes:
+        calls (Counter): Number of calls of each operation, e.g. calls['ListHITs'].
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+
+    def call(self, operation):
+        """ Count a call, wait out the latency and maybe throttle it """
+        with self.lock:
+            self.calls[operation] += 1
+            throttled = self.throttle_rate and self.rng.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            self.throttle(operation)
+
+
+    @abc.abstractmethod
+    def throttle(self, operation):
+        """ Raise the error the real API raises when a call is throttled """
+
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+
+
+class FakeMTurkClient(FakeBackend):
+    """In-process stand-in for the boto3 'mturk' client.
+
+    Implements the operations MTurkAccount uses, with NextToken pagination
+    and MaxResults limits like the real service. Throttled calls raise the
+    same ClientError boto3 does, so retries and rate limiting can be
+    exercised without an AWS account.
+
+    Args:
+        num_hits (int): Number of HITs to start with.
+        assignments_per_hit (int): Number of submitted assignments of each HIT.
+        num_videos (int): Number of videos rated in each assignment.
+        **kwargs: latency, throttle_rate and seed (see FakeBackend).
+    """
+    # Each client numbers its HITs differently, like the sandbox and live sites
+    instances = itertools.count()
+
+    def __init__(self, num_hits=0, assignments_per_hit=0, num_videos=5, **kwargs):
+        super().__init__(**kwargs)
+        self.id_prefix = f"HIT{next(FakeMTurkClient.instances):03d}"
+        self.num_videos = num_videos
+        self.hits = {}
+        self.hit_list = []
+        self.assignments = {}
+        self.tokens = {}
+        self.qualification_types = {}
+        self.qualifications = {}
+        self.bonuses = {}
+        self.assignment_index = {}
+        for _ in range(num_hits):
+            hit = self.new_hit(Title="Rate surgical videos", Description="", MaxAssignments=assignments_per_hit)
+            for _ in range(assignments_per_hit):
+                self.submit_assignment(hit['HITId'])
+
+
+    def throttle(self, operation):
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+
+    def error(self, operation, message, code='RequestError'):
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+    def new_hit(self, **params):
+        """ Add a HIT with the given create_hit parameters """
+        with self.lock:
+            hit_id = f"{self.id_prefix}{len(self.hits):08d}"
+            hit = {
+                'HITId': hit_id,
+                'HITGroupId': "GROUP" + hashlib.sha1(params.get('Title', '').encode()).hexdigest()[:10],
+                'Title': params.get('Title'),
+                'Description': params.get('Description'),
+                'Question': params.get('Question'),
+                'RequesterAnnotation': params.get('RequesterAnnotation'),
+                'HITStatus': 'Assignable',
+                'HITReviewStatus': 'NotReviewed',
+                'MaxAssignments': params.get('MaxAssignments', 1),
+                'QualificationRequirements': params.get('QualificationRequirements', []),
+                'NumberOfAssignmentsAvailable': params.get('MaxAssignments', 1),
+                'NumberOfAssignmentsPending': 0,
+                'NumberOfAssignmentsCompleted': 0,
+                'CreationTime': datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc),
+                'Expiration': datetime.datetime(2021, 1, 8, tzinfo=datetime.timezone.utc),
+            }
+            self.hits[hit_id] = hit
+            self.hit_list.append(hit)
+            self.assignments[hit_id] = []
+        return hit
+
+
+    def submit_assignment(self, hit_id, worker_id=None, ratings=None):
+        """ Add a submitted assignment to a HIT, with random ratings if none are given """
+        with self.lock:
+            hit = self.hits[hit_id]
+            if ratings is None:
+                ratings = {f"video{v}_{q}": str(self.rng.randint(1, 5))
+                           for v in range(self.num_videos) for q in QUESTIONS}
+            answer = json.dumps([ratings]).replace('"', "&quot;")
+            accepted = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+            assignment = {
+                'AssignmentId': f"{hit_id}A{len(self.assignments[hit_id]):04d}",
+                'WorkerId': worker_id or f"WORKER{self.rng.randrange(1000):04d}",
+                'HITId': hit_id,
+                'AssignmentStatus': 'Submitted',
+                'AcceptTime': accepted,
+                'SubmitTime': accepted + datetime.timedelta(minutes=10),
+                'Answer': ('<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers><Answer>'
+                           '<QuestionIdentifier>taskAnswers</QuestionIdentifier>'
+                           f'<FreeText>{answer}</FreeText></Answer></QuestionFormAnswers>'),
+            }
+            self.assignments[hit_id].append(assignment)
+            self.assignment_index[assignment['AssignmentId']] = assignment
+            hit['NumberOfAssignmentsAvailable'] = max(0, hit['NumberOfAssignmentsAvailable'] - 1)
+            hit['NumberOfAssignmentsCompleted'] += 1
+        return assignment
+
+
+    def page(self, items, MaxResults, NextToken=None):
+        """ One page of items and the token of the next page """
+        start = int(NextToken or 0)
+        response = {'NumResults': len(items[start:start + MaxResults])}
+        if start + MaxResults < len(items):
+            response['NextToken'] = str(start + MaxResults)
+        return items[start:start + MaxResults], response
+
+
+    def create_hit(self, UniqueRequestToken=None, **params):
+        self.call('CreateHIT')
+        if UniqueRequestToken is not None:
+            with self.lock:
+                if UniqueRequestToken in self.tokens:
+                    raise self.error('CreateHIT', f"The HIT with UniqueRequestToken "
+                                     f"{UniqueRequestToken} already exists.")
+                self.tokens[UniqueRequestToken] = None
+        return {'HIT': self.new_hit(**params)}
+
+
+    def list_hits(self, MaxResults=10, NextToken=None):
+        self.call('ListHITs')
+        if MaxResults > MTURK_PAGE_SIZE:
+            raise self.error('ListHITs', "MaxResults must be at most 100", 'ValidationException')
+        with self.lock:
+            items, response = self.page(self.hit_list, MaxResults, NextToken)
+        response['HITs'] = [dict(hit) for hit in items]
+        return response
+
+
+    def list_assignments_for_hit(self, HITId, MaxResults=10, NextToken=None, AssignmentStatuses=None):
+        self.call('ListAssignmentsForHIT')
+        with self.lock:
+            assignments = [a for a in self.assignments.get(HITId, [])
+                           if AssignmentStatuses is None or a['AssignmentStatus'] in AssignmentStatuses]
+        items, response = self.page(assignments, MaxResults, NextToken)
+        response['Assignments'] = [dict(a) for a in items]
+        return response
+
+
+    def review(self, operation, AssignmentId, status):
+        self.call(operation)
+        with self.lock:
+            assignment = self.assignment_index.get(AssignmentId)
+            if assignment is None:
+                raise self.error(operation, f"Assignment {AssignmentId} does not exist.")
+            if assignment['AssignmentStatus'] != 'Submitted':
+                raise self.error(operation, "This operation can be called with a status of: Submitted")
+            assignment['AssignmentStatus'] = status
+            time_key = 'ApprovalTime' if status == 'Approved' else 'RejectionTime'
+            assignment[time_key] = datetime.datetime.now(datetime.timezone.utc)
+            hit = self.hits[assignment['HITId']]
+            if all(a['AssignmentStatus'] != 'Submitted' for a in self.assignments[hit['HITId']]):
+                hit['HITReviewStatus'] = 'Reviewed'
+        return {}
+
+
+    def get_assignment(self, AssignmentId):
+        self.call('GetAssignment')
+        with self.lock:
+            assignment = self.assignment_index.get(AssignmentId)
+            if assignment is None:
+                raise self.error('GetAssignment', f"Assignment {AssignmentId} does not exist.")
+            return {'Assignment': dict(assignment), 'HIT': dict(self.hits[assignment['HITId']])}
+
+
+    def approve_assignment(self, AssignmentId, RequesterFeedback=None, OverrideRejection=False):
+        return self.review('ApproveAssignment', AssignmentId, 'Approved')
+
+
+    def reject_assignment(self, AssignmentId, RequesterFeedback):
+        return self.review('RejectAssignment', AssignmentId, 'Rejected')
+
+
+    def send_bonus(self, WorkerId, BonusAmount, AssignmentId, Reason, UniqueRequestToken=None):
+        self.call('SendBonus')
+        with self.lock:
+            key = UniqueRequestToken or object()
+            if key in self.bonuses:
+                raise self.error('SendBonus', "A bonus with this UniqueRequestToken was already sent.")
+            self.bonuses[key] = (WorkerId, AssignmentId, BonusAmount)
+        return {}
+
+
+    def create_additional_assignments_for_hit(self, HITId, NumberOfAdditionalAssignments, UniqueRequestToken=None):
+        self.call('CreateAdditionalAssignmentsForHIT')
+        with self.lock:
+            hit = self.hits.get(HITId)
+            if hit is None:
+                raise self.error('CreateAdditionalAssignmentsForHIT', f"Hit {HITId} does not exist.")
+            if UniqueRequestToken is not None:
+                if UniqueRequestToken in self.tokens:
+                    raise self.error('CreateAdditionalAssignmentsForHIT', f"The request with UniqueRequestToken "
+                                     f"{UniqueRequestToken} was already made.")
+                self.tokens[UniqueRequestToken] = None
+            if hit['MaxAssignments'] < 10 <= hit['MaxAssignments'] + NumberOfAdditionalAssignments:
+                raise self.error('CreateAdditionalAssignmentsForHIT', "HITs created with fewer than 10 "
+                                 "assignments cannot be extended to have 10 or more assignments.",
+                                 'ValidationException')
+            hit['MaxAssignments'] += NumberOfAdditionalAssignments
+            hit['NumberOfAssignmentsAvailable'] += NumberOfAdditionalAssignments
+            hit['HITStatus'] = 'Assignable'
+        return {}
+
+
+    def update_expiration_for_hit(self, HITId, ExpireAt):
+        self.call('UpdateExpirationForHIT')
+        with self.lock:
+            hit = self.hits.get(HITId)
+            if hit is None:
+                raise self.error('UpdateExpirationForHIT', f"Hit {HITId} does not exist.")
+            # A time in the past expires the HIT right away
+            now = datetime.datetime.now(datetime.timezone.utc)
+            hit['Expiration'] = max(ExpireAt, now)
+            if ExpireAt <= now:
+                hit['NumberOfAssignmentsAvailable'] = 0
+                hit['HITStatus'] = 'Reviewable' if not hit['NumberOfAssignmentsPending'] else 'Unassignable'
+        return {}
+
+
+    def list_qualification_types(self, Query=None, MustBeRequestable=False, MustBeOwnedByCaller=True,
+                                 MaxResults=10, NextToken=None):
+        self.call('ListQualificationTypes')
+        with self.lock:
+            types = [t for t in self.qualification_types.values() if not Query or Query in t['Name']]
+        items, response = self.page(types, MaxResults, NextToken)
+        response['QualificationTypes'] = items
+        return response
+
+
+    def create_qualification_type(self, Name, Description, QualificationTypeStatus, Keywords=None, **kwargs):
+        self.call('CreateQualificationType')
+        with self.lock:
+            type_id = f"QUAL{len(self.qualification_types):06d}"
+            qual_type = {'QualificationTypeId': type_id, 'Name': Name, 'Description': Description,
+                         'QualificationTypeStatus': QualificationTypeStatus}
+            self.qualification_types[type_id] = qual_type
+            self.qualifications[type_id] = {}
+        return {'QualificationType': qual_type}
+
+
+    def associate_qualification_with_worker(self, QualificationTypeId, WorkerId, IntegerValue=1,
+                                            SendNotification=True):
+        self.call('AssociateQualificationWithWorker')
+        with self.lock:
+            self.qualifications[QualificationTypeId][WorkerId] = IntegerValue
+        return {}
+
+
+    def list_workers_with_qualification_type(self, QualificationTypeId, Status='Granted',
+                                             MaxResults=10, NextToken=None):
+        self.call('ListWorkersWithQualificationType')
+        with self.lock:
+            qualifications = [{'QualificationTypeId': QualificationTypeId, 'WorkerId': worker_id,
+                               'IntegerValue': value, 'Status': 'Granted'}
+                              for worker_id, value in self.qualifications.get(QualificationTypeId, {}).items()]
+        items, response = self.page(qualifications, MaxResults, NextToken)
+        response['Qualifications'] = items
+        return response
+
+
+
+class FakeYouTubeClient(FakeBackend):
+    """In-process stand-in for the googleapiclient YouTube resource.
+
+    Supports the playlists(), playlistItems() and videos() collections used
+    by YouTubeAccount, with pageToken pagination, ETags (a request with a
+    matching If-None-Match header gets a 304) and 403 rate limit errors.
+
+    Args:
+        num_playlists (int): Number of playlists to start with.
+        videos_per_playlist (int): Number of videos in each playlist.
+        **kwargs: latency, throttle_rate and seed (see FakeBackend).
+    """
+    def __init__(self, num_playlists=0, videos_per_playlist=0, **kwargs):
+        super().__init__(**kwargs)
+        self.playlists_data = {}
+        self.items = {}
+        self.videos_data = {}
+        for p in range(num_playlists):
+            playlist_id = self.add_playlist(f"Playlist {p}")
+            for v in range(videos_per_playlist):
+                self.add_video(playlist_id, f"Video {p}-{v}")
+
+
+    def throttle(self, operation):
+        raise HttpError(httplib2.Response({'status': 403}),
+                        b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}')
+
+
+    def add_playlist(self, title, privacy_status='unlisted'):
+        with self.lock:
+            playlist_id = f"PL{len(self.playlists_data):08d}"
+            self.playlists_data[playlist_id] = {
+                'kind': 'youtube#playlist', 'id': playlist_id,
+                'snippet': {'title': title, 'description': ''},
+                'status': {'privacyStatus': privacy_status},
+            }
+            self.items[playlist_id] = []
+        return playlist_id
+
+
+    def add_video(self, playlist_id, title):
+        with self.lock:
+            video_id = f"VID{len(self.videos_data):08d}"
+            self.videos_data[video_id] = {'id': video_id, 'snippet': {'title': title}}
+            self.items[playlist_id].append({
+                'kind': 'youtube#playlistItem',
+                'contentDetails': {'videoId': video_id},
+                'snippet': {'title': title, 'description': '', 'playlistId': playlist_id},
+                'status': {'privacyStatus': 'unlisted'},
+            })
+        return video_id
+
+
+    def playlists(self):
+        return FakeCollection(self, 'playlists')
+
+
+    def playlistItems(self):
+        return FakeCollection(self, 'playlistItems')
+
+
+    def videos(self):
+        return FakeCollection(self, 'videos')
+
+
+    def list_items(self, collection, params):
+        """ All items a list request pages through """
+        with self.lock:
+            if collection == 'playlists':
+                return list(self.playlists_data.values())
+            return list(self.items.get(params['playlistId'], []))
+
+
+    def execute(self, request):
+        """ Respond to a FakeRequest like the YouTube Data API would """
+        operation = f"youtube.{request.collection}.{request.method}"
+        self.call(operation)
+        if request.method == 'insert':
+            body = request.params['body']
+            if request.collection == 'playlists':
+                playlist_id = self.add_playlist(body['snippet']['title'], body['status']['privacyStatus'])
+                return dict(self.playlists_data[playlist_id])
+            if request.collection == 'playlistItems':
+                snippet = body['snippet']
+                with self.lock:
+                    video = self.videos_data[snippet['resourceId']['videoId']]
+                    self.items[snippet['playlistId']].append({
+                        'kind': 'youtube#playlistItem',
+                        'contentDetails': {'videoId': video['id']},
+                        'snippet': {'title': video['snippet']['title'], 'description': '',
+                                    'playlistId': snippet['playlistId']},
+                        'status': {'privacyStatus': 'unlisted'},
+                    })
+                return {}
+            with self.lock:
+                video_id = f"VID{len(self.videos_data):08d}"
+                self.videos_data[video_id] = {'id': video_id, 'snippet': body['snippet']}
+            return {'id': video_id}
+
+        items = self.list_items(request.collection, request.params)
+        start = int(request.params.get('pageToken') or 0)
+        page_size = min(request.params.get('maxResults', 5), YOUTUBE_PAGE_SIZE)
+        page = items[start:start + page_size]
+        etag = hashlib.sha1(json.dumps(page, sort_keys=True).encode()).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            raise HttpError(httplib2.Response({'status': 304}), b'')
+        response = {'etag': etag, 'items': page, 'pageInfo': {'totalResults': len(items)}}
+        if start + page_size < len(items):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+
+
+class FakeCollection:
+    """ A collection of the fake YouTube resource, e.g. youtube.playlists() """
+    def __init__(self, client, collection):
+        self.client = client
+        self.collection = collection
+
+
+    def list(self, **params):
+        return FakeRequest(self.client, self.collection, 'list', params)
+
+
+    def insert(self, **params):
+        return FakeRequest(self.client, self.collection, 'insert', params)
+
+
+    def list_next(self, previous_request, previous_response):
+        """ Request for the next page, or None after the last page """
+        if 'nextPageToken' not in previous_response:
+            return None
+        params = dict(previous_request.params, pageToken=previous_response['nextPageToken'])
+        return FakeRequest(self.client, self.collection, 'list', params)
+
+
+
+class FakeRequest:
+    """ A request of the fake YouTube resource, executed in-process """
+    def __init__(self, client, collection, method, params):
+        self.client = client
+        self.collection = collection
+        self.method = method
+        self.params = params
+        self.headers = {}
+        query = "&".join(f"{k}={v}" for k, v in sorted(params.items()) if k != 'body')
+        self.uri = f"https://youtube.googleapis.com/youtube/v3/{collection}?{query}"
+
+
+    def execute(self, http=None, num_retries=0):
+        return self.client.execute(self)
+
+
+    def next_chunk(self, http=None, num_retries=0):
+        """ Upload the whole media body in one chunk """
+        return None, self.client.execute(self)
@@ -0,0 +1,330 @@
+import json
+import time
+import datetime
+import threading
+import functools
+import contextlib
+import contextvars
+from src.ratelimit import THROTTLING_ERRORS, RETRY_ATTEMPT
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# YouTube Data API quota cost of each method, see
+# https://developers.google.com/youtube/v3/determine_quota_cost
+YOUTUBE_QUOTA_COSTS = {
+    'youtube.videos.insert': 1600,
+    'youtube.search.list': 100,
+}
+YOUTUBE_DEFAULT_COSTS = {'list': 1, 'insert': 50, 'update': 50, 'delete': 50}
+
+# YouTube errors returned when the quota is used up or requests are too fast
+YOUTUBE_QUOTA_ERRORS = ["quotaExceeded", "rateLimitExceeded", "userRateLimitExceeded"]
+
+# Command the API calls made in the current context are attributed to (see ApiMetrics.command)
+CURRENT_COMMAND = contextvars.ContextVar("api_metrics_command", default=None)
+
+
+def youtube_quota_cost(method_id):
+    """ Quota units a YouTube Data API method costs, e.g. 'youtube.playlists.list' costs 1 """
+    method_id = method_id or ""
+    if method_id in YOUTUBE_QUOTA_COSTS:
+        return YOUTUBE_QUOTA_COSTS[method_id]
+    return YOUTUBE_DEFAULT_COSTS.get(method_id.rsplit(".", 1)[-1], 1)
+
+
+
+class OperationStats:
+    """Totals for one API operation.
+
+    Attributes:
+        calls (int): Number of calls, not counting retries.
+        errors (int): Number of calls that failed, after any retries.
+        throttled (int): Number of attempts rejected for throttling or quota.
+        retries (int): Number of extra attempts made by the client library
+            or by call_with_retries.
+        seconds (float): Total time spent in calls, including retries.
+        histogram (list): Number of calls in each LATENCY_BUCKETS bucket.
+        bytes_sent (int): Size of the request bodies.
+        bytes_received (int): Size of the response bodies.
+        quota (int): YouTube quota units used.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.quota = 0
+
+
+    def add(self, seconds, error=False, throttled=False, retries=0, bytes_sent=0, bytes_received=0, quota=0,
+            retry=False):
+        if retry:
+            # Another attempt of a call whose throttled attempt was already counted as failed
+            self.retries += 1
+            self.errors -= int(not error)
+        else:
+            self.calls += 1
+            self.errors += int(error)
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            self.histogram[bucket] += 1
+        self.throttled += throttled
+        self.retries += retries
+        self.seconds += seconds
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.quota += quota
+
+
+    def percentile(self, fraction):
+        """ Upper bound of the histogram bucket the given fraction of calls fall in """
+        target = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target and count:
+                return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'seconds': round(self.seconds, 4),
+            'latency_histogram': dict(zip([f"<={b}s" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"],
+                                          self.histogram)),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'quota': self.quota,
+        }
+
+
+
+class ApiMetrics:
+    """Call counts, latency, retries, bytes and quota of every MTurk and YouTube request.
+
+    boto3 clients are instrumented with botocore event hooks (see
+    instrument_boto3) and YouTube clients are built with a request class
+    that records each request (see request_builder), so the accounts
+    don't need to record anything themselves.
+
+    Args:
+        profile_commands (bool): Also keep separate totals for each CLI
+            command run inside command().
+
+    Attributes:
+        totals (dict): OperationStats of each (service, operation).
+        profiles (dict): Totals of each command, by command name.
+        started (datetime): When recording started.
+    """
+    def __init__(self, profile_commands=False):
+        self.profile_commands = profile_commands
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.profiles = {}
+        self.started = datetime.datetime.now()
+
+
+    def record(self, service, operation, seconds, **kwargs):
+        """ Record a finished call (see OperationStats.add for the keyword arguments)
+
+        Attempts after the first of a call_with_retries call are recorded as
+        retries of that call.
+        """
+        key = (service, operation)
+        command = CURRENT_COMMAND.get()
+        retry = RETRY_ATTEMPT.get() > 0
+        with self.lock:
+            self.totals.setdefault(key, OperationStats()).add(seconds, retry=retry, **kwargs)
+            if command is not None:
+                profile = self.profiles.setdefault(command, {})
+                profile.setdefault(key, OperationStats()).add(seconds, retry=retry, **kwargs)
+
+
+    @contextlib.contextmanager
+    def command(self, name):
+        """ Attribute calls made inside the block to a command, if profiling commands
+
+        Calls are attributed in the block's context, so calls made on
+        ContextThreadPoolExecutor workers count too but calls made by
+        background threads, like the StatusCache checks, don't.
+        """
+        if not self.profile_commands:
+            yield
+            return
+        token = CURRENT_COMMAND.set(name)
+        try:
+            yield
+        finally:
+            CURRENT_COMMAND.reset(token)
+
+
+    def quota_used(self):
+        """ YouTube quota units used since recording started """
+        with self.lock:
+            return sum(stats.quota for (service, _), stats in self.totals.items() if service == 'youtube')
+
+
+    def instrument_boto3(self, client):
+        """ Record every call made with a boto3 client using botocore's event hooks """
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+
+        def before_call(context, **kwargs):
+            context['metrics_start'] = time.perf_counter()
+            context['metrics_attempts'] = 0
+            context['metrics_bytes_sent'] = 0
+            context['metrics_throttled'] = 0
+
+        def request_created(request, operation_name=None, **kwargs):
+            context = request.context
+            context['metrics_attempts'] = context.get('metrics_attempts', 0) + 1
+            body = request.body
+            if body:
+                context['metrics_bytes_sent'] = len(body) if isinstance(body, (bytes, str)) else 0
+
+        def needs_retry(response, request_dict, **kwargs):
+            # Attempts botocore throttled and retried by itself
+            if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERRORS:
+                context = request_dict['context']
+                context['metrics_throttled'] = context.get('metrics_throttled', 0) + 1
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            self.record(service, model.name, time.perf_counter() - context.get('metrics_start', time.perf_counter()),
+                        error=http_response.status_code >= 300,
+                        throttled=context.get('metrics_throttled', 0),
+                        retries=max(0, context.get('metrics_attempts', 1) - 1),
+                        bytes_sent=context.get('metrics_bytes_sent', 0),
+                        bytes_received=len(http_response.content or b""))
+
+        def after_call_error(context, event_name, exception=None, **kwargs):
+            # Connection and credential errors that never got a response
+            self.record(service, event_name.rsplit(".", 1)[-1], time.perf_counter() - context.get('metrics_start', time.perf_counter()),
+                        error=True, retries=max(0, context.get('metrics_attempts', 1) - 1),
+                        bytes_sent=context.get('metrics_bytes_sent', 0))
+
+        events.register(f"before-call.{service}", before_call)
+        events.register(f"request-created.{service}", request_created)
+        events.register(f"needs-retry.{service}", needs_retry)
+        events.register(f"after-call.{service}", after_call)
+        events.register(f"after-call-error.{service}", after_call_error)
+        return client
+
+
+    def request_builder(self):
+        """ HttpRequest class to build YouTube clients with, recording every request """
+        return type("InstrumentedHttpRequest", (instrumented_http_request(),), {'metrics': self})
+
+
+    def to_dict(self):
+        """ Everything recorded so far, in a form that can be saved as JSON """
+        def by_operation(stats):
+            return {f"{service}.{operation}": s.to_dict() for (service, operation), s in sorted(stats.items())}
+        with self.lock:
+            return {
+                'started': self.started.isoformat(timespec='seconds'),
+                'exported': datetime.datetime.now().isoformat(timespec='seconds'),
+                'operations': by_operation(self.totals),
+                'commands': {name: by_operation(stats) for name, stats in self.profiles.items()},
+            }
+
+
+    def save(self, path):
+        """ Export the metrics as JSON """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+    def report(self, daily_quota=None):
+        """ Table of the calls made to each operation, as a string """
+        lines = [f"{'Operation':<45} {'Calls':>6} {'Errors':>6} {'Thrtl':>6} {'Retry':>6} "
+                 f"{'Avg ms':>7} {'p95 <=':>7} {'KB out':>7} {'KB in':>7} {'Quota':>6}"]
+        with self.lock:
+            stats = sorted(self.totals.items())
+            for (service, operation), s in stats:
+                lines.append(
+                    f"{service + '.' + operation:<45} {s.calls:>6} {s.errors:>6} {s.throttled:>6} "
+                    f"{s.retries:>6} {1000 * s.seconds / max(s.calls, 1):>7.0f} "
+                    f"{s.percentile(0.95):>6}s {s.bytes_sent / 1e3:>7.1f} {s.bytes_received / 1e3:>7.1f} "
+                    f"{s.quota:>6}")
+        if not stats:
+            lines.append("No API calls made yet")
+        quota = sum(s.quota for (service, _), s in stats if service == 'youtube')
+        line = f"YouTube quota used since {self.started:%H:%M}: {quota}"
+        if daily_quota:
+            line += f" of {daily_quota} daily units ({100 * quota / daily_quota:.1f}%)"
+        lines.append(line)
+        return "\n".join(lines)
+
+
+
+@functools.lru_cache(maxsize=None)
+def instrumented_http_request():
+    """ googleapiclient request class that records its latency, size and quota cost
+
+    Defined on first use so googleapiclient is only imported when a YouTube
+    client is built. Use ApiMetrics.request_builder() to get a subclass
+    bound to an ApiMetrics.
+    """
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import HttpRequest
+
+    class InstrumentedHttpRequest(HttpRequest):
+        metrics = None
+
+        def execute(self, http=None, num_retries=0):
+            if self.resumable:
+                # Recorded chunk by chunk in next_chunk
+                return super().execute(http=http, num_retries=num_retries)
+            return self.recorded(lambda: super(InstrumentedHttpRequest, self).execute(
+                http=http, num_retries=num_retries), len(self.body or ""), youtube_quota_cost(self.methodId))
+
+
+        def next_chunk(self, http=None, num_retries=0):
+            # An upload only costs quota once, however many chunks it takes
+            quota = 0 if self.resumable_progress else youtube_quota_cost(self.methodId)
+            progress = self.resumable_progress
+            return self.recorded(lambda: super(InstrumentedHttpRequest, self).next_chunk(
+                http=http, num_retries=num_retries), lambda: self.resumable_progress - progress, quota)
+
+
+        def recorded(self, send, bytes_sent, quota):
+            """ Send the request, recording it once it finishes or fails """
+            received = 0
+            postproc = self.postproc
+
+            def counting_postproc(resp, content):
+                nonlocal received
+                received = len(content or b"")
+                return postproc(resp, content)
+
+            self.postproc = counting_postproc
+            start = time.perf_counter()
+            error = throttled = False
+            try:
+                return send()
+            except HttpError as e:
+                error = e.resp.status != 304
+                throttled = any(reason in str(e.content) for reason in YOUTUBE_QUOTA_ERRORS)
+                received = len(e.content or b"")
+                raise
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.postproc = postproc
+                self.metrics.record(
+                    'youtube', (self.methodId or "unknown").split(".", 1)[-1], time.perf_counter() - start,
+                    error=error, throttled=throttled, bytes_received=received,
+                    bytes_sent=bytes_sent() if callable(bytes_sent) else bytes_sent, quota=quota)
+
+    return InstrumentedHttpRequest
@@ -1,6 +1,26 @@
-import boto3
-import xmltodict
+import os
+import csv
+import time
 import json
+import string
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+from src.ratelimit import RateLimiter, ContextThreadPoolExecutor, call_with_retries, call_many
+from src.answers import decode_answer
+from src.utils import LazyDict
+
+# Number of HITs to create at the same time
+HIT_WORKERS = 8
+
+# Default MTurk request rate (requests per second) used for batches
+REQUESTS_PER_SECOND = 5
+
+ENDPOINTS = {
+    True: 'https://mturk-requester-sandbox.us-east-1.amazonaws.com',
+    False: 'https://mturk-requester.us-east-1.amazonaws.com',
+}
+
+ASSIGNMENT_STATUSES = ['Submitted', 'Approved', 'Rejected']
 
 
 class MTurkAccount:
@@ -9,48 +29,243 @@ class MTurkAccount:
     Args:
         aws_access_key_id (str): AWS access key id.
         aws_secret_access_key (str): AWS secret access key.
+        sandbox_client: Optional mturk client to use instead of connecting
+            to the sandbox, e.g. a src.fakes.FakeMTurkClient.
+        live_client: Optional mturk client to use instead of connecting to
+            the live site.
+        metrics (ApiMetrics): Optional recorder of every call made by the
+            boto3 clients.
 
     Attributes:
-
+        clients (dict): mturk client of the sandbox (True) and live site
+            (False), each created the first time it is needed.
     """
-    def __init__(self, aws_access_key_id, aws_secret_access_key):
-        self.sandbox_client = boto3.client(
-            'mturk',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name='us-east-1',
-            endpoint_url='https://mturk-requester-sandbox.us-east-1.amazonaws.com'
-        )
-        self.live_client = boto3.client(
-            'mturk',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name='us-east-1',
-            endpoint_url='https://mturk-requester.us-east-1.amazonaws.com'
-        )
+    def __init__(self, aws_access_key_id, aws_secret_access_key, sandbox_client=None, live_client=None,
+                 metrics=None):
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.metrics = metrics
+        self.clients = {True: sandbox_client, False: live_client}
+        self.clients_lock = threading.Lock()
 
 
     def get_client(self, sandbox=False):
-        return self.sandbox_client if sandbox else self.live_client
+        """ The sandbox or live mturk client, creating it on first use
 
+        boto3 is only imported here, since importing it and creating clients
+        takes long enough to noticeably slow down starting the CLI.
+        """
+        sandbox = bool(sandbox)
+        if self.clients[sandbox] is None:
+            with self.clients_lock:
+                if self.clients[sandbox] is None:
+                    import boto3
+                    client = boto3.client(
+                        'mturk',
+                        aws_access_key_id=self.aws_access_key_id,
+                        aws_secret_access_key=self.aws_secret_access_key,
+                        region_name='us-east-1',
+                        endpoint_url=ENDPOINTS[sandbox]
+                    )
+                    if self.metrics is not None:
+                        self.metrics.instrument_boto3(client)
+                    self.clients[sandbox] = client
+        return self.clients[sandbox]
+
+
+    def create_hits_from_csv(self, hit_config, html_file, csv_file, journal_file, sandbox=False,
+                             qualification_type_id=None):
+        """ Create one HIT per row of the survey csv
 
-    def create_hit(self, hit_config, sandbox=False):
-        # TODO - Add parameter to differentiate qualification hit from normal hit
-        # TODO - Add in HITLayoutParameters as dict to put all questions in
+        The ${video_url_N} placeholders in the survey html are filled in
+        from each row. HITs are created concurrently under a rate limiter,
+        retrying throttled requests. Every created HIT is written to a
+        journal, so running this again after an interruption only creates
+        the HITs for rows that are missing.
+
+        Args:
+            hit_config (dict): MTURK section of the config.
+            html_file (str): Survey html with ${video_url_N} placeholders.
+            csv_file (str): Survey csv with a video_url_N column per video.
+            journal_file (str): JSON lines file recording created HITs.
+            sandbox (bool): Create HITs in the sandbox.
+            qualification_type_id (str): Only let workers with this
+                qualification find and accept the HITs.
+
+        Returns:
+            int: Number of HITs created in this run.
+        """
+        import hashlib
+        from botocore.exceptions import ClientError
         client = self.get_client(sandbox)
+        limiter = self.get_limiter(hit_config)
+        hit_params = self.hit_params(hit_config)
+        if qualification_type_id:
+            hit_params['QualificationRequirements'] = [{
+                'QualificationTypeId': qualification_type_id,
+                'Comparator': 'Exists',
+                'ActionsGuarded': 'DiscoverPreviewAndAccept',
+            }]
+        with open(html_file, "r") as f:
+            template = string.Template(f.read())
+        journal = HITJournal(journal_file)
+        if len(journal) > 0:
+            print(f"Resuming batch, {len(journal)} HITs already created")
 
-        # Read in survey html as string
-        with open("surveys/survey.html", "r") as f:
-            html_question = f.read()
-        xml_question = f"""
-        <HTMLQuestion xmlns=\"http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2011-11-11/HTMLQuestion.xsd\">
-            <HTMLContent><![CDATA[<!DOCTYPE html>{html_question}]]></HTMLContent>
-            <FrameHeight>0</FrameHeight>
-        </HTMLQuestion>
+        created = 0
+        found = []
+        failed = []
+        start = time.monotonic()
+        lock = threading.Lock()
+        existing = None
+
+        def find_existing(token):
+            """ HIT already created with a request token, found by its RequesterAnnotation """
+            nonlocal existing
+            with lock:
+                if existing is None:
+                    existing = {hit.get('RequesterAnnotation'): hit for hit in self.list_all_hits(sandbox)}
+            return existing.get(token)
+
+        def create(row_number, row):
+            nonlocal created
+            # The same row always gets the same token, MTurk won't create it twice
+            token = hashlib.sha1(f"{csv_file}:{row_number}:{sorted(row.items())}".encode()).hexdigest()
+            try:
+                response = call_with_retries(
+                    client.create_hit,
+                    limiter=limiter,
+                    Question=self.xml_question(template.safe_substitute(row)),
+                    UniqueRequestToken=token,
+                    RequesterAnnotation=token,
+                    **hit_params
+                )
+                hit = response['HIT']
+                journal.add(row_number, hit['HITId'], hit['HITGroupId'], row)
+            except ClientError as e:
+                if "UniqueRequestToken" not in str(e):
+                    raise
+                # Created before the journal entry was saved, so record the HIT it made
+                hit = find_existing(token)
+                with lock:
+                    (found if hit else failed).append(row_number)
+                if hit:
+                    journal.add(row_number, hit['HITId'], hit['HITGroupId'], row)
+                return
+            with lock:
+                created += 1
+                if created % 50 == 0:
+                    rate = created / (time.monotonic() - start)
+                    print(f"  {created} HITs created ({rate:.1f} HITs/s)")
+
+        # Stream the csv, keeping a bounded number of requests in flight
+        with open(csv_file, "r", newline="") as f, ContextThreadPoolExecutor(max_workers=HIT_WORKERS) as executor:
+            pending = set()
+            for row_number, row in enumerate(csv.DictReader(f)):
+                if journal.done(row_number, row):
+                    continue
+                if len(pending) >= HIT_WORKERS * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(create, row_number, row))
+            for future in pending:
+                future.result()
+
+        elapsed = time.monotonic() - start
+        print(f"Created {created} HITs in {elapsed:.1f}s ({created / max(elapsed, 1e-6):.1f} HITs/s)")
+        if found:
+            print(f"Found {len(found)} HITs created by an earlier run that weren't in the journal yet")
+        if failed:
+            # Their tokens were used, but the HITs are gone (e.g. disposed) so they can't be made again
+            print(f"Couldn't create or find the HITs of {len(failed)} csv rows: "
+                  f"{', '.join(str(row_number) for row_number in sorted(failed))}")
+        if journal.group_ids:
+            group_id = next(iter(journal.group_ids))
+            print("You can preview them here:")
+            print(f"https://worker{'sandbox' if sandbox else ''}.mturk.com/mturk/preview?groupId={group_id}")
+        return created
+
+
+    def get_limiter(self, hit_config):
+        """ Rate limiter for bulk requests using the MTURK config """
+        return RateLimiter(hit_config.get("REQUESTS_PER_SECOND") or REQUESTS_PER_SECOND)
+
+
+    def get_qualification_type(self, name, sandbox=False):
+        """ Id of the qualification type with this name that we own, or None """
+        response = self.get_client(sandbox).list_qualification_types(
+            Query = name,
+            MustBeRequestable = False,
+            MustBeOwnedByCaller = True,
+            MaxResults = 100
+        )
+        for qual_type in response['QualificationTypes']:
+            if qual_type['Name'] == name:
+                return qual_type['QualificationTypeId']
+        return None
+
+
+    def create_qualification_type(self, name, description, sandbox=False):
+        """ Create a qualification type that is granted by the requester, returns its id """
+        response = self.get_client(sandbox).create_qualification_type(
+            Name = name,
+            Description = description,
+            Keywords = "video, rating, qualification",
+            QualificationTypeStatus = 'Active'
+        )
+        return response['QualificationType']['QualificationTypeId']
+
+
+    def get_qualified_workers(self, qualification_type_id, sandbox=False):
+        """ Ids of the workers who have been granted a qualification """
+        client = self.get_client(sandbox)
+        kwargs = dict(QualificationTypeId=qualification_type_id, Status='Granted', MaxResults=100)
+        workers = set()
+        while True:
+            response = call_with_retries(client.list_workers_with_qualification_type, **kwargs)
+            workers.update(q['WorkerId'] for q in response['Qualifications'])
+            if 'NextToken' not in response:
+                return workers
+            kwargs['NextToken'] = response['NextToken']
+
+
+    def qualify_workers(self, qualification_type_id, worker_scores, limiter=None, sandbox=False):
+        """ Grant a qualification to many workers concurrently
+
+        Args:
+            qualification_type_id (str): Qualification to grant.
+            worker_scores (dict): Integer score of each worker id, saved as
+                the value of the qualification.
+
+        Returns:
+            list: (kwargs, response, error) of each call.
         """
+        return call_many(self.get_client(sandbox).associate_qualification_with_worker, [
+            {'QualificationTypeId': qualification_type_id, 'WorkerId': worker_id,
+             'IntegerValue': int(score), 'SendNotification': False}
+            for worker_id, score in worker_scores.items()
+        ], limiter, HIT_WORKERS)
+
+
+    def approve_assignments(self, assignment_ids, feedback=None, limiter=None, sandbox=False):
+        """ Approve many assignments concurrently, returns (kwargs, response, error) of each call """
+        extra = {'RequesterFeedback': feedback} if feedback else {}
+        return call_many(self.get_client(sandbox).approve_assignment, [
+            dict(AssignmentId=assignment_id, **extra) for assignment_id in assignment_ids
+        ], limiter, HIT_WORKERS)
+
 
-        # Create hit
-        response = client.create_hit(
+    def reject_assignments(self, assignment_ids, feedback, limiter=None, sandbox=False):
+        """ Reject many assignments concurrently, returns (kwargs, response, error) of each call """
+        return call_many(self.get_client(sandbox).reject_assignment, [
+            dict(AssignmentId=assignment_id, RequesterFeedback=feedback) for assignment_id in assignment_ids
+        ], limiter, HIT_WORKERS)
+
+
+    def hit_params(self, hit_config):
+        """ Parameters of create_hit that come from the MTURK config """
+        return dict(
             Title = hit_config["TITLE"],
             Description = hit_config["DESCRIPTION"],
             Keywords = hit_config["KEYWORDS"],
@@ -59,66 +274,173 @@ class MTurkAccount:
             LifetimeInSeconds = hit_config["LIFETIME_SECONDS"],
             AssignmentDurationInSeconds = hit_config["ASSIGNMENT_DURATION_SECONDS"],
             AutoApprovalDelayInSeconds = hit_config["AUTO_APPROVAL_SECONDS"],
-            Question = xml_question
         )
 
-        # Show results
-        print("A new HIT has been created. You can preview it here:")
-        print(f"https://worker{'sandbox' if sandbox else ''}.mturk.com/mturk/preview?groupId={response['HIT']['HITGroupId']}")
-        print("HITID = " + response['HIT']['HITId'] + " (Use to Get Results)")
 
+    def xml_question(self, html_question):
+        """ Wrap survey html in an HTMLQuestion """
+        return f"""
+        <HTMLQuestion xmlns=\"http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2011-11-11/HTMLQuestion.xsd\">
+            <HTMLContent><![CDATA[<!DOCTYPE html>{html_question}]]></HTMLContent>
+            <FrameHeight>0</FrameHeight>
+        </HTMLQuestion>
+        """
 
-    def get_hits(self, sandbox=False):
-        """ Get all hits from an mturk account"""
-        client = self.get_client(sandbox)
 
-        # Get all hits (using pagination if many pages)
-        response = client.list_hits()
-        all_hits = response['HITs']
-        while 'NextToken' in response:
-            response = client.list_hits(NextToken=response['NextToken'])
-            all_hits.extend(response['HITs'])
+    def get_hits(self, sandbox=False, with_responses=False):
+        """ Get all hits from an mturk account
 
+        Worker responses of each HIT are fetched the first time the
+        'responses' key is accessed, or up front for all HITs at once (on a
+        thread pool) if with_responses is True.
+        """
         # Extract info from each hit response
         hit_info = []
-        for hit in all_hits:
-            hit_info.append({
+        for hit in self.list_all_hits(sandbox):
+            hit_info.append(HIT(self, sandbox, {
                 'id': hit['HITId'],
                 'title': hit['Title'],
                 'description': hit['Description'],
                 'status': hit['HITStatus'],
-                'qual_requirements': hit['QualificationRequirements'],
+                'qual_requirements': hit.get('QualificationRequirements', []),
                 'hits_available': hit['NumberOfAssignmentsAvailable'],
                 'hits_complete': hit['NumberOfAssignmentsCompleted'],
-                'responses': self.get_responses(hit['HITId'], sandbox)
-            })
+            }))
+
+        if with_responses:
+            with ContextThreadPoolExecutor(max_workers=HIT_WORKERS) as executor:
+                list(executor.map(HIT.load_responses, hit_info))
         return hit_info
 
 
+    def has_hits(self, sandbox=False):
+        """ Whether any hits exist in the mturk account, using a single request """
+        response = self.get_client(sandbox).list_hits(MaxResults=1)
+        return len(response['HITs']) > 0
+
+
     def get_responses(self, hit_id, sandbox=False):
         """ Get all worker responses from a specific hit """
+        # Get responses from assignments
+        responses = []
+        for assignment in self.get_assignments(hit_id, sandbox, ['Submitted']):
+            responses.append({
+                'assignment_id': assignment["AssignmentId"],
+                'worker_id': assignment["WorkerId"],
+                'answers': decode_answer(assignment['Answer'])
+            })
+        return responses
+
+
+    def get_assignments(self, hit_id, sandbox=False, statuses=ASSIGNMENT_STATUSES):
+        """ Get all assignments of a specific hit with the given statuses """
         client = self.get_client(sandbox)
 
         # Get all assignments (using pagination if many pages)
-        response = client.list_assignments_for_hit(
+        response = call_with_retries(
+            client.list_assignments_for_hit,
             HITId = hit_id,
-            AssignmentStatuses = ['Submitted']
+            AssignmentStatuses = statuses,
+            MaxResults = 100
         )
         all_assignments = response['Assignments']
         while 'NextToken' in response:
-            response = client.list_assignments_for_hit(
+            response = call_with_retries(
+                client.list_assignments_for_hit,
                 HITId = hit_id,
-                AssignmentStatuses = ['Submitted'],
+                AssignmentStatuses = statuses,
+                MaxResults = 100,
                 NextToken = response['NextToken']
             )
             all_assignments.extend(response['Assignments'])
+        return all_assignments
 
-        # Get responses from assignments
-        responses = []
-        for assignment in all_assignments:
-            responses.append({
-                'assignment_id': assignment["AssignmentId"],
-                'worker_id': assignment["WorkerId"],
-                'answers': json.loads(xmltodict.parse(assignment['Answer'])['QuestionFormAnswers']['Answer']['FreeText'])
-            })
-        return responses
+
+    def list_all_hits(self, sandbox=False):
+        """ Get the raw info of every hit in the account """
+        client = self.get_client(sandbox)
+        response = call_with_retries(client.list_hits, MaxResults=100)
+        all_hits = response['HITs']
+        while 'NextToken' in response:
+            response = call_with_retries(client.list_hits, MaxResults=100, NextToken=response['NextToken'])
+            all_hits.extend(response['HITs'])
+        return all_hits
+
+
+
+class HIT(LazyDict):
+    """Summary of a single HIT whose worker responses are fetched on first access.
+
+    Behaves like the plain HIT dict, the 'responses' key is filled in by
+    MTurkAccount.get_responses the first time it is looked up (see LazyDict).
+
+    Args:
+        account (MTurkAccount): Account used to fetch the responses.
+        sandbox (bool): Whether the HIT is in the sandbox.
+        info (dict): Summary of the HIT (id, title, status, ...).
+    """
+    lazy_keys = ('responses',)
+
+    def __init__(self, account, sandbox, info):
+        super().__init__(info)
+        self.account = account
+        self.sandbox = sandbox
+
+
+    def fetch(self, key):
+        return self.account.get_responses(self['id'], self.sandbox)
+
+
+    def load_responses(self):
+        """ Fetch the responses to the HIT if they haven't been fetched yet """
+        return self.load('responses')
+
+
+
+class HITJournal:
+    """Append-only record of the HITs created from each row of a survey csv.
+
+    Args:
+        path (str): JSON lines file the journal is saved to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.group_ids = set()
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.rows[entry['row']] = entry
+                        if entry['group_id']:
+                            self.group_ids.add(entry['group_id'])
+
+
+    def done(self, row_number, row):
+        """ Whether a HIT was already created for this row with the same videos """
+        entry = self.rows.get(row_number)
+        # Entries without a HIT id are retried so the HIT they made is looked up
+        return entry is not None and entry['hit_id'] is not None and entry['videos'] == row
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def hit_videos(self):
+        """ Video urls of each created HIT, by hit id """
+        return {entry['hit_id']: entry['videos'] for entry in self.rows.values() if entry['hit_id']}
+
+
+    def add(self, row_number, hit_id, group_id, row):
+        """ Record a created HIT, flushing it to disk right away """
+        entry = {'row': row_number, 'hit_id': hit_id, 'group_id': group_id, 'videos': row}
+        with self.lock:
+            self.rows[row_number] = entry
+            if group_id:
+                self.group_ids.add(group_id)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
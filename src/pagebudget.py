@@ -0,0 +1,197 @@
+import sys
+import gzip
+import time
+import threading
+import contextlib
+import urllib.request
+from html.parser import HTMLParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import click
+from src.survey import HTMLSurvey, TEMPLATES
+
+# Budgets of the rendered survey page
+BUDGET_KB = 20          # Gzipped html plus everything needed before the survey can be used
+BUDGET_TTI_MS = 1000    # Estimated time to interactive on SLOW_NETWORK
+BUDGET_BLOCKING = 0     # Scripts and stylesheets that hold up the first paint
+BUDGET_PLAYERS = 0      # Video players started when the page loads
+
+# Connection the time to interactive is estimated on (Lighthouse's mobile throttling)
+SLOW_NETWORK = {'rtt_ms': 150, 'kbps': 1638.4}
+
+# Round trips to set up a connection to a new origin (DNS, TCP and TLS) before its first request
+NEW_ORIGIN_ROUND_TRIPS = 3
+
+
+class PageResources(HTMLParser):
+    """Resources a page fetches while it loads, found by parsing its html.
+
+    Attributes:
+        blocking (list): Urls of scripts (without async/defer) and stylesheets.
+        deferred (list): Urls of scripts with async/defer.
+        players (list): Urls of iframes that load with the page.
+        inputs (int): Number of form inputs.
+    """
+    def __init__(self):
+        super().__init__()
+        self.blocking = []
+        self.deferred = []
+        self.players = []
+        self.inputs = 0
+
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "script" and attrs.get("src"):
+            deferred = "defer" in attrs or "async" in attrs or attrs.get("type") == "module"
+            (self.deferred if deferred else self.blocking).append(attrs["src"])
+        elif tag == "link" and attrs.get("rel") == "stylesheet" and attrs.get("href"):
+            self.blocking.append(attrs["href"])
+        elif tag == "iframe" and attrs.get("src") and attrs.get("loading") != "lazy":
+            self.players.append(attrs["src"])
+        elif tag == "input":
+            self.inputs += 1
+
+
+
+@contextlib.contextmanager
+def serve(html):
+    """ Serve html gzipped from a local web server, yields its url """
+    body = gzip.compress(html.encode("utf-8"))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/survey.html"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def fetch_size(url, timeout=5):
+    """ Bytes transferred to fetch a url (gzipped if the server supports it), None if it can't be fetched """
+    request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return len(response.read())
+    except (OSError, ValueError):
+        return None
+
+
+def measure(html, fetch_external=True):
+    """ Serve a rendered survey locally and measure what it takes to load
+
+    The time to interactive is estimated for SLOW_NETWORK: one round trip
+    and the transfer of the survey itself, then, if anything blocks the
+    page, a player starts with it or there are deferred scripts, the setup
+    of a connection to a new origin and the transfer of those resources
+    (loaded in parallel). Deferred scripts don't hold up the first paint,
+    but the survey can't be submitted until they've run, since
+    crowd-html-elements.js is what defines crowd-form.
+
+    Returns:
+        dict: Sizes, resource counts and timings of the page.
+    """
+    with serve(html) as url:
+        start = time.perf_counter()
+        request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+        with urllib.request.urlopen(request) as response:
+            transferred = response.read()
+        page = PageResources()
+        page.feed(gzip.decompress(transferred).decode("utf-8"))
+        page.close()
+        local_ms = 1000 * (time.perf_counter() - start)
+
+    critical = page.blocking + page.deferred + page.players
+    sizes = {url: fetch_size(url) if fetch_external else None for url in critical}
+    critical_bytes = sum(size for size in sizes.values() if size)
+    bytes_per_ms = SLOW_NETWORK['kbps'] * 1000 / 8 / 1000
+    tti_ms = SLOW_NETWORK['rtt_ms'] + len(transferred) / bytes_per_ms
+    if critical:
+        tti_ms += (NEW_ORIGIN_ROUND_TRIPS + 1) * SLOW_NETWORK['rtt_ms'] + critical_bytes / bytes_per_ms
+    return {
+        'html_bytes': len(html.encode("utf-8")),
+        'transfer_bytes': len(transferred),
+        'critical_bytes': critical_bytes,
+        'unmeasured': [url for url, size in sizes.items() if size is None],
+        'blocking': len(page.blocking),
+        'deferred': len(page.deferred),
+        'players': len(page.players),
+        'inputs': page.inputs,
+        'local_ms': local_ms,
+        'tti_ms': tti_ms,
+    }
+
+
+def render_survey(template, num_videos=5):
+    """ Sample survey html for a playlist of YouTube videos """
+    playlist = {'title': "Budget check", 'videos': [
+        {'url': f"https://www.youtube.com/embed/video{i:05d}"} for i in range(num_videos)]}
+    with contextlib.redirect_stdout(sys.stderr):
+        return HTMLSurvey(playlist, num_videos, 1, seed=0, template=template).sample_survey
+
+
+@click.command()
+@click.option("--template", "templates", multiple=True, type=click.Choice(list(TEMPLATES)),
+              help="Survey template to check (can be repeated), lite if not given.")
+@click.option("--videos", default=5, show_default=True, help="Videos per survey.")
+@click.option("--max-kb", default=BUDGET_KB, show_default=True,
+              help="Max KB transferred before the survey can be used.")
+@click.option("--max-tti", default=BUDGET_TTI_MS, show_default=True,
+              help="Max estimated milliseconds to interactive on a slow connection.")
+@click.option("--max-blocking", default=BUDGET_BLOCKING, show_default=True,
+              help="Max render blocking scripts and stylesheets.")
+@click.option("--max-players", default=BUDGET_PLAYERS, show_default=True,
+              help="Max video players loaded with the page.")
+@click.option("--fetch-external/--no-fetch-external", default=True, show_default=True,
+              help="Fetch the resources needed before the survey can be used to count their size. "
+                   "Resources that can't be fetched fail the check, --no-fetch-external skips the "
+                   "KB and time to interactive checks instead.")
+def main(templates, videos, max_kb, max_tti, max_blocking, max_players, fetch_external):
+    """ Check that a rendered survey page is light and quick to use """
+    over_budget = False
+    for template in templates or ["lite"]:
+        result = measure(render_survey(template, videos), fetch_external)
+        kb = (result['transfer_bytes'] + result['critical_bytes']) / 1000
+        print(f"{template}: {result['html_bytes'] / 1000:.1f} KB html, {result['transfer_bytes'] / 1000:.1f} KB "
+              f"gzipped, served and parsed locally in {result['local_ms']:.0f} ms ({result['inputs']} inputs)")
+        # Sizes and timings are only complete if every resource they depend on was fetched
+        measured = not result['unmeasured']
+        checks = [
+            ("KB before interactive", kb, max_kb, measured),
+            ("Estimated time to interactive (ms)", result['tti_ms'], max_tti, measured),
+            ("Render blocking requests", result['blocking'], max_blocking, True),
+            ("Video players loaded with the page", result['players'], max_players, True),
+        ]
+        for name, value, budget, complete in checks:
+            if complete:
+                ok = value <= budget
+                status = 'ok' if ok else 'OVER BUDGET'
+            elif fetch_external:
+                ok, status = False, 'UNMEASURED'
+            else:
+                ok, status = True, 'not checked'
+            over_budget |= not ok
+            print(f"  {name:<36} {value:>8.0f}  budget {budget:<6} {status}")
+        if result['unmeasured']:
+            print(f"  {'Couldn' if fetch_external else 'Didn'}'t fetch {len(result['unmeasured'])} resources, "
+                  "so the KB and time to interactive can't be checked:")
+            for url in result['unmeasured']:
+                print(f"    {url}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import os
+import uuid
+import sqlite3
+import datetime
+import threading
+from pathlib import Path
+from src.mturk import HIT_WORKERS
+from src.ratelimit import ContextThreadPoolExecutor, call_with_retries
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS actions (
+    token TEXT PRIMARY KEY,
+    action TEXT NOT NULL,
+    assignment_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    sandbox INTEGER NOT NULL,
+    amount TEXT,
+    reason TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    created TEXT,
+    updated TEXT,
+    UNIQUE (action, assignment_id)
+);
+CREATE INDEX IF NOT EXISTS actions_worker_id ON actions (worker_id);
+"""
+
+# Errors that mean an approve/reject already went through on an earlier run
+ALREADY_REVIEWED = "This operation can be called with a status of: Submitted"
+
+# Error that means a bonus was already paid on an earlier run, with the same request token
+ALREADY_PAID = "UniqueRequestToken"
+
+# Status an assignment has once each review action went through
+REVIEWED_STATUSES = {'approve': 'Approved', 'reject': 'Rejected'}
+
+
+class PaymentRules:
+    """Rules used to decide what to do with each submitted assignment.
+
+    Args:
+        min_work_seconds (float): Reject assignments submitted faster than this.
+        reject_straightlining (bool): Reject assignments that gave every
+            question of every video the same rating (failed attention check).
+        require_qualification (bool): Reject assignments from workers who
+            don't have the qualification.
+        bonus (float): Bonus in dollars for each approved assignment, 0 for none.
+        bonus_reason (str): Message sent to workers with the bonus.
+    """
+    def __init__(self, min_work_seconds=0, reject_straightlining=False, require_qualification=False,
+                 bonus=0.0, bonus_reason="Thank you for your careful ratings!"):
+        self.min_work_seconds = min_work_seconds
+        self.reject_straightlining = reject_straightlining
+        self.require_qualification = require_qualification
+        self.bonus = bonus
+        self.bonus_reason = bonus_reason
+
+
+    @classmethod
+    def from_config(cls, hit_config):
+        return cls(
+            min_work_seconds=hit_config["MIN_WORK_SECONDS"],
+            reject_straightlining=hit_config["REJECT_STRAIGHTLINING"],
+            require_qualification=hit_config["REQUIRE_QUALIFICATION"],
+            bonus=hit_config["BONUS"],
+            bonus_reason=hit_config["BONUS_REASON"],
+        )
+
+
+    def decide(self, assignment, ratings, qualified_workers=None):
+        """ Decide whether to approve or reject an assignment
+
+        Args:
+            assignment (dict): Row of the assignments table of the ResponseStore.
+            ratings (list): The ratings given in the assignment.
+            qualified_workers (set): Ids of workers with the qualification.
+
+        Returns:
+            tuple: (action, reason) where action is 'approve' or 'reject'.
+        """
+        if self.min_work_seconds and assignment['accept_time'] and assignment['submit_time']:
+            accepted = datetime.datetime.fromisoformat(assignment['accept_time'])
+            submitted = datetime.datetime.fromisoformat(assignment['submit_time'])
+            if (submitted - accepted).total_seconds() < self.min_work_seconds:
+                return 'reject', "The survey was submitted too quickly to have watched the videos."
+        if self.reject_straightlining and len(ratings) > 1 and len(set(ratings)) == 1:
+            return 'reject', "Every question was given the same rating."
+        if (self.require_qualification and qualified_workers is not None and
+                assignment['worker_id'] not in qualified_workers):
+            return 'reject', "The qualification survey was not passed."
+        return 'approve', None
+
+
+
+class PaymentLedger:
+    """Local record of every approve, reject and bonus sent to MTurk.
+
+    Each action gets a unique request token and is written to the ledger
+    before it is sent, then marked done once MTurk accepts it. Running the
+    same payout again skips finished actions and re-sends unfinished ones
+    with the same token, so nobody is paid twice.
+
+    Args:
+        path (str): Path of the SQLite ledger file.
+    """
+    def __init__(self, path):
+        Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(LEDGER_SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def plan(self, action, assignment_id, worker_id, sandbox, amount=None, reason=None):
+        """ Record an action to send, returns its row (existing row if already planned) """
+        now = datetime.datetime.utcnow().isoformat()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO actions VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', NULL, ?, ?)",
+                (uuid.uuid4().hex, action, assignment_id, worker_id, int(sandbox),
+                 None if amount is None else f"{amount:.2f}", reason, now, now))
+            return self.db.execute("SELECT * FROM actions WHERE action = ? AND assignment_id = ?",
+                                   (action, assignment_id)).fetchone()
+
+
+    def finish(self, token, error=None):
+        """ Mark an action as done, or failed with an error """
+        with self.lock, self.db:
+            self.db.execute("UPDATE actions SET status = ?, error = ?, updated = ? WHERE token = ?",
+                            ('failed' if error else 'done', error,
+                             datetime.datetime.utcnow().isoformat(), token))
+
+
+    def pending(self, sandbox=False):
+        """ Actions that haven't been confirmed by MTurk yet """
+        return self.db.execute("SELECT * FROM actions WHERE status != 'done' AND sandbox = ?",
+                               (int(sandbox),)).fetchall()
+
+
+    def totals(self, sandbox=False):
+        """ Number of finished actions and total bonus paid """
+        counts = dict(self.db.execute(
+            "SELECT action, COUNT(*) FROM actions WHERE status = 'done' AND sandbox = ? GROUP BY action",
+            (int(sandbox),)).fetchall())
+        bonus = self.db.execute(
+            "SELECT COALESCE(SUM(CAST(amount AS REAL)), 0) FROM actions "
+            "WHERE action = 'bonus' AND status = 'done' AND sandbox = ?", (int(sandbox),)).fetchone()[0]
+        return counts, bonus
+
+
+
+def review_assignments(store, rules, sandbox=False, qualified_workers=None):
+    """ Decide on every submitted assignment in the store, without recording anything
+
+    Returns:
+        list: (assignment row, action, reason) of each submitted assignment.
+    """
+    cursor = store.db.cursor()
+    cursor.row_factory = sqlite3.Row
+    assignments = cursor.execute(
+        "SELECT a.* FROM assignments a JOIN hits h ON a.hit_id = h.hit_id "
+        "WHERE a.status = 'Submitted' AND h.sandbox = ?", (int(sandbox),)).fetchall()
+    ratings = {}
+    for assignment_id, rating in store.db.execute(
+            "SELECT an.assignment_id, an.rating FROM answers an JOIN assignments a "
+            "ON an.assignment_id = a.assignment_id WHERE a.status = 'Submitted'"):
+        ratings.setdefault(assignment_id, []).append(rating)
+    return [(a, *rules.decide(a, ratings.get(a['assignment_id'], []), qualified_workers))
+            for a in assignments]
+
+
+def plan_payments(store, ledger, rules, sandbox=False, hit_ids=None, qualified_workers=None):
+    """ Decide on every submitted assignment in the store and record the actions in the ledger
+
+    An assignment that already has a decision in the ledger keeps it, so
+    changing the rules between runs never both approves and rejects it.
+
+    Args:
+        store (ResponseStore): Synced store of assignments and answers.
+        ledger (PaymentLedger): Ledger to record the actions in.
+        rules (PaymentRules): Rules to decide with.
+        sandbox (bool): Pay the sandbox assignments instead of the live ones.
+        hit_ids (set): Only review assignments of these HITs, e.g. the
+            survey HITs and not the qualification HITs.
+        qualified_workers (set): Ids of workers with the qualification.
+
+    Returns:
+        list: Ledger rows of the actions that still need to be sent.
+    """
+    decided = set(row[0] for row in ledger.db.execute(
+        "SELECT assignment_id FROM actions WHERE action IN ('approve', 'reject')"))
+
+    for a, action, reason in review_assignments(store, rules, sandbox, qualified_workers):
+        if (hit_ids is not None and a['hit_id'] not in hit_ids) or a['assignment_id'] in decided:
+            continue
+        ledger.plan(action, a['assignment_id'], a['worker_id'], sandbox, reason=reason)
+        if action == 'approve' and rules.bonus:
+            ledger.plan('bonus', a['assignment_id'], a['worker_id'], sandbox,
+                        amount=rules.bonus, reason=rules.bonus_reason)
+    return ledger.pending(sandbox)
+
+
+def send_payments(account, ledger, actions, limiter=None, sandbox=False):
+    """ Send planned actions to MTurk concurrently, recording each result in the ledger
+
+    Approvals and rejections are sent before bonuses, since a bonus can
+    only be paid on an approved assignment.
+
+    Returns:
+        dict: Number of actions that succeeded and failed (bonuses held back
+            for a failed approval are left pending for the next run).
+    """
+    from botocore.exceptions import ClientError
+    client = account.get_client(sandbox)
+
+    def send(row):
+        try:
+            if row['action'] == 'approve':
+                call_with_retries(client.approve_assignment, limiter=limiter,
+                                  AssignmentId=row['assignment_id'])
+            elif row['action'] == 'reject':
+                call_with_retries(client.reject_assignment, limiter=limiter,
+                                  AssignmentId=row['assignment_id'], RequesterFeedback=row['reason'])
+            elif row['action'] == 'bonus':
+                call_with_retries(client.send_bonus, limiter=limiter,
+                                  WorkerId=row['worker_id'], AssignmentId=row['assignment_id'],
+                                  BonusAmount=row['amount'], Reason=row['reason'],
+                                  UniqueRequestToken=row['token'])
+        except ClientError as e:
+            error = str(e)
+            # Sent on an earlier run that crashed before saving to the ledger
+            if row['action'] == 'bonus' and ALREADY_PAID in error:
+                ledger.finish(row['token'])
+                return True
+            # Only counts as done if it was reviewed the same way, not e.g. rejected elsewhere
+            if row['action'] != 'bonus' and ALREADY_REVIEWED in error:
+                try:
+                    status = call_with_retries(client.get_assignment, limiter=limiter,
+                                               AssignmentId=row['assignment_id'])['Assignment']['AssignmentStatus']
+                except ClientError as lookup_error:
+                    status, error = None, f"{error} ({lookup_error})"
+                if status == REVIEWED_STATUSES[row['action']]:
+                    ledger.finish(row['token'])
+                    return True
+                if status is not None:
+                    error = f"The assignment was already {status}"
+            ledger.finish(row['token'], error)
+            return False
+        ledger.finish(row['token'])
+        return True
+
+    with ContextThreadPoolExecutor(max_workers=HIT_WORKERS) as executor:
+        results = list(executor.map(send, [row for row in actions if row['action'] != 'bonus']))
+        # Bonuses wait for their approval to go through, on this run or a later one
+        approved = set(row[0] for row in ledger.db.execute(
+            "SELECT assignment_id FROM actions WHERE action = 'approve' AND status = 'done'"))
+        results += executor.map(send, [row for row in actions
+                                       if row['action'] == 'bonus' and row['assignment_id'] in approved])
+    return {'succeeded': results.count(True), 'failed': results.count(False)}
@@ -0,0 +1,186 @@
+import sys
+import datetime
+import traceback
+import contextlib
+from src.design import design_size, estimate_cost
+from src.mturk import HITJournal
+from src.store import ResponseStore
+from src.survey import HTMLSurvey
+from src.ratelimit import ContextThreadPoolExecutor
+
+# Stages of the pipeline in the order they run
+STAGES = ["playlists", "surveys", "hits", "collect", "export"]
+
+
+class Pipeline:
+    """Runs the CLI's steps end to end without prompts.
+
+    Results of each stage are kept in memory and handed to the next one
+    (e.g. the playlists are listed once and used to build both surveys),
+    and the HIT stages for the sandbox and live site run at the same time.
+    Progress messages go to stderr, the results are returned as a dict
+    that can be printed as JSON.
+
+    Args:
+        cli (CLI): Interactive CLI whose config, accounts and files are used.
+    """
+    def __init__(self, cli):
+        self.cli = cli
+        self.config = cli.config
+        self.playlists = {}
+
+
+    def run(self, stages=STAGES, modes=(True,), qualification=False):
+        """ Run the given stages, for each of the modes (True for the sandbox, False for live)
+
+        Args:
+            stages (list): Stages to run (see STAGES).
+            modes (list): Run the HIT stages in the sandbox (True) and/or live (False).
+            qualification (bool): Create qualification HITs instead of survey HITs.
+
+        Returns:
+            dict: Results of each stage, with an 'error' entry for stages that failed.
+        """
+        results = {
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'stages': [stage for stage in STAGES if stage in stages],
+        }
+        # Progress messages of the stages would mix with the JSON on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            ok = True
+            if "playlists" in stages or "surveys" in stages:
+                ok = self.stage(results, "playlists", self.load_playlists)
+            if "surveys" in stages and ok:
+                self.stage(results, "surveys", self.create_surveys)
+            if "hits" in stages or "collect" in stages or "export" in stages:
+                with ContextThreadPoolExecutor(max_workers=len(modes)) as executor:
+                    runs = {mode_name(sandbox): executor.submit(self.run_mode, stages, sandbox, qualification)
+                            for sandbox in modes}
+                    for name, future in runs.items():
+                        results[name] = future.result()
+
+        api_usage = self.cli.api_metrics.to_dict()['operations']
+        results['api_calls'] = {operation: stats['calls'] for operation, stats in api_usage.items()}
+        results['youtube_quota'] = self.cli.api_metrics.quota_used()
+        results['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+        results['ok'] = not has_errors(results)
+        return results
+
+
+    def stage(self, results, name, func, *args, label=None):
+        """ Run one stage, saving its result or error under its name. Returns whether it succeeded """
+        label = label or name
+        print(f"[{label}] starting")
+        try:
+            results[name] = func(*args)
+        except Exception as e:
+            traceback.print_exc()
+            results[name] = {'error': f"{type(e).__name__}: {e}"}
+            print(f"[{label}] failed")
+            return False
+        print(f"[{label}] done")
+        return True
+
+
+    def run_mode(self, stages, sandbox, qualification):
+        """ Run the HIT stages for the sandbox or the live site """
+        results = {}
+        name = mode_name(sandbox)
+        ok = True
+        if "hits" in stages:
+            ok = self.stage(results, "hits", self.create_hits, sandbox, qualification, label=f"{name} hits")
+        if "collect" in stages and ok:
+            ok = self.stage(results, "collect", self.collect, sandbox, label=f"{name} collect")
+        if "export" in stages and ok:
+            self.stage(results, "export", self.export, sandbox, label=f"{name} export")
+        return results
+
+
+    def load_playlists(self):
+        """ Find the survey and qualification playlists with one listing of the account's playlists """
+        survey_config = self.config["SURVEY"]
+        titles = {'survey': survey_config["SURVEY_PLAYLIST"],
+                  'qualification': survey_config["QUALIFICATION_PLAYLIST"]}
+        found = self.cli.youtube_account.find_playlists(list(titles.values()))
+        results = {}
+        for kind, title in titles.items():
+            if found[title] is None:
+                raise LookupError(f"Could not find the {kind} playlist '{title}' in your YouTube account")
+            self.playlists[kind] = found[title]
+            results[kind] = {'title': title, 'id': found[title]['id'], 'videos': len(found[title]['videos'])}
+        return results
+
+
+    def create_surveys(self):
+        """ Create the survey and qualification survey files from the loaded playlists """
+        survey_config = self.config["SURVEY"]
+        ratings_per_video = survey_config["RATINGS_PER_VIDEO"]
+        results = {}
+        for kind, files, num_videos in [
+                ('qualification', self.cli.qual_survey_files, survey_config["QUALIFICATION_VIDEOS"]),
+                ('survey', self.cli.survey_files, survey_config["SURVEY_VIDEOS"])]:
+            playlist = self.playlists[kind]
+            survey = HTMLSurvey(playlist, num_videos, ratings_per_video, survey_config["SEED"],
+                                survey_config["CSV_SHARD_ROWS"], survey_config["TEMPLATE"])
+            survey.save_survey(*files)
+            num_surveys = design_size(len(playlist['videos']), num_videos, ratings_per_video)
+            results[kind] = {
+                'surveys': num_surveys,
+                'estimated_cost': round(estimate_cost(num_surveys, self.config["MTURK"]["MAX_ASSIGNMENTS"],
+                                                      self.config["MTURK"]["REWARD"]), 2),
+                'html': files[0],
+                'csv': files[2],
+            }
+        return results
+
+
+    def create_hits(self, sandbox, qualification=False):
+        """ Create a HIT for each row of the survey (or qualification survey) csv that doesn't have one """
+        hit_config = self.config["MTURK"]
+        files = self.cli.qual_survey_files if qualification else self.cli.survey_files
+        journal_file = self.cli.hit_journal_file(sandbox, qualification)
+        qualification_type_id = None
+        if not qualification and hit_config["REQUIRE_QUALIFICATION"]:
+            qualification_type_id = self.cli.mturk_account.get_qualification_type(
+                hit_config["QUALIFICATION_NAME"], sandbox)
+            if qualification_type_id is None:
+                raise LookupError("No workers have been qualified yet, grade the qualification HITs first "
+                                  "(or set REQUIRE_QUALIFICATION to False in config.yml)")
+        created = self.cli.mturk_account.create_hits_from_csv(
+            hit_config, files[0], files[2], journal_file, sandbox=sandbox,
+            qualification_type_id=qualification_type_id)
+        return {'created': created, 'total': len(HITJournal(journal_file)), 'journal': journal_file}
+
+
+    def collect(self, sandbox):
+        """ Sync new assignments into the response store and summarize them """
+        store = ResponseStore(self.cli.response_store_file)
+        try:
+            changes = store.sync(self.cli.mturk_account, sandbox, self.cli.hit_journal_file(sandbox))
+            return dict(changes, **store.summary(sandbox))
+        finally:
+            store.close()
+
+
+    def export(self, sandbox):
+        """ Append the ratings collected since the last export to the columnar export """
+        from src.export import RatingExport
+        export = RatingExport(self.cli.rating_export_dir(sandbox))
+        store = ResponseStore(self.cli.response_store_file)
+        try:
+            appended = export.append(store, sandbox)
+        finally:
+            store.close()
+        return {'appended': appended, 'ratings': export.meta['rows'], 'directory': export.directory}
+
+
+
+def mode_name(sandbox):
+    return "sandbox" if sandbox else "live"
+
+
+def has_errors(results):
+    """ Whether any stage in the (nested) results failed """
+    if isinstance(results, dict):
+        return 'error' in results or any(has_errors(value) for value in results.values())
+    return False
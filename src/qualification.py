@@ -0,0 +1,70 @@
+import csv
+from src.answers import decode_assignments
+from src.mturk import HIT_WORKERS, HITJournal
+from src.survey import question_name
+from src.ratelimit import ContextThreadPoolExecutor
+
+
+def load_gold(gold_file):
+    """ Load the gold standard ratings of the qualification videos
+
+    The csv needs video_url, question and rating columns. Questions can be
+    given by title (e.g. Depth Perception) or input name (depth_perception).
+
+    Returns:
+        dict: Gold rating by (video url, question name).
+    """
+    gold = {}
+    with open(gold_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            gold[(row['video_url'].strip(), question_name(row['question'].strip()))] = int(row['rating'])
+    return gold
+
+
+def grade_assignments(assignments, hit_videos, gold, tolerance=1):
+    """ Score each assignment against the gold standard ratings
+
+    Args:
+        assignments (list): Raw MTurk assignments of qualification HITs.
+        hit_videos (dict): Row of video urls of each HIT (see HITJournal.hit_videos).
+        gold (dict): Gold rating by (video url, question name).
+        tolerance (int): Max difference from the gold rating that still counts as correct.
+
+    Returns:
+        dict: {'worker_id', 'correct', 'graded'} of each assignment id.
+    """
+    grades = {a['AssignmentId']: {'worker_id': a['WorkerId'], 'correct': 0, 'graded': 0}
+              for a in assignments}
+    for assignment_id, hit_id, worker_id, position, question, rating in decode_assignments(assignments):
+        video_url = hit_videos.get(hit_id, {}).get(f"video_url_{position}")
+        expected = gold.get((video_url, question))
+        if expected is None:
+            continue
+        grade = grades[assignment_id]
+        grade['graded'] += 1
+        grade['correct'] += abs(rating - expected) <= tolerance
+    return grades
+
+
+def score_workers(grades):
+    """ Fraction of gold ratings each worker got right, over all their assignments """
+    totals = {}
+    for grade in grades.values():
+        correct, graded = totals.get(grade['worker_id'], (0, 0))
+        totals[grade['worker_id']] = (correct + grade['correct'], graded + grade['graded'])
+    return {worker_id: correct / graded for worker_id, (correct, graded) in totals.items() if graded}
+
+
+def grade_qualifications(account, journal_file, gold_file, tolerance=1, sandbox=False):
+    """ Grade every submitted (not yet reviewed) assignment of the qualification HITs
+
+    Returns:
+        tuple: (grades, worker_scores) from grade_assignments and score_workers.
+    """
+    hit_videos = HITJournal(journal_file).hit_videos()
+    with ContextThreadPoolExecutor(max_workers=HIT_WORKERS) as executor:
+        per_hit = executor.map(lambda hit_id: account.get_assignments(hit_id, sandbox, ['Submitted']),
+                               hit_videos)
+        assignments = [a for hit_assignments in per_hit for a in hit_assignments]
+    grades = grade_assignments(assignments, hit_videos, load_gold(gold_file), tolerance)
+    return grades, score_workers(grades)
@@ -0,0 +1,132 @@
+import sys
+import json
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Error codes MTurk returns when requests are being throttled
+THROTTLING_ERRORS = ["ThrottlingException", "Throttling", "TooManyRequestsException"]
+
+# Reasons of the 403 errors YouTube returns when requests are being throttled
+YOUTUBE_THROTTLING_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Attempt of the call being made by call_with_retries, 0 for the first attempt
+RETRY_ATTEMPT = contextvars.ContextVar("retry_attempt", default=0)
+
+
+class RateLimiter:
+    """Token bucket rate limiter that can be shared between threads.
+
+    Args:
+        rate (float): Number of requests allowed per second on average.
+        burst (int): Max number of requests allowed at once after being idle.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """ Block until a request is allowed """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that runs each task in a copy of the context it was submitted from.
+
+    Keeps context variables, like the command API calls are attributed to
+    (see ApiMetrics.command), set on the worker threads.
+    """
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def loaded_class(module, name):
+    """ A class of a module that has already been imported, or None
+
+    An error can only be an instance of a library's exception class once
+    the library has been imported, so checking for one never needs to
+    import it (e.g. botocore on YouTube-only paths).
+    """
+    return getattr(sys.modules.get(module), name, None)
+
+
+def is_throttled(error):
+    """ Whether a boto3 or YouTube API error is due to throttling """
+    ClientError = loaded_class("botocore.exceptions", "ClientError")
+    if ClientError is not None and isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+    HttpError = loaded_class("googleapiclient.errors", "HttpError")
+    if HttpError is None or not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    try:
+        reasons = [e.get('reason') for e in json.loads(error.content)['error']['errors']]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        reasons = []
+    return error.resp.status == 403 and any(reason in YOUTUBE_THROTTLING_REASONS for reason in reasons)
+
+
+def call_with_retries(func, limiter=None, max_retries=8, base_delay=0.5, max_delay=30, **kwargs):
+    """ Call an API function, retrying throttling errors with jittered backoff
+
+    Args:
+        func (callable): boto3 client method or YouTube request's execute
+            method to call with kwargs.
+        limiter (RateLimiter): Optional rate limiter to wait on before each attempt.
+        max_retries (int): Number of retries before the error is re-raised.
+        base_delay (float): Seconds of the first backoff, doubled on each retry.
+        max_delay (float): Max seconds to back off for.
+    """
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        token = RETRY_ATTEMPT.set(attempt)
+        try:
+            return func(**kwargs)
+        except Exception as e:
+            if not is_throttled(e) or attempt == max_retries:
+                raise
+        finally:
+            RETRY_ATTEMPT.reset(token)
+        time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+def call_many(func, calls, limiter=None, max_workers=8):
+    """ Make many API calls concurrently, retrying throttling errors
+
+    Args:
+        func (callable): boto3 client method.
+        calls (list): kwargs of each call.
+        limiter (RateLimiter): Optional rate limiter shared by all calls.
+        max_workers (int): Number of calls in flight at once.
+
+    Returns:
+        list: (kwargs, response, error) of each call, error is None if it succeeded.
+    """
+    from botocore.exceptions import ClientError
+
+    def call(kwargs):
+        try:
+            return kwargs, call_with_retries(func, limiter=limiter, **kwargs), None
+        except ClientError as e:
+            return kwargs, None, e
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, calls))
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import select
+import statistics
+import subprocess
+import click
+
+# The CLI should show its menu within this many milliseconds of starting, on
+# a machine where a bare Python interpreter starts within INTERPRETER_MS
+BUDGET_MS = 150
+INTERPRETER_MS = 30
+
+# Number of timed starts, enough for the median to be steady on a busy machine
+RUNS = 15
+
+# Text the CLI prints once the menu is ready for input
+PROMPT_TEXT = b"Options (enter the letter"
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_to_prompt(timeout=10, bare=False):
+    """ Seconds from starting `python main.py` until it prints its menu
+
+    With bare=True, times a Python interpreter that only prints the menu's
+    prompt instead, i.e. the part of the startup main.py has no control over.
+    """
+    start = time.perf_counter()
+    args = ["-c", f"print({PROMPT_TEXT.decode()!r})"] if bare else ["main.py"]
+    process = subprocess.Popen([sys.executable, *args], cwd=ROOT_DIR, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = b""
+    try:
+        while PROMPT_TEXT not in output:
+            remaining = timeout - (time.perf_counter() - start)
+            if remaining <= 0 or not select.select([process.stdout], [], [], remaining)[0]:
+                raise TimeoutError(f"The CLI didn't show its menu within {timeout}s")
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                raise RuntimeError(f"The CLI exited before showing its menu:\n{output.decode()}")
+            output += chunk
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def slowest_imports(count=10):
+    """ Modules that take the longest to import with main.py, from python -X importtime """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            imports.append((int(cumulative) / 1000, name.rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+@click.command()
+@click.option("--budget", default=BUDGET_MS, show_default=True, help="Max milliseconds to reach the menu.")
+@click.option("--interpreter", default=INTERPRETER_MS, show_default=True,
+              help="Milliseconds of the budget a bare Python start is expected to take.")
+@click.option("--runs", default=RUNS, show_default=True, help="Number of times to start the CLI.")
+def main(budget, interpreter, runs):
+    """ Check that `python main.py` shows its menu within the startup budget
+
+    The first start isn't timed, since it also compiles and caches the
+    modules. Each timed start of the CLI is paired with a bare interpreter
+    start, and the check is on the median time the CLI adds to it, so a
+    slow or busy machine doesn't fail the check by itself.
+    """
+    time_to_prompt()
+    times, bare_times = [], []
+    for _ in range(runs):
+        bare_times.append(time_to_prompt(bare=True) * 1000)
+        times.append(time_to_prompt() * 1000)
+    median, bare_median = statistics.median(times), statistics.median(bare_times)
+    added = median - bare_median
+    print(f"Time to menu: {median:.0f} ms median of {runs} runs "
+          f"(min {min(times):.0f} ms, max {max(times):.0f} ms)")
+    print(f"Bare Python start: {bare_median:.0f} ms median, main.py adds {added:.0f} ms "
+          f"of its {budget - interpreter} ms share of the {budget} ms budget")
+    print("Slowest imports of main.py (cumulative):")
+    for ms, name in slowest_imports():
+        print(f"  {ms:>7.1f} ms  {name}")
+    if added > budget - interpreter:
+        print("Over budget, import heavy libraries where they're first needed instead of at startup")
+        sys.exit(1)
+    print("Within budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import time
+import threading
+import contextvars
+
+
+class StatusCache:
+    """Caches the results of slow status checks and refreshes them in the background.
+
+    Each check is a function with no arguments. Reading a check never blocks:
+    it returns the last known value and, if that value is older than the
+    check's TTL, starts a background refresh so the next read is up to date.
+
+    Args:
+        default_ttl (float): Seconds a result stays fresh if no TTL is given
+            when registering a check.
+    """
+    def __init__(self, default_ttl=60):
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.checks = {}
+
+
+    def register(self, name, check, ttl=None):
+        """ Register a check function under a name """
+        with self.lock:
+            self.checks[name] = {
+                'check': check,
+                'ttl': self.default_ttl if ttl is None else ttl,
+                'value': None,
+                'updated': None,
+                'running': False,
+                'error': None,
+                'generation': 0,
+            }
+
+
+    def get(self, name):
+        """ Get the last known value of a check
+
+        Returns:
+            tuple: (value, stale). value is None if the check has never
+                finished. stale is True if the value is missing, expired or
+                currently being refreshed.
+        """
+        with self.lock:
+            entry = self.checks[name]
+            expired = (entry['updated'] is None or
+                       time.monotonic() - entry['updated'] > entry['ttl'])
+            value, running = entry['value'], entry['running']
+        if expired and not running:
+            self.refresh(name)
+        return value, expired or running
+
+
+    def refresh(self, name):
+        """ Start a background refresh of a check unless one is already running """
+        with self.lock:
+            entry = self.checks[name]
+            if entry['running']:
+                return
+            entry['running'] = True
+        # Run in a new context, so API calls of the check aren't attributed to the current command
+        threading.Thread(target=contextvars.Context().run, args=(self._run, name), daemon=True).start()
+
+
+    def refresh_all(self):
+        """ Start a background refresh of every check """
+        for name in list(self.checks):
+            self.refresh(name)
+
+
+    def invalidate(self, *names):
+        """ Mark checks as expired and refresh them (all checks if no names given) """
+        names = names or list(self.checks)
+        with self.lock:
+            for name in names:
+                self.checks[name]['updated'] = None
+                self.checks[name]['generation'] += 1
+        for name in names:
+            self.refresh(name)
+
+
+    def wait(self, timeout=None):
+        """ Block until no refreshes are running or the timeout passes """
+        start = time.monotonic()
+        while any(entry['running'] for entry in self.checks.values()):
+            if timeout is not None and time.monotonic() - start > timeout:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+    def _run(self, name):
+        entry = self.checks[name]
+        while True:
+            generation = entry['generation']
+            try:
+                value = entry['check']()
+            except Exception as e:
+                # Keep the old value around, it will be retried on the next read
+                with self.lock:
+                    entry['error'] = e
+                    entry['running'] = False
+                return
+            with self.lock:
+                entry['value'] = value
+                entry['error'] = None
+                # Run again if the check was invalidated while it was running
+                if entry['generation'] != generation:
+                    continue
+                entry['updated'] = time.monotonic()
+                entry['running'] = False
+                return
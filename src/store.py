@@ -0,0 +1,209 @@
+import re
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from src.mturk import HIT_WORKERS
+from src.answers import decode_assignments
+from src.ratelimit import ContextThreadPoolExecutor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hits (
+    hit_id TEXT PRIMARY KEY,
+    sandbox INTEGER NOT NULL,
+    group_id TEXT,
+    title TEXT,
+    status TEXT,
+    review_status TEXT,
+    max_assignments INTEGER,
+    available INTEGER,
+    pending INTEGER,
+    completed INTEGER,
+    creation_time TEXT,
+    expiration TEXT
+);
+CREATE TABLE IF NOT EXISTS hit_videos (
+    hit_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    video_url TEXT NOT NULL,
+    PRIMARY KEY (hit_id, position)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    first_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    assignment_id TEXT PRIMARY KEY,
+    hit_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    status TEXT,
+    accept_time TEXT,
+    submit_time TEXT,
+    approval_time TEXT,
+    rejection_time TEXT,
+    answer TEXT
+);
+CREATE TABLE IF NOT EXISTS answers (
+    assignment_id TEXT NOT NULL,
+    hit_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    video_url TEXT,
+    question TEXT NOT NULL,
+    rating INTEGER,
+    PRIMARY KEY (assignment_id, position, question)
+);
+CREATE INDEX IF NOT EXISTS hit_videos_video_url ON hit_videos (video_url);
+CREATE INDEX IF NOT EXISTS assignments_hit_id ON assignments (hit_id);
+CREATE INDEX IF NOT EXISTS assignments_worker_id ON assignments (worker_id);
+CREATE INDEX IF NOT EXISTS answers_hit_id ON answers (hit_id);
+CREATE INDEX IF NOT EXISTS answers_worker_id ON answers (worker_id);
+CREATE INDEX IF NOT EXISTS answers_video_url ON answers (video_url);
+"""
+
+
+class ResponseStore:
+    """Local SQLite copy of HITs, assignments, workers and answers.
+
+    Syncing only fetches the assignments of HITs whose counts or status
+    changed since the last sync, so reports can be made from local queries
+    and API traffic grows with new work rather than the full history.
+
+    Args:
+        path (str): Path of the SQLite database file.
+    """
+    def __init__(self, path):
+        Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def sync(self, account, sandbox=False, journal_file=None):
+        """ Update the store with any new or changed HITs and assignments
+
+        Args:
+            account (MTurkAccount): Account to fetch from.
+            sandbox (bool): Sync the sandbox HITs instead of the live ones.
+            journal_file (str): Optional journal of created HITs (see
+                MTurkAccount.create_hits_from_csv), used to map each HIT's
+                answers to video urls.
+
+        Returns:
+            dict: Number of changed HITs and new assignments.
+        """
+        if journal_file and os.path.isfile(journal_file):
+            self.add_hit_videos(journal_file)
+
+        # Find HITs that are new or changed since the last sync
+        stored = {row[0]: row[1:] for row in self.db.execute(
+            "SELECT hit_id, status, review_status, available, pending, completed FROM hits")}
+        changed = []
+        for hit in account.list_all_hits(sandbox):
+            fingerprint = (hit['HITStatus'], hit.get('HITReviewStatus'),
+                           hit['NumberOfAssignmentsAvailable'],
+                           hit['NumberOfAssignmentsPending'],
+                           hit['NumberOfAssignmentsCompleted'])
+            if stored.get(hit['HITId']) != fingerprint:
+                changed.append(hit)
+
+        # Fetch the assignments of changed HITs concurrently
+        def fetch(hit):
+            return hit, account.get_assignments(hit['HITId'], sandbox)
+        with ContextThreadPoolExecutor(max_workers=HIT_WORKERS) as executor:
+            results = list(executor.map(fetch, changed))
+
+        new_assignments = []
+        with self.lock, self.db:
+            known = set(row[0] for row in self.db.execute("SELECT assignment_id FROM assignments"))
+            for hit, assignments in results:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (hit['HITId'], int(sandbox), hit.get('HITGroupId'), hit.get('Title'),
+                     hit['HITStatus'], hit.get('HITReviewStatus'), hit.get('MaxAssignments'),
+                     hit['NumberOfAssignmentsAvailable'], hit['NumberOfAssignmentsPending'],
+                     hit['NumberOfAssignmentsCompleted'], str(hit.get('CreationTime')),
+                     str(hit.get('Expiration'))))
+                for a in assignments:
+                    if a['AssignmentId'] in known:
+                        # Only the review status of stored assignments can change
+                        self.db.execute(
+                            "UPDATE assignments SET status = ?, approval_time = ?, rejection_time = ? "
+                            "WHERE assignment_id = ?",
+                            (a['AssignmentStatus'], timestamp(a, 'ApprovalTime'),
+                             timestamp(a, 'RejectionTime'), a['AssignmentId']))
+                        continue
+                    new_assignments.append(a)
+            self.add_assignments(new_assignments)
+
+        return {'changed_hits': len(changed), 'new_assignments': len(new_assignments)}
+
+
+    def add_assignments(self, assignments):
+        """ Insert new assignments along with their workers and decoded answers """
+        self.db.executemany("INSERT OR IGNORE INTO workers VALUES (?, ?)",
+                            [(a['WorkerId'], timestamp(a, 'SubmitTime')) for a in assignments])
+        self.db.executemany(
+            "INSERT INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(a['AssignmentId'], a['HITId'], a['WorkerId'], a['AssignmentStatus'],
+              timestamp(a, 'AcceptTime'), timestamp(a, 'SubmitTime'),
+              timestamp(a, 'ApprovalTime'), timestamp(a, 'RejectionTime'), a['Answer'])
+             for a in assignments])
+        self.db.executemany(
+            "INSERT OR REPLACE INTO answers SELECT ?1, ?2, ?3, ?4, "
+            "(SELECT video_url FROM hit_videos WHERE hit_id = ?2 AND position = ?4), ?5, ?6",
+            decode_assignments(assignments))
+
+
+    def add_hit_videos(self, journal_file):
+        """ Record which video is in each position of each HIT from a HIT journal """
+        rows = []
+        with open(journal_file, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['hit_id'] is None:
+                    continue
+                for column, url in entry['videos'].items():
+                    match = re.match(r"^video_url_(\d+)$", column)
+                    if match:
+                        rows.append((entry['hit_id'], int(match.group(1)), url))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO hit_videos VALUES (?, ?, ?)", rows)
+            # Fill in answers that were stored before their HIT's videos were known
+            self.db.execute(
+                "UPDATE answers SET video_url = (SELECT video_url FROM hit_videos "
+                "WHERE hit_videos.hit_id = answers.hit_id AND hit_videos.position = answers.position) "
+                "WHERE video_url IS NULL")
+
+
+    def summary(self, sandbox=False):
+        """ Counts of HITs, assignments and ratings by status """
+        sandbox = int(sandbox)
+        return {
+            'hits': dict(self.db.execute(
+                "SELECT status, COUNT(*) FROM hits WHERE sandbox = ? GROUP BY status", (sandbox,))),
+            'assignments': dict(self.db.execute(
+                "SELECT a.status, COUNT(*) FROM assignments a JOIN hits h ON a.hit_id = h.hit_id "
+                "WHERE h.sandbox = ? GROUP BY a.status", (sandbox,))),
+            'workers': self.db.execute(
+                "SELECT COUNT(DISTINCT a.worker_id) FROM assignments a JOIN hits h ON a.hit_id = h.hit_id "
+                "WHERE h.sandbox = ?", (sandbox,)).fetchone()[0],
+            'ratings': self.db.execute(
+                "SELECT COUNT(*) FROM answers a JOIN hits h ON a.hit_id = h.hit_id "
+                "WHERE h.sandbox = ?", (sandbox,)).fetchone()[0],
+        }
+
+
+
+def timestamp(assignment, key):
+    """ Assignment time as a string, or None """
+    value = assignment.get(key)
+    return None if value is None else str(value)
@@ -1,10 +1,76 @@
 import os
-import jinja2
-import itertools
+import re
+import functools
+from pathlib import Path
 import src.utils as utils
+from src.design import create_design
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Compiled templates are also cached on disk so new runs skip parsing
+BYTECODE_CACHE_DIR = os.path.join(os.getcwd(), ".cache", "jinja")
+
+# Survey page templates, 'lite' inlines its styles and only loads a video player once it's clicked
+TEMPLATES = {
+    'lite': "survey_template_lite.html",
+    'bootstrap': "survey_template.html",
+}
+
+# Blocks whose whitespace matters, minified separately from the markup around them
+RAW_BLOCK = re.compile(r"<(script|style|pre|textarea)\b[^>]*>.*?</\1\s*>", re.S | re.I)
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(name):
+    """ Load and compile a template once per process """
+    import jinja2
+    Path(BYTECODE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR),
+    )
+    return env.get_template(name)
+
+
+def question_name(title):
+    """ Name of a question's inputs in the survey, e.g. 'depth_perception' """
+    return title.lower().replace(' ', '_')
+
+
+def minify_html(html):
+    """ Strip comments and collapse whitespace, to keep the HTMLQuestion payload small """
+    def markup(text):
+        text = re.sub(r"<!--(?!\[if).*?-->", "", text, flags=re.S)
+        # A space between tags can show on the page, so runs of whitespace are only shortened
+        return re.sub(r"\s+", " ", text)
+
+    def raw(block):
+        start = block.index(">") + 1
+        block = re.sub(r"\s+", " ", block[:start]) + block[start:]
+        if block[1:6].lower() == "style":
+            end = block.rindex("<")
+            css = re.sub(r"/\*.*?\*/", "", block[start:end], flags=re.S)
+            css = re.sub(r"\s+", " ", css).strip()
+            # Spaces around : and > change what a selector matches, so they're only dropped in declarations
+            css = re.sub(r"\{[^{}]*\}", lambda m: re.sub(r"\s*([{};:,])\s*", r"\1", m.group(0)), css)
+            return block[:start] + re.sub(r"\s*([{},])\s*", r"\1", css) + block[end:]
+        if block[1:7].lower() == "script":
+            # Lines are kept, since scripts may rely on automatic semicolons
+            return "\n".join(line.strip() for line in block.splitlines() if line.strip())
+        return block
+
+    parts = []
+    position = 0
+    for match in RAW_BLOCK.finditer(html):
+        parts.append(markup(html[position:match.start()]))
+        parts.append(raw(match.group(0)))
+        position = match.end()
+    parts.append(markup(html[position:]))
+    return "".join(parts).strip()
+
 
 class HTMLSurvey:
-    def __init__(self, playlist, num_videos):
+    def __init__(self, playlist, num_videos, ratings_per_video, seed=None, shard_rows=None, template="lite"):
         # Make sure the videos in playlist fit in the survey
         if len(playlist['videos']) < num_videos:
             raise ValueError(f"Your playlist '{playlist['title']}' only has "
@@ -12,51 +78,70 @@ class HTMLSurvey:
                 "per survey\n Please try again and choose a number <= "
                 f"{len(playlist['videos'])}\n")
 
+        if template not in TEMPLATES:
+            raise ValueError(f"Unknown survey template '{template}', use one of: {', '.join(TEMPLATES)}")
+        self.template = template
+
         # Create text for all files
         self.survey = self.create_survey(num_videos)
         self.sample_survey = self.create_sample_survey(playlist, num_videos)
-        self.csv_file = self.create_csv(playlist, num_videos)
+        self.playlist = playlist
+        self.num_videos = num_videos
+        self.ratings_per_video = ratings_per_video
+        self.seed = seed
+        self.shard_rows = shard_rows
+
 
+    def create_survey(self, num_videos, video_urls=None):
+        """ Create html of the survey
 
-    def create_survey(self, num_videos):
-        """ Create html of the survey """
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.abspath(__file__))))
-        template = env.get_template("survey_template.html")
-        return template.render(
+        Without video_urls, the videos are ${video_url_N} placeholders to be
+        filled in by mechanical turk from the csv file. The html is minified
+        since it's sent with every HIT.
+        """
+        return minify_html(get_template(TEMPLATES[self.template]).render(
             num_videos=num_videos,
             questions=self.get_questions(),
-        )
+            video_urls=video_urls,
+        ))
 
 
     def create_sample_survey(self, playlist, num_videos):
         """ Create sample html for a single survey """
-        sample_survey = self.create_survey(num_videos)
-        for i in range(num_videos):
-            sample_survey = sample_survey.replace(f"${{video_url_{i}}}", playlist['videos'][i]["url"])
-        return sample_survey
+        video_urls = [vid["url"] for vid in playlist['videos'][:num_videos]]
+        return self.create_survey(num_videos, video_urls)
+
+
+    def create_csv(self, playlist, num_videos, ratings_per_video, seed=None):
+        """ Create the header and rows of the csv file to upload to mechanical turk
 
+        Each row is one survey, with each video appearing in ratings_per_video
+        rows (see design.create_design). Rows are generated lazily.
 
-    def create_csv(self, playlist, num_videos):
-        """ Create the accompanying csv file to upload to mechanical turk """
+        Returns:
+            tuple: (header, rows) where rows is a generator of tuples of urls.
+        """
         video_urls = [vid['url'] for vid in playlist['videos']]
-        vid_combinations = itertools.combinations(video_urls, num_videos)
-        csv_text = ",".join([f"video_url_{i}" for i in range(num_videos)])
-        for vids in vid_combinations:
-            csv_text += "\n" + ",".join(vids)
-        return csv_text
+        header = [f"video_url_{i}" for i in range(num_videos)]
+        return header, create_design(video_urls, num_videos, ratings_per_video, seed)
 
 
     def save_survey(self, survey_file, sample_survey_file, csv_file):
         """ Save out survey and accompanying csv along with a sample survey """
         utils.save_text(survey_file, self.survey)
         utils.save_text(sample_survey_file, self.sample_survey)
-        utils.save_text(csv_file, self.csv_file)
+        header, rows = self.create_csv(self.playlist, self.num_videos, self.ratings_per_video, self.seed)
+        shards = utils.save_csv(csv_file, header, rows, self.shard_rows)
         print(f"Survey is here: {os.path.abspath(survey_file)}")
         print(f"Sample survey is here: {os.path.abspath(sample_survey_file)}")
         print(f"Accompanying csv is here: {os.path.abspath(csv_file)}")
+        if len(shards) > 1:
+            print(f"  Also split into {len(shards)} files of up to {self.shard_rows} rows: "
+                  f"{os.path.basename(shards[0])} ... {os.path.basename(shards[-1])}")
 
 
-    def get_questions(self):
+    @staticmethod
+    def get_questions():
         return [
         {
             "title": "Depth Perception",
@@ -1,9 +1,11 @@
 import os
+import csv
+import itertools
 from pathlib import Path
-from tkinter import Tk, filedialog
 
 def folder_select_dialogue():
     """ Use system GUI to select a folder """
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
     root.attributes('-topmost', True)
@@ -16,3 +18,92 @@ def save_text(file, text):
     Path(os.path.dirname(file)).mkdir(parents=True, exist_ok=True)
     with open(file, "w") as f:
         f.write(text)
+
+
+def save_csv(file, header, rows, shard_rows=None, chunk_rows=10000):
+    """ Stream rows to a csv file, overwriting existing file
+
+    Rows are written in chunks as they are generated, so memory use doesn't
+    depend on the number of rows. If shard_rows is set, the rows are also
+    split into numbered files of at most shard_rows rows each (e.g.
+    survey_001.csv), for services that limit the size of an upload.
+
+    Returns:
+        list: Paths of the shard files written.
+    """
+    Path(os.path.dirname(file)).mkdir(parents=True, exist_ok=True)
+    base, ext = os.path.splitext(file)
+    for old_shard in Path(os.path.dirname(file)).glob(f"{os.path.basename(base)}_[0-9][0-9][0-9]{ext}"):
+        old_shard.unlink()
+
+    shards = []
+    shard_file = shard_writer = None
+    tmp_file = file + ".tmp"
+    with open(tmp_file, "w", newline="", buffering=1024 * 1024) as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        rows = iter(rows)
+        written = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunk_rows))
+                if not chunk:
+                    break
+                writer.writerows(chunk)
+                if shard_rows:
+                    # Split the chunk across shard boundaries
+                    start = 0
+                    while start < len(chunk):
+                        if written % shard_rows == 0:
+                            if shard_file:
+                                shard_file.close()
+                            shards.append(f"{base}_{len(shards) + 1:03d}{ext}")
+                            shard_file = open(shards[-1], "w", newline="", buffering=1024 * 1024)
+                            shard_writer = csv.writer(shard_file)
+                            shard_writer.writerow(header)
+                        end = min(len(chunk), start + shard_rows - written % shard_rows)
+                        shard_writer.writerows(chunk[start:end])
+                        written += end - start
+                        start = end
+        finally:
+            if shard_file:
+                shard_file.close()
+    os.replace(tmp_file, file)
+    return shards
+
+
+
+class LazyDict(dict):
+    """Dict with keys whose values are fetched the first time they're looked up.
+
+    Subclasses list the keys in lazy_keys and fetch their values in fetch.
+    Lazy keys are loaded by [], get() and load(), and count as present for
+    `in` before they're loaded. Other keys behave like a plain dict.
+    """
+    lazy_keys = ()
+
+
+    def fetch(self, key):
+        """ Fetch the value of a lazy key """
+        raise NotImplementedError
+
+
+    def load(self, key):
+        """ Fetch the value of a lazy key if it hasn't been fetched yet """
+        if not dict.__contains__(self, key):
+            self[key] = self.fetch(key)
+        return dict.__getitem__(self, key)
+
+
+    def __missing__(self, key):
+        if key not in self.lazy_keys:
+            raise KeyError(key)
+        return self.load(key)
+
+
+    def __contains__(self, key):
+        return key in self.lazy_keys or dict.__contains__(self, key)
+
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
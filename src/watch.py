@@ -0,0 +1,125 @@
+import asyncio
+import datetime
+import functools
+from src.store import ResponseStore
+from src.pipeline import mode_name
+
+# src.export imports numpy, so it's imported in HITWatcher.watch rather than here
+
+# HIT statuses that can't get any more work
+FINISHED_STATUSES = ["Reviewable", "Reviewing", "Disposed"]
+
+
+class HITWatcher:
+    """Polls MTurk until every HIT is finished, printing new submissions as they arrive.
+
+    The sandbox and live HITs are watched by separate asyncio tasks. Each
+    poll lists the HITs and only fetches the assignments of HITs whose
+    counts changed (see ResponseStore.sync), in a worker thread since boto3
+    blocks. New assignments are saved to the response store and appended
+    to the rating export as they land. The poll interval drops back to
+    min_interval whenever new assignments arrive and grows by backoff after
+    each idle poll, up to max_interval. With allocate, each poll that brings
+    new ratings is followed by an allocation round (see CLI.allocation_round).
+
+    Args:
+        cli (CLI): CLI whose MTurk account and files are used.
+        min_interval (float): Seconds between polls while work is arriving.
+        max_interval (float): Longest wait between polls when idle.
+        backoff (float): Factor the interval grows by after an idle poll.
+        allocate (bool): Expire and extend HITs as ratings settle.
+    """
+    def __init__(self, cli, min_interval=15, max_interval=600, backoff=2.0, allocate=False):
+        self.cli = cli
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.allocate = allocate
+
+
+    def run(self, modes=(True, False)):
+        """ Watch the sandbox (True) and/or live (False) HITs until they're all finished
+
+        Returns:
+            dict: Number of polls and new assignments of each mode.
+        """
+        return asyncio.run(self.watch_all(modes))
+
+
+    async def watch_all(self, modes):
+        results = await asyncio.gather(*[self.watch(sandbox) for sandbox in modes])
+        return {mode_name(sandbox): result for sandbox, result in zip(modes, results)}
+
+
+    async def watch(self, sandbox):
+        """ Poll the HITs of one mode until they're all finished """
+        from src.export import RatingExport
+        name = mode_name(sandbox)
+        loop = asyncio.get_running_loop()
+        store = ResponseStore(self.cli.response_store_file)
+        export = RatingExport(self.cli.rating_export_dir(sandbox))
+        journal_file = self.cli.hit_journal_file(sandbox)
+        # Only assignments submitted while watching are printed
+        last_seen = store.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM assignments").fetchone()[0]
+        interval = self.min_interval
+        polls = new_assignments = 0
+        try:
+            while True:
+                changes = await loop.run_in_executor(None, functools.partial(
+                    store.sync, self.cli.mturk_account, sandbox, journal_file))
+                polls += 1
+                new_assignments += changes['new_assignments']
+                for rowid, assignment_id, hit_id, worker_id, submit_time in store.db.execute(
+                        "SELECT a.rowid, a.assignment_id, a.hit_id, a.worker_id, a.submit_time "
+                        "FROM assignments a JOIN hits h ON a.hit_id = h.hit_id "
+                        "WHERE h.sandbox = ? AND a.rowid > ? ORDER BY a.rowid", (int(sandbox), last_seen)):
+                    print(f"[{name}] {submit_time}  {worker_id} submitted {assignment_id} (HIT {hit_id})")
+                    last_seen = rowid
+                extended = False
+                if changes['new_assignments']:
+                    await loop.run_in_executor(None, export.append, store, sandbox)
+                    if self.allocate:
+                        results = await loop.run_in_executor(None, self.cli.allocation_round, store, sandbox)
+                        extended = bool(results and results['extended_hits'])
+
+                remaining = unfinished_hits(store, sandbox)
+                # Extended HITs only show up as open on the next poll
+                if not remaining and not extended:
+                    print(f"[{name}] All HITs are finished ({new_assignments} new assignments)")
+                    break
+                if changes['new_assignments']:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+                print(f"[{name}] {remaining} HITs still open, {changes['changed_hits']} changed, "
+                      f"checking again in {interval:.0f}s")
+                await asyncio.sleep(interval)
+        finally:
+            store.close()
+        return {'polls': polls, 'new_assignments': new_assignments}
+
+
+
+def unfinished_hits(store, sandbox=False):
+    """ Number of HITs in the store that can still get assignments """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    remaining = 0
+    for status, available, pending, expiration in store.db.execute(
+            "SELECT status, available, pending, expiration FROM hits WHERE sandbox = ?", (int(sandbox),)):
+        if status in FINISHED_STATUSES:
+            continue
+        # Accepted assignments can still be submitted after the HIT expires
+        if pending or (available and not expired(expiration, now)):
+            remaining += 1
+    return remaining
+
+
+def expired(expiration, now):
+    """ Whether a stored HIT expiration time has passed """
+    try:
+        expiration = datetime.datetime.fromisoformat(expiration)
+    except (TypeError, ValueError):
+        return False
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+    return expiration <= now
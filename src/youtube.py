@@ -1,9 +1,15 @@
 import os
 import glob
+import json
+import time
+import random
 import datetime
-import googleapiclient.discovery
-import google_auth_oauthlib
-from googleapiclient.http import MediaFileUpload
+import threading
+from src.ratelimit import ContextThreadPoolExecutor, call_with_retries
+from src.utils import LazyDict
+
+# The google api libraries take a long time to import, so they are imported
+# in the methods that use them rather than when the CLI starts
 
 
 ACCEPTED_EXTENSIONS = [
@@ -11,6 +17,36 @@ ACCEPTED_EXTENSIONS = [
     ".MPG", ".AVI", ".WMV", ".MPEGPS", ".FLV",
 ]
 
+SCOPES = [
+    # "https://www.googleapis.com/auth/youtube",
+    "https://www.googleapis.com/auth/youtube.readonly",
+    # "https://www.googleapis.com/auth/youtube.upload"
+]
+
+# Uploading videos and editing playlists needs write access
+UPLOAD_SCOPES = [
+    "https://www.googleapis.com/auth/youtube",
+]
+
+# Refresh the access token when it is this close to expiring
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Max number of playlists to fetch videos for at the same time
+MAX_WORKERS = 8
+
+# Number of videos to upload at the same time
+UPLOAD_WORKERS = 3
+
+# Size of each resumable upload chunk (must be a multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+
+# Retry settings for failed upload chunks
+UPLOAD_MAX_RETRIES = 8
+RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+
+# Name of the file kept in the video directory to track finished uploads
+UPLOAD_MANIFEST = ".upload_manifest.json"
+
 
 class YouTubeAccount:
     """Helper class for interfacing with the YouTube API
@@ -19,43 +55,135 @@ class YouTubeAccount:
         secrets_file (str): Path to the JSON file that contains your OAuth 2.0
             credentials for the YouTube Data API. Info on how to obtain:
             https://developers.google.com/youtube/v3/quickstart/python#step_1_set_up_your_project_and_credentials
+        token_file (str): Path where the authorized credentials are cached
+            between runs. Only readable by the current user.
+        client: Optional YouTube API client to use instead of logging in
+            and building one, e.g. a src.fakes.FakeYouTubeClient.
+        metrics (ApiMetrics): Optional recorder of every request made by
+            the client, including the quota it uses.
     """
-    def __init__(self, secrets_file):
+    def __init__(self, secrets_file, token_file=".youtube_token.json", client=None, metrics=None):
         self.secrets_file = secrets_file
+        self.token_file = token_file
         self.credentials = None
+        self.login_lock = threading.Lock()
+        self.page_cache = {}
+        self.client = client
+        self.fixed_client = client is not None
+        self.metrics = metrics
+        self.client_credentials = None
+        self.local = threading.local()
 
 
-    def login(self):
+    def login(self, scopes=SCOPES, interactive=True):
         """ Login using OAuth
 
-        Checks to see if logged in already. If not, this will automatically
-        open a browser page to ask for access.
+        Checks to see if logged in already, either in this session or from
+        the cached token file. Credentials that are expired or about to
+        expire are refreshed silently using the refresh token. Only if that
+        isn't possible will this automatically open a browser page to ask
+        for access.
+
+        Args:
+            scopes (list): OAuth scopes the credentials need.
+            interactive (bool): Ask for access in the browser if needed. Set
+                to False when not running in the foreground, e.g. in
+                background status checks.
+
+        Returns:
+            bool: Whether there are valid credentials (always True if interactive).
         """
-        if not self.credentials or self.credentials.valid == False:
-            print("Need to log in and authorize google account.")
-            print("If this doesn't open a browser, use the link below:")
-            scopes = [
-                # "https://www.googleapis.com/auth/youtube",
-                "https://www.googleapis.com/auth/youtube.readonly",
-                # "https://www.googleapis.com/auth/youtube.upload"
-            ]
-            flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
-                self.secrets_file, scopes
-            )
-            self.credentials = flow.run_local_server()
+        if self.fixed_client:
+            return True
+        import google_auth_oauthlib.flow
+        from google.auth.exceptions import RefreshError
+        from google.auth.transport.requests import Request
+        with self.login_lock:
+            if self.credentials is None:
+                self.credentials = self.load_credentials()
+
+            if self.credentials and self.credentials.refresh_token and self.expiring():
+                try:
+                    self.credentials.refresh(Request())
+                    self.save_credentials()
+                except RefreshError:
+                    self.credentials = None
+
+            if (not self.credentials or self.credentials.valid == False or
+                    not self.credentials.has_scopes(scopes)):
+                if not interactive:
+                    return False
+                print("Need to log in and authorize google account.")
+                print("If this doesn't open a browser, use the link below:")
+                flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
+                    self.secrets_file, sorted(set(SCOPES) | set(scopes))
+                )
+                self.credentials = flow.run_local_server()
+                self.save_credentials()
+            return True
+
+
+    def expiring(self):
+        """ Whether the credentials are expired or will expire soon """
+        if self.credentials.expiry is None:
+            return not self.credentials.valid
+        return self.credentials.expiry - REFRESH_MARGIN <= datetime.datetime.utcnow()
+
+
+    def load_credentials(self):
+        """ Load cached credentials from the token file, if there are any """
+        if not self.token_file or not os.path.isfile(self.token_file):
+            return None
+        from google.oauth2.credentials import Credentials
+        try:
+            return Credentials.from_authorized_user_file(self.token_file)
+        except ValueError:
+            print(f"Ignoring invalid token file {self.token_file}")
+            return None
+
+
+    def save_credentials(self):
+        """ Cache the credentials in the token file, readable only by this user """
+        if not self.token_file:
+            return
+        fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.credentials.to_json())
+        os.chmod(self.token_file, 0o600)
 
 
     def get_playlist(self, playlist_title):
-        """ Get info for a specific playlist """
-        self.login()
-        playlists = self.get_playlists_info()
-        for p in playlists:
-            if p['title'] == playlist_title:
-                return p
+        """ Get info for a specific playlist
+
+        Only the playlist metadata is listed to find the title, the videos of
+        the matching playlist are loaded the first time they are accessed.
+        """
+        return self.find_playlists([playlist_title], load_videos=False)[playlist_title]
 
-        # Couldn't find playlist
-        print(f"Could not find playlist '{playlist_title}' in your YouTube account")
-        return None
+
+    def find_playlists(self, playlist_titles, load_videos=True):
+        """ Get info for several playlists from a single listing of the account's playlists
+
+        Args:
+            playlist_titles (list): Titles of the playlists to find.
+            load_videos (bool): Fetch the videos of the found playlists
+                concurrently, instead of when they are first accessed.
+
+        Returns:
+            dict: Playlist of each title, or None if it wasn't found.
+        """
+        self.login()
+        playlists = {p['title']: p for p in reversed(self.get_playlists())}
+        found = {}
+        for title in playlist_titles:
+            found[title] = playlists.get(title)
+            if found[title] is None:
+                print(f"Could not find playlist '{title}' in your YouTube account")
+        if load_videos:
+            to_load = {id(p): p for p in found.values() if p is not None}.values()
+            with ContextThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                list(executor.map(Playlist.load_videos, to_load))
+        return found
 
 
     def get_playlists_info(self):
@@ -64,105 +192,230 @@ class YouTubeAccount:
         Returns:
             A dictionary containing info on all playlists in the user's account
         """
+        playlists = self.get_playlists()
+        with ContextThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(Playlist.load_videos, playlists))
+        return playlists
+
+
+    def get_playlists(self):
+        """Get basic info of all playlists in the account.
+
+        Returns:
+            list: List of Playlist dicts, the videos of each playlist are
+                loaded lazily when the 'videos' key is first accessed.
+        """
+        self.login()
+        youtube = self.get_client()
+        request = youtube.playlists().list(
+            part="snippet,contentDetails,status,player,id",
+            maxResults=50, mine=True
+        )
+        playlists = []
+        while request is not None:
+            response = self.execute_cached(request)
+            for playlist in response['items']:
+                playlists.append(Playlist(self, {
+                    'id': playlist['id'],
+                    'title': playlist['snippet']['title'],
+                    'description': playlist['snippet']['description'],
+                    'privacy_status': playlist['status']['privacyStatus'],
+                }))
+            request = youtube.playlists().list_next(request, response)
+        return playlists
+
 
+    def get_videos(self, playlist_id):
+        """ Get info about all videos in a playlist.
+
+        Args:
+            playlist_id (str): Unique playlist ID.
+
+        Returns:
+            list: List of dicts with info on each video in the playlist.
+        """
         self.login()
-        youtube = googleapiclient.discovery.build(
-            "youtube", "v3", credentials=self.credentials
+        youtube = self.get_client()
+        http = self.get_http()
+        request = youtube.playlistItems().list(
+            part='contentDetails,status,snippet',
+            maxResults=50, playlistId=playlist_id
         )
+        videos = []
+        while request is not None:
+            response = self.execute_cached(request, http)
+            for vid in response['items']:
+                videos.append({
+                    'id': vid['contentDetails']['videoId'],
+                    'title': vid['snippet']['title'],
+                    'description': vid['snippet']['description'],
+                    'privacy_status': vid['status']['privacyStatus'],
+                    'url': f"https://www.youtube.com/embed/{vid['contentDetails']['videoId']}"
+                })
+            request = youtube.playlistItems().list_next(request, response)
+        return videos
 
-        def get_playlists():
-            """Get basic info of all playlists in the account.
 
-            Returns:
-                list: List of dicts with info on each playlist in the account.
-            """
-            request = youtube.playlists().list(
-                part="snippet,contentDetails,status,player,id",
-                maxResults=50, mine=True
+    def get_client(self):
+        """ Get the YouTube Data API client for the current credentials
+
+        The client is built once per login using the discovery document
+        bundled with googleapiclient, so no network fetch is needed.
+        """
+        if self.fixed_client:
+            return self.client
+        if self.client is None or self.client_credentials is not self.credentials:
+            import googleapiclient.discovery
+            from googleapiclient.http import HttpRequest
+            self.client = googleapiclient.discovery.build(
+                "youtube", "v3", credentials=self.credentials, static_discovery=True,
+                requestBuilder=self.metrics.request_builder() if self.metrics else HttpRequest
             )
-            playlists = []
-            while request is not None:
-                response = request.execute()
-                for playlist in response['items']:
-                    playlists.append({
-                        'id': playlist['id'],
-                        'title': playlist['snippet']['title'],
-                        'description': playlist['snippet']['description'],
-                        'privacy_status': playlist['status']['privacyStatus'],
-                    })
-                request = youtube.playlistItems().list_next(request, response)
-            return playlists
-
-        def get_videos(playlist_id):
-            """ Get info about all videos in a playlist.
-
-            Args:
-                playlist_id (str): Unique playlist ID.
-
-            Returns:
-                list: List of dicts with info on each video in the playlist.
-            """
-            request = youtube.playlistItems().list(
-                part='contentDetails,status,snippet',
-                maxResults=50, playlistId=playlist_id
+            self.client_credentials = self.credentials
+            self.local = threading.local()
+        return self.client
+
+
+    def get_http(self):
+        """ Get an authorized http object for the current thread
+
+        httplib2 is not thread-safe, so requests running on worker threads
+        must each execute with their own http object.
+        """
+        if self.fixed_client:
+            return None
+        if getattr(self.local, 'http', None) is None:
+            import httplib2
+            import google_auth_httplib2
+            self.local.http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http()
             )
-            videos = []
-            while request is not None:
-                response = request.execute()
-                for vid in response['items']:
-                    videos.append({
-                        'id': vid['contentDetails']['videoId'],
-                        'title': vid['snippet']['title'],
-                        'description': vid['snippet']['description'],
-                        'privacy_status': vid['status']['privacyStatus'],
-                        'url': f"https://www.youtube.com/embed/{vid['contentDetails']['videoId']}"
-                    })
-                request = youtube.playlistItems().list_next(request, response)
-            return videos
-
-        playlists = get_playlists()
-        for p in playlists:
-            p['videos'] = get_videos(p['id'])
-        return playlists
+        return self.local.http
+
+
+    def execute_cached(self, request, http=None):
+        """ Execute a list request, revalidating a cached page with its ETag
+
+        If the page was fetched before, the request is sent with an
+        If-None-Match header and a 304 response returns the cached page
+        without downloading it again.
+        """
+        from googleapiclient.errors import HttpError
+        cached = self.page_cache.get(request.uri)
+        if cached is not None:
+            request.headers['If-None-Match'] = cached['etag']
+        try:
+            response = call_with_retries(request.execute, http=http)
+        except HttpError as e:
+            if cached is not None and e.resp.status == 304:
+                return cached
+            raise
+        if 'etag' in response:
+            self.page_cache[request.uri] = response
+        return response
 
 
     def upload_to_playlist(self, video_dir_path, playlist_name):
         """ Upload a directory of videos to a playlist.
         The title of the video in YouTube will be the name of the file (minus the extension)
 
+        Videos are uploaded a few at a time in resumable chunks. Finished
+        uploads are recorded in a manifest in the video directory keyed by the
+        file's content hash, so running this again skips videos that were
+        already uploaded and only adds them to the playlist if needed. The
+        upload session of each unfinished video is kept in the manifest too,
+        so a video whose upload was interrupted continues where it stopped.
+
         Args:
             video_dir_path (str): The directory where the videos are located.
             playlist_name (str): The name of the playlist to create.
         """
         # Get the files to upload, check if valid
-        video_files = sorted(glob.glob(os.path.join(video_dir_path, "*")))
-        for v in video_files:
+        video_files = []
+        for v in sorted(glob.glob(os.path.join(video_dir_path, "*"))):
             if not os.path.splitext(os.path.basename(v))[1].upper() in ACCEPTED_EXTENSIONS:
                 print(f"Video {v} not an accepted video file, ignoring")
-                video_files.remove(v)
+            else:
+                video_files.append(v)
         if len(video_files) == 0:
             print(f"No video files found in {video_dir_path}. Exiting.")
             return
 
         # Login to YouTube API and build API client
-        self.login()
-        youtube = googleapiclient.discovery.build(
-            "youtube", "v3", credentials=self.credentials
-        )
+        self.login(UPLOAD_SCOPES)
+        youtube = self.get_client()
 
         # Create playlist
+        playlist = self.get_playlist(playlist_name)
+        if playlist is None:
+            response = self.execute_with_retries(youtube.playlists().insert(
+                part='snippet,status',
+                body={
+                    'snippet': {'title': playlist_name},
+                    'status': {'privacyStatus': 'unlisted'},
+                }
+            ))
+            print(f"Created playlist '{playlist_name}'")
+            playlist_id, playlist_videos = response['id'], set()
+        else:
+            playlist_id = playlist['id']
+            playlist_videos = set(vid['id'] for vid in playlist['videos'])
 
         # Upload all videos
-        for idx, v in enumerate(video_files):
-            # Upload video
+        manifest = UploadManifest(os.path.join(video_dir_path, UPLOAD_MANIFEST))
+        def upload(idx_video):
+            idx, v = idx_video
             video_name = os.path.splitext(os.path.basename(v))[0]
-            print(f"Uploading video {video_name} ({idx+1}/{len(video_files)})..")
-            request = youtube.videos().insert(
+            progress = f"{video_name} ({idx+1}/{len(video_files)})"
+            file_hash = hash_file(v)
+            video_id = manifest.video_id(file_hash)
+            if video_id is None:
+                print(f"Uploading video {progress}..")
+                video_id = self.upload_video(v, video_name, f'Video {idx}', progress,
+                                             manifest=manifest, file_hash=file_hash)
+                manifest.add(file_hash, v, video_id)
+            else:
+                print(f"Video {progress} already uploaded, skipping")
+
+            # Insert video into playlist
+            if video_id not in playlist_videos:
+                self.execute_with_retries(youtube.playlistItems().insert(
+                    part='snippet',
+                    body={'snippet': {
+                        'playlistId': playlist_id,
+                        'resourceId': {'kind': 'youtube#video', 'videoId': video_id},
+                    }}
+                ))
+            return video_id
+
+        with ContextThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            video_ids = list(executor.map(upload, enumerate(video_files)))
+        print(f"{len(video_ids)} videos are in the playlist '{playlist_name}'")
+        return video_ids
+
+
+    def upload_video(self, video_file, title, description, progress="", manifest=None, file_hash=None):
+        """ Upload a single video in resumable chunks, retrying failed chunks
+
+        Args:
+            manifest (UploadManifest): Optional manifest to save the upload
+                session in after every chunk, keyed by file_hash. An upload
+                session saved by an earlier run is resumed from the offset
+                YouTube has received, or restarted if it has expired.
+
+        Returns:
+            str: The id of the uploaded video.
+        """
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
+        def new_request():
+            return self.get_client().videos().insert(
                 part='snippet,status',
                 body={
                     'snippet': {
-                        'title': video_name,
-                        'description': f'Video {idx}',
+                        'title': title,
+                        'description': description,
                         'categoryId': 27,
                         'tags': ['annotation', 'crowdsourcing']
                     },
@@ -172,10 +425,166 @@ class YouTubeAccount:
                     },
                     'notifySubscribers': False
                 },
-                media_body=MediaFileUpload(v, chunksize=-1)
+                media_body=MediaFileUpload(video_file, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
             )
-            response = request.execute()
-            print(response)
 
-            # Insert video into playlist
+        request = new_request()
+        session = manifest.session(file_hash) if manifest is not None else None
+        if session is not None:
+            print(f"  {progress}: resuming upload after {session['uploaded_bytes'] / 1e6:.1f} MB")
+            request.resumable_uri = session['upload_uri']
+            # Makes the next chunk ask YouTube how much it received before sending anything
+            request._in_error_state = True
+        http = self.get_http()
+        start = time.monotonic()
+        response = None
+        retries = 0
+        while response is None:
+            try:
+                status, response = call_with_retries(request.next_chunk, http=http)
+                retries = 0
+            except HttpError as e:
+                if e.resp.status in (404, 410) and session is not None:
+                    print(f"  {progress}: upload session expired, starting over")
+                    request, session = new_request(), None
+                    continue
+                if e.resp.status not in RETRIABLE_STATUS_CODES:
+                    raise
+                retries = self.backoff(retries, e)
+                continue
+            except retriable_exceptions() as e:
+                retries = self.backoff(retries, e)
+                continue
+            if status is not None:
+                if manifest is not None:
+                    manifest.add_session(file_hash, video_file, request.resumable_uri,
+                                         status.resumable_progress)
+                elapsed = max(time.monotonic() - start, 1e-6)
+                mb_per_sec = status.resumable_progress / elapsed / 1e6
+                print(f"  {progress}: {status.progress() * 100:.0f}% ({mb_per_sec:.1f} MB/s)")
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        size_mb = os.path.getsize(video_file) / 1e6
+        print(f"  {progress}: done, {size_mb:.1f} MB in {elapsed:.0f}s ({size_mb / elapsed:.1f} MB/s)")
+        return response['id']
+
+
+    def execute_with_retries(self, request):
+        """ Execute a request on this thread's http object, retrying throttling and server errors """
+        from googleapiclient.errors import HttpError
+        retries = 0
+        while True:
+            try:
+                return call_with_retries(request.execute, http=self.get_http())
+            except HttpError as e:
+                if e.resp.status not in RETRIABLE_STATUS_CODES:
+                    raise
+                retries = self.backoff(retries, e)
+            except retriable_exceptions() as e:
+                retries = self.backoff(retries, e)
+
+
+    def backoff(self, retries, error):
+        """ Sleep with exponential backoff and jitter, re-raising once out of retries """
+        retries += 1
+        if retries > UPLOAD_MAX_RETRIES:
+            raise error
+        sleep_seconds = random.random() * (2 ** retries)
+        print(f"  Retrying in {sleep_seconds:.1f}s after error: {error}")
+        time.sleep(sleep_seconds)
+        return retries
+
+
+
+class UploadManifest:
+    """Record of uploaded videos, keyed by the hash of the video file.
+
+    Unfinished uploads are recorded with their resumable upload session URI
+    and the number of bytes uploaded so far, instead of a video id.
+
+    Args:
+        path (str): JSON file the manifest is saved to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+
+    def video_id(self, file_hash):
+        """ YouTube id of an already uploaded file, or None """
+        entry = self.entries.get(file_hash)
+        return entry.get('video_id') if entry else None
+
+
+    def session(self, file_hash):
+        """ Entry of an unfinished upload with its 'upload_uri' and 'uploaded_bytes', or None """
+        entry = self.entries.get(file_hash)
+        return entry if entry and 'upload_uri' in entry else None
+
+
+    def add(self, file_hash, video_file, video_id):
+        """ Record a finished upload and save the manifest """
+        self.save(file_hash, {'file': os.path.basename(video_file), 'video_id': video_id})
+
+
+    def add_session(self, file_hash, video_file, upload_uri, uploaded_bytes):
+        """ Record how far an unfinished upload got and save the manifest """
+        self.save(file_hash, {'file': os.path.basename(video_file), 'upload_uri': upload_uri,
+                              'uploaded_bytes': uploaded_bytes})
+
+
+    def save(self, file_hash, entry):
+        with self.lock:
+            self.entries[file_hash] = entry
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def retriable_exceptions():
+    """ Network errors worth retrying a request after """
+    import socket
+    import httplib2
+    return (httplib2.HttpLib2Error, IOError, socket.timeout)
+
+
+def hash_file(path, block_size=1024 * 1024):
+    """ SHA-256 of a file's contents, read in blocks """
+    import hashlib
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+
+class Playlist(LazyDict):
+    """Info on a single playlist whose videos are fetched on first access.
+
+    Behaves like the plain playlist dict, the 'videos' key is filled in by
+    YouTubeAccount.get_videos the first time it is looked up (see LazyDict).
+
+    Args:
+        account (YouTubeAccount): Account used to fetch the videos.
+        info (dict): Basic info on the playlist (id, title, ...).
+    """
+    lazy_keys = ('videos',)
+
+    def __init__(self, account, info):
+        super().__init__(info)
+        self.account = account
+
+
+    def fetch(self, key):
+        return self.account.get_videos(self['id'])
+
 
+    def load_videos(self):
+        """ Fetch the videos in the playlist if they haven't been fetched yet """
+        return self.load('videos')